@@ -0,0 +1,5 @@
+# Benchmarks and numerical regression checks (scripts, run from the repository root):
+#
+#   python -m benchmarks.run                          stage timings, memory, reference check
+#   python -m benchmarks.check_1022 /path/to/ds005620 equivalence with kq_timeseries_hybrid_1022.csv
+#   python -m benchmarks.startup                      import time of the library API (no MNE/matplotlib/Tk/tqdm)
@@ -0,0 +1,100 @@
+# =============================================================================
+# Numerical equivalence with the stored sub-1022 reference output
+#
+# kq_timeseries_hybrid_1022.csv (repository root) is the output of the
+# original script for subject 1022 of ds005620 (2 s windows, 50% overlap).
+# This check re-runs the current pipeline on the real recording and compares
+# every column with it. It needs the dataset on disk:
+#
+#   python -m benchmarks.check_1022 /path/to/ds005620
+# =============================================================================
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from kqeeg.metrics import SPECTRAL_MODES
+from kqeeg.pipeline import (DEFAULT_OVERLAP_PERC, DEFAULT_WIN_SEC, add_derived_metrics, analyze_with_events,
+                            load_full_cycle_and_events)
+
+# Stored output of the original script
+REFERENCE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "kq_timeseries_hybrid_1022.csv")
+
+# The formulas under guard, and the tolerance (relative to the column scale)
+CORE_COLUMNS = ("KQ_naive", "C_naive", "H_norm_naive")
+CORE_RTOL = 1e-9
+
+# Other per-window columns; the derived columns (dKQ_dt, KQ_local_variance,
+# KQ_zscore) amplify round-off and get a looser bound
+COLUMN_RTOL = 1e-9
+DERIVED_RTOL = 1e-6
+DERIVED_COLUMNS = ("dKQ_dt", "KQ_local_variance", "KQ_zscore")
+
+
+def column_deviations(df, reference):
+    """Column -> max |df - reference| relative to the reference column's largest magnitude."""
+    deviation = {}
+    for name in reference.columns:
+        if name not in df.columns:
+            deviation[name] = float("inf")
+            continue
+        expected = reference[name].to_numpy(dtype=float)
+        scale = max(np.nanmax(np.abs(expected)), np.finfo(float).tiny)
+        diff = np.abs(df[name].to_numpy(dtype=float) - expected)
+        # NaN in one file but not the other counts as a mismatch
+        diff[np.isnan(diff) & ~(np.isnan(expected) & df[name].isna().to_numpy())] = np.inf
+        deviation[name] = float(np.nanmax(diff) / scale) if len(diff) else 0.0
+    return deviation
+
+
+def tolerance(name):
+    if name in CORE_COLUMNS:
+        return CORE_RTOL
+    return DERIVED_RTOL if name in DERIVED_COLUMNS else COLUMN_RTOL
+
+
+def check_1022(dataset_path, reference_csv=REFERENCE_CSV, **analysis_kwargs):
+    """
+    Recomputes sub-1022 and compares it with the stored reference table.
+
+    Returns:
+        tuple: (deviations dict, list of failing column names)
+    """
+    reference = pd.read_csv(reference_csv)
+    data, sfreq, phases, duration, events = load_full_cycle_and_events(dataset_path, "1022")
+    results, _ = analyze_with_events(data, sfreq, phases, events, "1022", DEFAULT_WIN_SEC, DEFAULT_OVERLAP_PERC,
+                                     live_plot=False, **analysis_kwargs)
+    df = pd.DataFrame(results)
+    add_derived_metrics(df, phases, DEFAULT_WIN_SEC, DEFAULT_OVERLAP_PERC)
+    if len(df) != len(reference):
+        raise ValueError(f"Window count differs from the reference: {len(df)} != {len(reference)}")
+
+    deviation = column_deviations(df, reference)
+    failures = [name for name, dev in deviation.items() if not dev <= tolerance(name)]
+    return deviation, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a fresh sub-1022 run with kq_timeseries_hybrid_1022.csv.")
+    parser.add_argument("dataset", help="Path to the ds005620 root")
+    parser.add_argument("--reference", default=REFERENCE_CSV, help="Reference CSV (default: the stored one)")
+    parser.add_argument("--spectral-mode", default="exact", choices=SPECTRAL_MODES)
+    args = parser.parse_args(argv)
+
+    deviation, failures = check_1022(args.dataset, args.reference, spectral_mode=args.spectral_mode)
+    for name, dev in deviation.items():
+        status = "FAIL" if name in failures else "ok"
+        print(f"{name:24s} {dev:10.3e}  (tol {tolerance(name):.0e})  {status}")
+    if failures:
+        print(f"Numerical regression in: {', '.join(failures)}")
+        return 1
+    print("sub-1022 matches the reference output.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
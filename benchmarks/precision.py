@@ -0,0 +1,149 @@
+# =============================================================================
+# float32 computation path vs float64: accuracy, memory and speed
+#
+# precision="float32" (kqeeg.stream) stores the filtered signal as float32
+# and computes every window FFT in complex64, while the reductions (moments,
+# channel-averaged PSDs, entropy sum, C) stay in float64. This report loads a
+# subject once, analyzes it in both precisions and prints, per metric
+# column, the maximum absolute deviation of the float32 result and that
+# deviation relative to the column's largest float64 magnitude, plus the
+# signal size, the window-analysis time and its peak traced memory.
+#
+# The exit status is 1 when KQ_naive, C_naive or H_norm_naive deviate by
+# more than their tolerance, so this can gate changes to the float32 path.
+#
+# What to expect: H_norm, the TS metrics and the in-band coherence agree to
+# ~1e-7 relative. C_naive (and so KQ_naive) is a mean over ALL coherence
+# bins up to Nyquist, and above ~200 Hz the band-passed signal is 1e-12 of
+# its peak power, below float32 resolution; the coherence of those bins is
+# round-off in either precision but different round-off, which moves C by
+# about 1-2% of its scale.
+#
+#   python -m benchmarks.precision                       # synthetic subject
+#   python -m benchmarks.precision --dataset /path/to/ds005620 --subject 1022
+# =============================================================================
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import matplotlib
+matplotlib.use("Agg")  # before kqeeg imports pyplot
+
+import numpy as np
+
+from kqeeg.metrics import METRIC_COLUMNS, SPECTRAL_MODES
+from kqeeg.pipeline import analyze_with_events, load_full_cycle_and_events
+
+from .run import best_time, traced_peak
+from .synthetic import make_dataset
+
+# Columns gated by the report and their tolerance (relative to the column
+# scale); C and KQ include the stopband coherence bins (see above)
+PRECISION_RTOL = {"KQ_naive": 5e-2, "C_naive": 5e-2, "H_norm_naive": 1e-6}
+PRECISION_COLUMNS = tuple(PRECISION_RTOL)
+
+SUBJECT_ID = "9001"
+
+
+def precision_report(data, sfreq, phases, events, subject_id, win_sec=2.0, overlap_perc=50, repeat=1,
+                     **analysis_kwargs):
+    """
+    Analyzes a float64 recording and its float32 copy and compares the results.
+
+    The float32 copy is exactly what precision="float32" loads (the filter
+    runs in float64 and its output is rounded), so loading happens once.
+
+    Returns:
+        dict: "deviation" (column -> {"max_abs", "max_rel"}) and, per
+        precision, the signal size, window-analysis time and peak memory.
+    """
+    report = {"n_windows": None, "deviation": {}}
+    results = {}
+    for precision in ("float64", "float32"):
+        signal = np.ascontiguousarray(data, dtype=precision)
+
+        def analyze():
+            out, _ = analyze_with_events(signal, sfreq, phases, events, subject_id, win_sec, overlap_perc,
+                                         live_plot=False, **analysis_kwargs)
+            return out
+
+        print(f"--- {precision} ---")
+        sec, results[precision] = best_time(analyze, repeat)
+        report[precision] = {"signal_mb": signal.nbytes / 2**20, "window_sec": sec,
+                             "window_peak_mb": traced_peak(analyze) / 2**20}
+        del signal
+
+    reference, single = results["float64"], results["float32"]
+    report["n_windows"] = len(reference["KQ_naive"])
+    for name in METRIC_COLUMNS:
+        if name.startswith("t_"):
+            continue
+        expected = np.asarray(reference[name], dtype=float)
+        diff = np.abs(np.asarray(single[name], dtype=float) - expected)
+        max_abs = float(np.nanmax(diff)) if len(diff) else 0.0
+        scale = max(np.nanmax(np.abs(expected)), np.finfo(float).tiny) if len(expected) else 1.0
+        report["deviation"][name] = {"max_abs": max_abs, "max_rel": max_abs / scale}
+    return report
+
+
+def print_report(report, rtol=PRECISION_RTOL):
+    """Prints the report; returns the gated columns that exceed their `rtol`."""
+    print(f"\n{'column':24s} {'max |f32 - f64|':>16s} {'relative':>10s}")
+    for name, dev in report["deviation"].items():
+        tol = rtol.get(name)
+        flag = "" if tol is None else f"  (tol {tol:.0e}) " + ("ok" if dev["max_rel"] <= tol else "FAIL")
+        print(f"{name:24s} {dev['max_abs']:16.3e} {dev['max_rel']:10.3e}{flag}")
+
+    f64, f32 = report["float64"], report["float32"]
+    print(f"\n{'':10s} {'signal (MB)':>12s} {'windows (s)':>12s} {'peak (MB)':>10s}")
+    for precision in ("float64", "float32"):
+        p = report[precision]
+        print(f"{precision:10s} {p['signal_mb']:12.1f} {p['window_sec']:12.3f} {p['window_peak_mb']:10.1f}")
+    print(f"{report['n_windows']} windows; float32 speed-up x{f64['window_sec'] / f32['window_sec']:.2f}, "
+          f"window memory x{f32['window_peak_mb'] / max(f64['window_peak_mb'], 1e-9):.2f}")
+    return [name for name, tol in rtol.items() if not report["deviation"][name]["max_rel"] <= tol]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the float32 computation path with float64.")
+    parser.add_argument("--dataset", default=None, help="Dataset root (default: a synthetic subject)")
+    parser.add_argument("--subject", default="1022", help="Subject of --dataset (default 1022)")
+    parser.add_argument("--channels", type=int, default=32, help="Synthetic channels (default 32)")
+    parser.add_argument("--run-sec", type=float, default=60.0, help="Synthetic run duration in s (default 60)")
+    parser.add_argument("--win-sec", type=float, default=2.0)
+    parser.add_argument("--overlap", type=float, default=50)
+    parser.add_argument("--spectral-mode", default="exact", choices=SPECTRAL_MODES)
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per precision; the best is kept")
+    parser.add_argument("--rtol", type=float, default=None,
+                        help="One relative tolerance for all gated columns (default: per column, "
+                             + ", ".join(f"{name} {tol:g}" for name, tol in PRECISION_RTOL.items()) + ")")
+    parser.add_argument("--output", default=None, help="Also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="kqeeg-precision-") as tmp:
+        dataset_path, subject_id = args.dataset, args.subject
+        if dataset_path is None:
+            print("Writing synthetic subject...")
+            dataset_path = make_dataset(os.path.join(tmp, "ds"), SUBJECT_ID, args.channels, args.run_sec)
+            subject_id = SUBJECT_ID
+        data, sfreq, phases, _, events = load_full_cycle_and_events(dataset_path, subject_id)
+        report = precision_report(data, sfreq, phases, events, subject_id, args.win_sec, args.overlap,
+                                  args.repeat, spectral_mode=args.spectral_mode)
+
+    rtol = PRECISION_RTOL if args.rtol is None else dict.fromkeys(PRECISION_COLUMNS, args.rtol)
+    failures = print_report(report, rtol)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if failures:
+        print(f"float32 deviation above tolerance in: {', '.join(failures)}")
+        return 1
+    print("float32 path within tolerance of float64.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# =============================================================================
+# Reference per-window metrics (the original loop, one window at a time)
+#
+# This is the calculation of the original analyze_with_events loop, written
+# with scipy.signal.welch / coherence exactly as it was, for one window. It is
+# slow (a scipy coherence call per channel pair) and is only used to check
+# that the vectorized engine in kqeeg.metrics still produces the same
+# numbers: every optimization of the KQ_naive / C_naive / H_norm_naive
+# formulas has to pass compare_to_reference.
+# =============================================================================
+
+import numpy as np
+from scipy.signal import coherence, welch
+
+from kqeeg.metrics import BANDS, METRIC_COLUMNS, window_starts
+
+# Default tolerance of the reference comparison (relative to the column scale)
+REFERENCE_RTOL = 1e-9
+
+# Accumulator modes: C (and so KQ) sits on a grid hop that divides the window
+# step (kqeeg.accumulator), i.e. its segments overlap a little differently
+# than the exact 128-sample hop. "accumulator_window_psd" keeps the exact PSD
+# columns; "accumulator" takes them from the 256-sample grid, whose coarse
+# bins and taper leakage move band powers and H_norm by tens of percent and
+# theta (next to the alpha peak) by a multiple on the synthetic recordings
+ACCUMULATOR_RTOL = {
+    "accumulator_window_psd": {"C_naive": 0.2, "KQ_naive": 0.2},
+    "accumulator": {
+        "C_naive": 0.2, "KQ_naive": 0.35, "H_norm_naive": 0.3,
+        **{f"{kind}_{band}": rtol for band, rtol in
+           {"delta": 0.8, "theta": 3.5, "alpha": 0.5, "beta": 0.5, "gamma": 0.5}.items()
+           for kind in ("band_power", "relative_power")},
+    },
+}
+
+
+def reference_tolerance(name, spectral_mode):
+    """Tolerance of column `name` in compare_to_reference for a spectral mode."""
+    return ACCUMULATOR_RTOL.get(spectral_mode, {}).get(name, REFERENCE_RTOL)
+
+
+def reference_window_metrics(win, sfreq, coh_channels=20):
+    """
+    All METRIC_COLUMNS except the times for one (channels, samples) window,
+    computed as in the original per-window loop.
+    """
+    win_samples = win.shape[1]
+    out = {
+        "gfp": np.std(win, axis=0).mean(),
+        "mean_amplitude": np.mean(win),
+        "variance": np.var(win),
+    }
+
+    f, psd = welch(win, fs=sfreq, nperseg=win_samples, axis=1)
+    psd_avg_ts = np.nan_to_num(np.nanmean(psd, axis=0))
+    total_power = np.sum(psd_avg_ts)
+    if total_power <= 0:
+        total_power = 1e-12
+    for band, (f_low, f_high) in BANDS.items():
+        power_in_band = np.sum(psd_avg_ts[(f >= f_low) & (f < f_high)])
+        out[f"band_power_{band}"] = power_in_band
+        out[f"relative_power_{band}"] = power_in_band / total_power
+
+    psd_avg = psd.mean(axis=0)
+    psd_avg /= (psd_avg.sum() + 1e-12)
+    H_norm = -np.sum(psd_avg * np.log2(psd_avg + 1e-12)) / np.log2(len(psd_avg))
+
+    n = min(coh_channels, win.shape[0])
+    C, pairs = 0.0, 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            _, coh = coherence(win[i], win[j], fs=sfreq)
+            C += coh.mean()
+            pairs += 1
+    C = C / pairs if pairs > 0 else 0.0
+
+    out.update({"KQ_naive": C * (1 - H_norm), "C_naive": C, "H_norm_naive": H_norm})
+    return out
+
+
+def compare_to_reference(data, sfreq, results, win_samples, step, n_windows=50, coh_channels=20):
+    """
+    Recomputes `n_windows` evenly spaced windows with the reference loop and
+    compares them with the engine output.
+
+    Args:
+        data (np.ndarray): Filtered signal (channels, samples).
+        sfreq (float): Sampling rate in Hz.
+        results (dict): Engine output (METRIC_COLUMNS -> arrays).
+        win_samples (int): Window length in samples.
+        step (int): Hop between windows in samples.
+        n_windows (int): Number of windows to check.
+        coh_channels (int): Channels used for C.
+
+    Returns:
+        dict: Column -> max deviation relative to the column's largest
+        reference magnitude (0 for exact agreement, inf when the windows
+        that are NaN differ between engine and reference).
+    """
+    starts = window_starts(data.shape[1], win_samples, step)
+    picks = np.unique(np.linspace(0, len(starts) - 1, min(n_windows, len(starts))).astype(int))
+    deviation = {}
+    columns = [name for name in METRIC_COLUMNS if not name.startswith("t_")]
+    expected = {name: np.empty(len(picks)) for name in columns}
+    for k, w in enumerate(picks):
+        ref = reference_window_metrics(data[:, starts[w]:starts[w] + win_samples], sfreq, coh_channels)
+        for name in columns:
+            expected[name][k] = ref[name]
+    for name in columns:
+        actual = np.asarray(results[name], dtype=float)[picks]
+        missing = np.isnan(expected[name])
+        if not np.array_equal(np.isnan(actual), missing):
+            # A NaN on one side only is a mismatch of its own, not a value to skip
+            deviation[name] = np.inf
+            continue
+        if missing.all():
+            deviation[name] = 0.0
+            continue
+        scale = max(np.abs(expected[name][~missing]).max(), np.finfo(float).tiny)
+        deviation[name] = float(np.abs(actual[~missing] - expected[name][~missing]).max() / scale)
+    return deviation
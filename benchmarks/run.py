@@ -0,0 +1,307 @@
+# =============================================================================
+# Stage benchmarks and numerical regression checks
+#
+# Writes a synthetic subject (benchmarks/synthetic.py), runs the pipeline on
+# it stage by stage and reports, per stage, the best wall time over
+# --repeat runs and the peak traced memory of one extra run:
+#
+#   load_full_cycle  load_full_cycle_and_events end to end
+#   load_resample    reading + resampling the runs (unfiltered blocks)
+#   filter           the block-wise band-pass
+#   window_metrics   analyze_with_events without the live plot (windows/sec)
+#   coherence        the C_naive kernel alone, on the same windows
+#   live_plot        LivePlot fed with the results block by block (Agg)
+#   outputs          write_outputs (result table, TSV, JSON, summary PNG)
+#   startup_<target> import time of the library API in a fresh interpreter
+#                    (benchmarks/startup.py); importing MNE, matplotlib, Tk,
+#                    tqdm or scipy.signal there is reported as a regression
+#
+# The engine output is compared with the original per-window loop
+# (benchmarks/reference.py) on a sample of windows. Every run is appended to
+# a JSON-lines history; when an earlier run with the same configuration
+# exists, stages that got slower or bigger than the tolerances are reported
+# as regressions and the exit status is 1 (so this can gate CI).
+#
+#   python -m benchmarks.run
+#   python -m benchmarks.run --channels 64 --run-sec 300 --repeat 3
+#   python -m benchmarks.run --dataset /path/to/ds005620   # + sub-1022 check
+# =============================================================================
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import matplotlib
+matplotlib.use("Agg")  # before kqeeg imports pyplot
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from kqeeg.liveplot import LivePlot
+from kqeeg.metrics import SPECTRAL_MODES, window_view
+from kqeeg.pipeline import analyze_with_events, load_full_cycle_and_events, write_outputs
+from kqeeg.spectral import naive_coherence
+from kqeeg.stream import BandpassFilter, SubjectStream
+
+from .reference import compare_to_reference, reference_tolerance
+from .startup import heavy_imports, measure_startup
+from .synthetic import make_dataset
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HISTORY = os.path.join(BENCH_DIR, "results", "history.jsonl")
+
+# Regression thresholds: a stage is flagged when it is this much slower /
+# bigger than the last run with the same configuration
+DEFAULT_TIME_TOLERANCE = 0.25
+DEFAULT_MEMORY_TOLERANCE = 0.25
+
+# Stages faster than this are too noisy to flag
+MIN_STAGE_SEC = 0.05
+
+# Windows per block fed to the coherence kernel and the live plot
+BLOCK_WINDOWS = 64
+
+SUBJECT_ID = "9001"
+
+
+def best_time(fn, repeat):
+    """(best wall time over `repeat` calls, last return value)."""
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def traced_peak(fn):
+    """Peak memory (bytes) traced by tracemalloc during one call (numpy buffers included)."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss_bytes():
+    """Peak resident set size of this process so far."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stages(dataset_path, config, repeat, out_dir):
+    """
+    Runs every stage; returns (stages dict, context) where context holds the
+    data and results needed by the numerical checks.
+    """
+    win_sec, overlap_perc = config["win_sec"], config["overlap_perc"]
+    analysis_kwargs = {"spectral_mode": config["spectral_mode"], "n_jobs": config["window_jobs"]}
+    ctx = {}
+
+    def load_full_cycle():
+        ctx["loaded"] = load_full_cycle_and_events(dataset_path, SUBJECT_ID)
+
+    def load_resample():
+        stream = SubjectStream(dataset_path, SUBJECT_ID)
+        ctx["stream"], ctx["raw_blocks"] = stream, list(stream.raw_blocks())
+
+    def filter_blocks():
+        stream = ctx["stream"]
+        filt = BandpassFilter(stream.sfreq, stream.n_channels)
+        data = np.empty(stream.shape)
+        pos = 0
+        for block in ctx["raw_blocks"]:
+            data[:, pos:pos + block.shape[1]] = filt(block)
+            pos += block.shape[1]
+        ctx["data"] = data
+
+    def window_metrics():
+        data, sfreq, phases, _, events = ctx["loaded"]
+        ctx["results"], _ = analyze_with_events(data, sfreq, phases, events, SUBJECT_ID, win_sec, overlap_perc,
+                                                live_plot=False, **analysis_kwargs)
+
+    def coherence():
+        data, sfreq = ctx["loaded"][:2]
+        win_samples = int(win_sec * sfreq)
+        windows = window_view(data, win_samples, int(win_samples * (1 - overlap_perc / 100)))
+        for w0 in range(0, len(windows), BLOCK_WINDOWS):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                naive_coherence(windows[w0:w0 + BLOCK_WINDOWS])
+
+    def live_plot():
+        _, _, phases, duration, events = ctx["loaded"]
+        results = ctx["results"]
+        plot = LivePlot(SUBJECT_ID, phases, events, duration, refresh_sec=0.0)
+        for w0 in range(0, len(results["t_mid_sec"]), BLOCK_WINDOWS):
+            block = slice(w0, w0 + BLOCK_WINDOWS)
+            plot.append(results["t_mid_sec"][block], results["KQ_naive"][block],
+                        results["C_naive"][block], results["H_norm_naive"][block])
+            plot.refresh()
+        plot.finish()
+        plt.close(plot.fig)
+
+    def outputs():
+        _, sfreq, phases, _, events = ctx["loaded"]
+        write_outputs(out_dir, dataset_path, SUBJECT_ID, "bench", ctx["results"], events, sfreq, phases,
+                      win_sec, overlap_perc)
+
+    stages = {}
+    for name, fn in [("load_full_cycle", load_full_cycle), ("load_resample", load_resample),
+                     ("filter", filter_blocks), ("window_metrics", window_metrics), ("coherence", coherence),
+                     ("live_plot", live_plot), ("outputs", outputs)]:
+        print(f"--- {name} ---")
+        sec, _ = best_time(fn, repeat)
+        stages[name] = {"sec": sec, "peak_mb": traced_peak(fn) / 2**20}
+
+    if not np.array_equal(ctx["data"], ctx["loaded"][0]):
+        raise RuntimeError("Stage-wise load + filter differs from load_full_cycle_and_events")
+    n_windows = len(ctx["results"]["KQ_naive"])
+    stages["window_metrics"]["windows_per_sec"] = n_windows / stages["window_metrics"]["sec"]
+    stages["coherence"]["windows_per_sec"] = n_windows / stages["coherence"]["sec"]
+    ctx["n_windows"] = n_windows
+
+    print("--- startup ---")
+    startup = measure_startup(max(repeat, 3))
+    for name, r in startup.items():
+        stages[f"startup_{name}"] = {"sec": r["sec"], "peak_mb": r["peak_mb"]}
+    ctx["heavy_imports"] = heavy_imports(startup)
+    return stages, ctx
+
+
+def find_baseline(history_path, config):
+    """Most recent history entry with the same configuration (or None)."""
+    if not os.path.exists(history_path):
+        return None
+    baseline = None
+    with open(history_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("config") == config:
+                baseline = entry
+    return baseline
+
+
+def regressions(stages, baseline, time_tolerance, memory_tolerance):
+    """Human-readable list of stages slower/bigger than the baseline allows."""
+    found = []
+    for name, now in stages.items():
+        before = baseline["stages"].get(name)
+        if before is None:
+            continue
+        if now["sec"] >= MIN_STAGE_SEC and now["sec"] > before["sec"] * (1 + time_tolerance):
+            found.append(f"{name}: {now['sec']:.3f} s vs {before['sec']:.3f} s")
+        if now["peak_mb"] > before["peak_mb"] * (1 + memory_tolerance) + 1.0:
+            found.append(f"{name}: {now['peak_mb']:.1f} MB vs {before['peak_mb']:.1f} MB peak")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="KQ pipeline stage benchmarks and numerical regression checks.")
+    parser.add_argument("--channels", type=int, default=32, help="Synthetic channels (default 32)")
+    parser.add_argument("--run-sec", type=float, default=60.0, help="Duration of every run in s (default 60)")
+    parser.add_argument("--sfreq", type=float, default=1000.0, help="File sampling rate in Hz (default 1000)")
+    parser.add_argument("--runs", type=int, default=8, help="Number of runs, 1-8 (default 8)")
+    parser.add_argument("--win-sec", type=float, default=2.0)
+    parser.add_argument("--overlap", type=float, default=50)
+    parser.add_argument("--spectral-mode", default="exact", choices=SPECTRAL_MODES)
+    parser.add_argument("--window-jobs", type=int, default=1, help="n_jobs of the window analysis (default 1)")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per stage; the best is kept")
+    parser.add_argument("--reference-windows", type=int, default=50,
+                        help="Windows checked against the original loop (0 = skip)")
+    parser.add_argument("--dataset", default=None,
+                        help="ds005620 root: also check sub-1022 against kq_timeseries_hybrid_1022.csv")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON-lines history file")
+    parser.add_argument("--no-record", action="store_true", help="Do not append this run to the history")
+    parser.add_argument("--time-tolerance", type=float, default=DEFAULT_TIME_TOLERANCE)
+    parser.add_argument("--memory-tolerance", type=float, default=DEFAULT_MEMORY_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    config = {"channels": args.channels, "run_sec": args.run_sec, "sfreq": args.sfreq, "runs": args.runs,
+              "win_sec": args.win_sec, "overlap_perc": args.overlap, "spectral_mode": args.spectral_mode,
+              "window_jobs": args.window_jobs}
+    failures = []
+
+    with tempfile.TemporaryDirectory(prefix="kqeeg-bench-") as tmp:
+        print(f"Writing synthetic subject: {config}")
+        dataset_path = make_dataset(os.path.join(tmp, "ds"), SUBJECT_ID, args.channels, args.run_sec,
+                                    args.sfreq, args.runs)
+        stages, ctx = run_stages(dataset_path, config, args.repeat, os.path.join(tmp, "out"))
+        failures += ctx["heavy_imports"]
+
+        deviation = {}
+        if args.reference_windows:
+            print("--- reference check ---")
+            data, sfreq = ctx["loaded"][:2]
+            win_samples = int(args.win_sec * sfreq)
+            deviation = compare_to_reference(data, sfreq, ctx["results"], win_samples,
+                                             int(win_samples * (1 - args.overlap / 100)), args.reference_windows)
+            bad = [name for name, dev in deviation.items()
+                   if not dev <= reference_tolerance(name, args.spectral_mode)]
+            failures += [f"reference mismatch in {name}: {deviation[name]:.3e}" for name in bad]
+
+    if args.dataset:
+        from .check_1022 import check_1022
+        print("--- sub-1022 check ---")
+        _, bad = check_1022(args.dataset, spectral_mode=args.spectral_mode)
+        failures += [f"sub-1022 mismatch in {name}" for name in bad]
+
+    entry = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "machine": {"python": platform.python_version(), "numpy": np.__version__, "cpu_count": os.cpu_count(),
+                    "platform": platform.platform()},
+        "config": config,
+        "n_windows": ctx["n_windows"],
+        "stages": stages,
+        "max_rss_mb": max_rss_bytes() / 2**20,
+        "reference_deviation": deviation,
+    }
+
+    # --- Report ---
+    print(f"\n{'stage':16s} {'time (s)':>10s} {'peak (MB)':>10s} {'windows/s':>10s}")
+    for name, s in stages.items():
+        rate = f"{s['windows_per_sec']:10.0f}" if "windows_per_sec" in s else ""
+        print(f"{name:16s} {s['sec']:10.3f} {s['peak_mb']:10.1f} {rate}")
+    print(f"{ctx['n_windows']} windows, max RSS {entry['max_rss_mb']:.0f} MB")
+    if deviation:
+        worst = max(deviation, key=deviation.get)
+        print(f"Reference check: max relative deviation {deviation[worst]:.2e} ({worst})")
+
+    baseline = find_baseline(args.history, config)
+    if baseline is not None:
+        print(f"Compared with {baseline['timestamp']} ({baseline.get('commit')})")
+        failures += regressions(stages, baseline, args.time_tolerance, args.memory_tolerance)
+
+    if not args.no_record:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    if failures:
+        print("\nREGRESSIONS:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# =============================================================================
+# Import (startup) time of the library API
+#
+# Pool workers and scripts that only need the KQ math used to import MNE,
+# matplotlib, tqdm and scipy.signal with the package. Every target below is
+# imported in a fresh interpreter; the report gives the best import time
+# over --repeat processes, the process' peak RSS and the heavy modules
+# (HEAVY_MODULES) the import pulled in, which must be none: those belong to
+# reading BrainVision files, plotting, the GUI and progress bars and are
+# imported when used. The exit status is 1 otherwise.
+#
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --repeat 5
+#
+# benchmarks.run records the same measurements as its startup_* stages;
+# tests/test_startup.py asserts them (no heavy modules, time budgets).
+# =============================================================================
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What a short-lived worker imports, by increasing scope
+IMPORT_TARGETS = {
+    "package": "import kqeeg",
+    "kernel": "from kqeeg import iter_window_metrics, naive_coherence, BandpassFilter, synchronize_events, "
+              "DerivedMetrics",
+    "online": "import kqeeg.online",
+    "pipeline": "import kqeeg.pipeline",
+}
+
+# Must not be imported by any target
+HEAVY_MODULES = ("mne", "matplotlib", "tkinter", "tqdm", "scipy.signal")
+
+_PROBE = """
+import json, resource, sys, time
+t0 = time.perf_counter()
+exec({statement!r})
+sec = time.perf_counter() - t0
+try:  # ru_maxrss survives exec(), i.e. would include the parent process
+    with open("/proc/self/status") as f:
+        rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+except OSError:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+print(json.dumps({{"sec": sec, "rss": rss,
+                   "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(statement, repeat=3, modules=HEAVY_MODULES):
+    """
+    Imports `statement` in `repeat` fresh interpreters.
+
+    Args:
+        modules (tuple): Modules reported when the import pulled them in.
+
+    Returns:
+        dict: "sec" (best import time), "peak_mb" (peak RSS of that process)
+        and "heavy" (the `modules` that were imported).
+    """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", _PROBE.format(statement=statement, heavy=tuple(modules))],
+                             cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        if best is None or result["sec"] < best["sec"]:
+            best = result
+    return {"sec": best["sec"], "peak_mb": best["rss"] / 2**20, "heavy": best["heavy"]}
+
+
+def measure_startup(repeat=3):
+    """measure_import of every IMPORT_TARGETS entry, by target name."""
+    return {name: measure_import(statement, repeat) for name, statement in IMPORT_TARGETS.items()}
+
+
+def heavy_imports(results):
+    """Human-readable list of targets that imported HEAVY_MODULES."""
+    return [f"{name} imports {', '.join(r['heavy'])}" for name, r in results.items() if r["heavy"]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import time of the kqeeg library API.")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per target; the best is kept")
+    args = parser.parse_args(argv)
+
+    results = measure_startup(args.repeat)
+    print(f"{'target':10s} {'import (s)':>10s} {'RSS (MB)':>10s}  heavy modules")
+    for name, r in results.items():
+        print(f"{name:10s} {r['sec']:10.3f} {r['peak_mb']:10.1f}  {', '.join(r['heavy']) or '-'}")
+    failures = heavy_imports(results)
+    if failures:
+        print("\nHEAVY IMPORTS:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
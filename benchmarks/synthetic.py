@@ -0,0 +1,160 @@
+# =============================================================================
+# Synthetic multi-channel EEG for benchmarks and regression checks
+#
+# Generates recordings with the structure of ds005620 (the eight runs of
+# kqeeg.stream.run_order, events .tsv files for the sedation runs) and
+# writes them as BrainVision .vhdr/.vmrk/.eeg triplets, so the whole
+# pipeline (MNE reader, resampling, filtering, analysis, outputs) can be
+# exercised at any size without the real dataset.
+#
+# The signal is a mix of a few shared latent sources (alpha and delta
+# rhythms whose strength depends on the phase, plus 1/f-like background)
+# projected onto the channels, plus independent sensor noise: the channels
+# are partially coherent and the spectrum changes between phases, so KQ, C
+# and H_norm are non-trivial. Samples are generated and written in chunks;
+# memory does not grow with the duration.
+# =============================================================================
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from kqeeg.stream import run_order
+
+# Relative (alpha, delta) source amplitude per phase
+PHASE_PROFILE = {
+    "awake_EC": (1.0, 0.2),
+    "awake_EO": (0.4, 0.2),
+    "sed_run1": (0.3, 0.8),
+    "sed_run2": (0.2, 1.0),
+    "sed_run3": (0.2, 1.0),
+    "pre_run1": (0.6, 0.5),
+    "pre_run2": (0.6, 0.5),
+    "pre_run3": (0.6, 0.5),
+}
+
+EVENT_TYPES = ("induction", "awakening", "dream report", "no dream report")
+
+# Samples generated per chunk
+CHUNK_SAMPLES = 2**16
+
+# Signal scale in volts (typical scalp EEG amplitude)
+AMPLITUDE_V = 20e-6
+
+
+def synthetic_blocks(n_channels, n_samples, sfreq, phase="awake_EC", n_sources=4, seed=0):
+    """
+    Yields one synthetic run as consecutive (channels, n) float64 blocks in volts.
+
+    Args:
+        n_channels (int): Number of channels.
+        n_samples (int): Length of the run in samples.
+        sfreq (float): Sampling rate in Hz.
+        phase (str): Key of PHASE_PROFILE (sets the alpha/delta balance).
+        n_sources (int): Number of shared latent sources.
+        seed (int): Random seed (the same seed gives the same samples).
+    """
+    rng = np.random.default_rng(seed)
+    alpha, delta = PHASE_PROFILE.get(phase, (0.5, 0.5))
+    mixing = rng.standard_normal((n_channels, n_sources)) / np.sqrt(n_sources)
+    alpha_hz = rng.uniform(9.0, 11.0, n_sources)
+    delta_hz = rng.uniform(1.0, 3.0, n_sources)
+    phases = rng.uniform(0, 2 * np.pi, (2, n_sources))
+    # AR(1) background (1/f-like below a few Hz), state carried across chunks
+    ar_a = [1.0, -0.98]
+    zi = np.zeros((n_sources, 1))
+
+    for s0 in range(0, n_samples, CHUNK_SAMPLES):
+        n = min(CHUNK_SAMPLES, n_samples - s0)
+        t = (s0 + np.arange(n)) / sfreq
+        rhythms = (alpha * np.sin(2 * np.pi * alpha_hz[:, None] * t + phases[0][:, None])
+                   + delta * np.sin(2 * np.pi * delta_hz[:, None] * t + phases[1][:, None]))
+        background, zi = lfilter([0.1], ar_a, rng.standard_normal((n_sources, n)), axis=1, zi=zi)
+        sources = rhythms + background
+        yield AMPLITUDE_V * (mixing @ sources + 0.5 * rng.standard_normal((n_channels, n)))
+
+
+def synthetic_eeg(n_channels, n_samples, sfreq, phase="awake_EC", n_sources=4, seed=0):
+    """One synthetic run as a single (channels, samples) array (see synthetic_blocks)."""
+    if n_samples == 0:
+        return np.empty((n_channels, 0))
+    return np.concatenate(list(synthetic_blocks(n_channels, n_samples, sfreq, phase, n_sources, seed)),
+                          axis=1)
+
+
+def write_brainvision(vhdr_path, blocks, n_channels, sfreq, ch_names=None):
+    """
+    Writes (channels, n) blocks in volts as a BrainVision triplet
+    (multiplexed IEEE float32 in µV, one 'New Segment' marker).
+
+    Args:
+        vhdr_path (str): Path of the .vhdr header; .eeg/.vmrk go next to it.
+        blocks (iterable): Consecutive (channels, n) sample blocks.
+        n_channels (int): Number of channels.
+        sfreq (float): Sampling rate in Hz.
+        ch_names (list): Channel names (default E1..En).
+    """
+    ch_names = ch_names or [f"E{k + 1}" for k in range(n_channels)]
+    base = os.path.splitext(os.path.basename(vhdr_path))[0]
+    root = os.path.dirname(vhdr_path)
+
+    with open(os.path.join(root, base + ".eeg"), "wb") as f:
+        for block in blocks:
+            f.write(np.ascontiguousarray((block * 1e6).T, dtype="<f4").tobytes())
+
+    with open(vhdr_path, "w", encoding="utf-8") as f:
+        f.write("Brain Vision Data Exchange Header File Version 1.0\n"
+                "; Synthetic EEG written by benchmarks/synthetic.py\n\n"
+                "[Common Infos]\nCodepage=UTF-8\n"
+                f"DataFile={base}.eeg\nMarkerFile={base}.vmrk\n"
+                "DataFormat=BINARY\nDataOrientation=MULTIPLEXED\n"
+                f"NumberOfChannels={n_channels}\nSamplingInterval={1e6 / sfreq:g}\n\n"
+                "[Binary Infos]\nBinaryFormat=IEEE_FLOAT_32\n\n"
+                "[Channel Infos]\n")
+        for k, name in enumerate(ch_names):
+            f.write(f"Ch{k + 1}={name},,1,µV\n")
+
+    with open(os.path.join(root, base + ".vmrk"), "w", encoding="utf-8") as f:
+        f.write("Brain Vision Data Exchange Marker File Version 1.0\n\n"
+                "[Common Infos]\nCodepage=UTF-8\n"
+                f"DataFile={base}.eeg\n\n"
+                "[Marker Infos]\nMk1=New Segment,,1,1,0\n")
+
+
+def make_dataset(root, subject_id="9001", n_channels=32, run_sec=60.0, sfreq=1000.0, n_runs=8,
+                 events_per_run=3, seed=0):
+    """
+    Writes a synthetic subject in the ds005620 layout:
+    <root>/sub-<id>/eeg/<run>.vhdr/.vmrk/.eeg plus events .tsv files.
+
+    Args:
+        root (str): Dataset root (created if needed).
+        subject_id (str): Subject identifier.
+        n_channels (int): Channels per run.
+        run_sec (float): Duration of every run in seconds.
+        sfreq (float): Sampling rate of the files (resampled to 500 Hz on load).
+        n_runs (int): Number of runs, taken in kqeeg.stream.run_order (1-8).
+        events_per_run (int): Events written per sedation run.
+        seed (int): Random seed.
+
+    Returns:
+        str: `root`, to pass as dataset_path.
+    """
+    eeg_path = os.path.join(root, f"sub-{subject_id}", "eeg")
+    os.makedirs(eeg_path, exist_ok=True)
+    n_samples = int(run_sec * sfreq)
+    rng = np.random.default_rng(seed)
+
+    for k, (phase, fname) in enumerate(run_order(subject_id)[:n_runs]):
+        blocks = synthetic_blocks(n_channels, n_samples, sfreq, phase, seed=seed * 100 + k)
+        write_brainvision(os.path.join(eeg_path, fname), blocks, n_channels, sfreq)
+        if phase.startswith(("sed", "pre")) and events_per_run:
+            onsets = np.sort(rng.uniform(0, run_sec, events_per_run)).round(3)
+            events = pd.DataFrame({"onset": onsets,
+                                   "duration": 0.0,
+                                   "trial_type": rng.choice(EVENT_TYPES, events_per_run)})
+            events.to_csv(os.path.join(eeg_path, fname.replace("_eeg.vhdr", "_events.tsv")),
+                          sep="\t", index=False)
+    return root
@@ -0,0 +1,90 @@
+"""
+kqeeg — reusable computation engine behind the KQ Anesthesia EEG analyzer.
+
+The GUI script (QKEEGAnalizerwithEVENTSComplete.py) stays the entry point;
+the numerical building blocks live here so they can be reused and tested
+independently of Tk and matplotlib.
+
+Library API (``import kqeeg``):
+
+    preprocessing     SubjectStream, BandpassFilter, load_full_cycle_and_events
+    events sync       load_events, synchronize_events, event_locked_analysis
+    window kernel     iter_window_metrics, iter_stream_window_metrics,
+                      naive_coherence, spectral_summary, window_starts, ...
+    derived metrics   DerivedMetrics, derived_columns, add_derived_metrics
+    pipeline / I/O    analyze_with_events, run_subject, read_results,
+                      SpectralCube, WindowCheckpoint
+
+Every name is imported from its submodule on first use, so ``import kqeeg``
+costs next to nothing and a worker that only needs the window kernel never
+loads MNE, matplotlib, Tk or tqdm. Those are imported by the functions that
+read BrainVision files, draw or report progress, when they are called.
+"""
+
+import importlib
+
+# Public name -> submodule defining it
+_API = {
+    # Preprocessing (MNE is imported when a recording is read)
+    "TARGET_SFREQ": "stream",
+    "FILTER_BAND_HZ": "stream",
+    "BandpassFilter": "stream",
+    "SubjectStream": "stream",
+    "run_order": "stream",
+    "load_full_cycle_and_events": "pipeline",
+    # Events
+    "load_events": "stream",
+    "synchronize_events": "stream",
+    "event_locked_analysis": "events",
+    # Spectral estimators
+    "COH_NPERSEG": "spectral",
+    "DEFAULT_COH_CHANNELS": "spectral",
+    "segment_fft": "spectral",
+    "welch_density_scale": "spectral",
+    "cross_spectral_matrix": "spectral",
+    "coherence_matrix": "spectral",
+    "mean_pair_coherence": "spectral",
+    "naive_coherence": "spectral",
+    "band_coherence": "spectral",
+    "SlidingSpectralAccumulator": "accumulator",
+    "window_moments": "accumulator",
+    # Per-window KQ / C / H kernel
+    "BANDS": "metrics",
+    "METRIC_COLUMNS": "metrics",
+    "window_starts": "metrics",
+    "window_view": "metrics",
+    "spectral_summary": "metrics",
+    "iter_window_metrics": "metrics",
+    "iter_stream_window_metrics": "metrics",
+    # Derived metrics
+    "DERIVED_COLUMNS": "derived",
+    "DerivedMetrics": "derived",
+    "RollingVariance": "derived",
+    "derived_columns": "derived",
+    "derivative_dt": "derived",
+    "baseline_interval": "derived",
+    "add_derived_metrics": "pipeline",
+    # Pipeline and outputs
+    "analyze_with_events": "pipeline",
+    "write_outputs": "pipeline",
+    "run_subject": "pipeline",
+    "read_results": "results",
+    "write_results": "results",
+    "SpectralCube": "cube",
+    "WindowCheckpoint": "checkpoint",
+}
+
+__all__ = sorted(_API)
+
+
+def __getattr__(name):
+    module = _API.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_API))
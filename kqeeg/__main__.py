@@ -0,0 +1,7 @@
+"""Entry point for `python -m kqeeg` (headless batch runner, see kqeeg.batch)."""
+
+import sys
+
+from .batch import main
+
+sys.exit(main())
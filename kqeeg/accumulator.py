@@ -0,0 +1,329 @@
+# =============================================================================
+# Segment-grid spectral accumulator
+#
+# With overlapping analysis windows every sample is Welch-transformed once per
+# window it belongs to (twice at the default 50% overlap, ten times at 90%).
+# This module instead computes ONE short-time spectral decomposition of the
+# whole filtered recording on a fixed segment grid (nperseg=256, the segments
+# scipy.signal.coherence uses). Each grid segment is FFT'd once and its
+# auto/cross-spectral products enter a running sum per window length when a
+# window reaches it and leave it when the window moves past.
+#
+# Cost trade-off. A window's cross-spectral matrix, and so its coherence C,
+# costs the segments that entered/left since the previous window of the same
+# length (about one step) plus one pass over its frequency x pair matrix, not
+# the window length. The running sums are recomputed from scratch every
+# REFRESH_EVERY updates (and whenever a window moved by more than its own
+# length) so add/subtract round-off cannot drift; that refresh costs the whole
+# window once. With psd=True every channel is transformed (not only the
+# coherence channels) and each segment's channel-mean power joins the same
+# running sums, so a window's PSD is the Welch average of its grid segments,
+# again at a cost per window that follows the step, not the window length.
+#
+# The price is resolution: that PSD has 256-sample bins (about 2 Hz at
+# 500 Hz) and the +-2 bin leakage of the Hann taper, where exact mode uses
+# one window-long periodogram. Band powers (rescaled by kqeeg.metrics to the
+# periodogram's bin width), relative powers and H_norm are therefore a
+# smoother estimate that can differ from exact mode by tens of percent, and
+# by a multiple in a narrow band next to a strong rhythm (theta beside the
+# alpha peak); benchmarks.reference records the bounds. Runs that need the
+# exact-mode PSD columns use spectral_mode="accumulator_window_psd": grid C,
+# plus the window-long periodogram, whose cost grows with the window again.
+# Measured per window (19 channels at 500 Hz, one core): 1.1 ms either way
+# at 2 s / 50%; 1.3 vs 2.8 ms at 10 s / 90%; 3.0 vs 8.3 ms at 30 s / 90%
+# (exact mode: 2.3, 6.7 and 18 ms).
+#
+# The grid hop is aligned_hop(): a divisor of the window step, so that every
+# window's segments start at its first sample as in the exact path, chosen
+# to give the same number of segments per window as the exact hop of
+# nperseg // 2 (the bias of a coherence estimate depends on that number).
+# When the step is a multiple of 128 the segments are the exact ones and C
+# agrees with exact mode to round-off; otherwise the segments overlap
+# slightly differently (e.g. hop 125 for a 500-sample step) and C moves by
+# the estimate's own segment-placement noise: a few percent on average, up
+# to ~20% of its scale in single windows with few segments and channels
+# (benchmarks.reference bounds it; python -m benchmarks.run checks it).
+# Only a step without such a divisor falls back to the 128 grid, where a
+# window may use one segment less. Windows shorter than one segment have no
+# place on the grid; kqeeg.metrics computes them on the exact path.
+#
+# A float32 recording is transformed in complex64; the running sums are
+# kept in float64 / complex128 so adding and removing segments stays exact
+# enough between refreshes.
+# =============================================================================
+
+import math
+import warnings
+
+import numpy as np
+from scipy import fft as sp_fft
+
+from .spectral import COH_NPERSEG, DEFAULT_COH_CHANNELS, segment_fft, welch_density_scale
+
+# Working-set budget for one block of buffered segment FFTs
+DEFAULT_BLOCK_BYTES = 64 * 2**20
+
+# Incremental updates of a running sum before it is recomputed from scratch
+REFRESH_EVERY = 256
+
+
+def _n_segments(length, nperseg, hop):
+    """Segments of `nperseg` samples, `hop` apart, from the first sample of a window."""
+    return max(0, (length - nperseg) // hop + 1)
+
+
+def aligned_hop(steps, lengths, nperseg=COH_NPERSEG):
+    """
+    Grid hop for windows of the given lengths starting at multiples of `steps`.
+
+    Prefers a divisor of every step (each window's segments then start at
+    its first sample) between nperseg // 4 and nperseg that gives every
+    window length the segment count of the exact hop (nperseg // 2), then
+    the divisor closest to that hop. Without any such divisor the exact hop
+    is returned.
+    """
+    default = nperseg - nperseg // 2
+    step = math.gcd(*[int(s) for s in steps])
+    candidates = [d for d in range(max(1, nperseg // 4), nperseg + 1) if step % d == 0]
+    if not candidates:
+        return default
+    lengths = np.unique(np.asarray(lengths, dtype=np.int64)).tolist()
+
+    def mismatch(hop):
+        return (sum(abs(_n_segments(L, nperseg, hop) - _n_segments(L, nperseg, default)) for L in lengths),
+                abs(hop - default))
+
+    return min(candidates, key=mismatch)
+
+
+class SlidingSpectralAccumulator:
+    """
+    Short-time spectral decomposition of a whole recording, shared by all windows.
+
+    Segment k covers samples [k * hop, k * hop + nperseg). A window
+    [start, stop) uses every segment fully contained in it.
+
+    Args:
+        data (np.ndarray): Filtered signal (channels, samples).
+        sfreq (float): Sampling rate in Hz.
+        nperseg (int): Segment length (default 256, as in scipy.signal.coherence).
+        coh_channels (int or None): Leading channels used for the naive C.
+            None uses all channels.
+        window (str): Segment taper.
+        block_bytes (int): Approximate memory budget for one block of
+            buffered segment FFTs.
+        hop (int): Grid hop (see aligned_hop); defaults to nperseg // 2.
+        psd (bool): Also keep running sums of every segment's channel-mean
+            power, so iter_windows yields each window's Welch PSD on the
+            grid (all channels are then transformed, not only the
+            coherence channels).
+    """
+
+    def __init__(self, data, sfreq, nperseg=COH_NPERSEG, coh_channels=DEFAULT_COH_CHANNELS,
+                 window='hann', block_bytes=DEFAULT_BLOCK_BYTES, hop=None, psd=False):
+        self.data = data
+        self.sfreq = float(sfreq)
+        self.nperseg = int(min(nperseg, data.shape[1]))
+        self.hop = self.nperseg - self.nperseg // 2 if hop is None else min(int(hop), self.nperseg)
+        self.window = window
+        self.psd = psd
+        n_channels = data.shape[0]
+        self.coh_channels = n_channels if coh_channels is None else min(coh_channels, n_channels)
+        self.n_segments = max(0, (data.shape[1] - self.nperseg) // self.hop + 1)
+        self.n_freqs = self.nperseg // 2 + 1
+        self.freqs = sp_fft.rfftfreq(self.nperseg, 1.0 / self.sfreq)
+        self._fft_dtype = np.result_type(data.dtype, np.complex64)
+
+        self._iu, self._ju = np.triu_indices(self.coh_channels, k=1)
+        # With psd=True every channel is transformed (only the coherence
+        # channels' FFTs are buffered, plus two power vectors per segment)
+        fft_channels = n_channels if psd else self.coh_channels
+        bytes_per_segment = self.n_freqs * fft_channels * self._fft_dtype.itemsize
+        self.block_segments = max(1, int(block_bytes // bytes_per_segment))
+
+    def segment_range(self, starts, stops):
+        """
+        Maps sample ranges [start, stop) to the grid segments they contain.
+
+        Returns:
+            tuple: (lo, hi) arrays; a window uses segments lo <= k < hi.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        lo = -(-starts // self.hop)
+        hi = np.minimum((stops - self.nperseg) // self.hop + 1, self.n_segments)
+        return lo, np.maximum(hi, lo)
+
+    def _transform(self, seg0, seg1):
+        """
+        Segment FFTs of the coherence channels (seg, c, f) for grid segments
+        [seg0, seg1) and, with psd=True, the channel mean / nanmean of every
+        segment's power (seg, 2, f) in float64 (else None).
+        """
+        s0 = seg0 * self.hop
+        s1 = (seg1 - 1) * self.hop + self.nperseg
+        channels = slice(None) if self.psd else slice(0, self.coh_channels)
+        X = segment_fft(self.data[channels, s0:s1], nperseg=self.nperseg, noverlap=self.nperseg - self.hop,
+                        window=self.window)                # (channels, seg, f)
+        P = None
+        if self.psd:
+            power = X.real ** 2 + X.imag ** 2
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN segments
+                P = np.stack([power.mean(axis=0, dtype=np.float64),
+                              np.nanmean(power, axis=0, dtype=np.float64)], axis=1)
+        return np.moveaxis(X[:self.coh_channels], 1, 0), P
+
+    def _range_sums(self, X, P, a, b):
+        """
+        Auto-spectra (c, f) and cross-spectral matrix (f, c, c) of the
+        coherence channels summed over buffered segments [a, b), in float64,
+        and the summed channel-mean powers (2, f) (None without psd).
+        """
+        seg = X[a:b]                                        # (seg, c, f)
+        auto = np.einsum('sif,sif->if', seg.real, seg.real) + np.einsum('sif,sif->if', seg.imag, seg.imag)
+        Xf = np.moveaxis(seg, 0, -1)                        # (c, f, seg)
+        Xf = np.swapaxes(Xf, 0, 1)                          # (f, c, seg)
+        cross = Xf.conj() @ np.swapaxes(Xf, 1, 2)
+        power = None if P is None else P[a:b].sum(axis=0)
+        return auto.astype(np.float64, copy=False), cross.astype(np.complex128, copy=False), power
+
+    def iter_windows(self, starts, stops):
+        """
+        Computes the naive coherence C (and, with psd=True, the grid PSD) of
+        every window [start, stop).
+
+        Windows may have different lengths (e.g. several window settings at
+        once). Each grid segment is transformed exactly once regardless, and
+        each distinct window length keeps its own running sum.
+
+        Yields:
+            tuple: (index, C, psd_mean, psd_nanmean) for a block of windows,
+            where `index` holds positions into `starts`, `C` the naive mean
+            pairwise coherence (n,) and the PSDs the channel mean / nanmean
+            of the Welch density PSD over the window's segments (n, n_freqs)
+            on `freqs` (None without psd). Windows that contain no full
+            segment get NaN.
+        """
+        lengths = np.asarray(stops, dtype=np.int64) - np.asarray(starts, dtype=np.int64)
+        lo, hi = self.segment_range(starts, stops)
+        order = np.argsort(hi, kind='stable')
+        hi_sorted = hi[order]
+        scale = welch_density_scale(self.nperseg, self.sfreq, self.window) if self.psd else None
+
+        X_buf = np.empty((0, self.coh_channels, self.n_freqs), dtype=self._fft_dtype)  # buffered segment FFTs
+        P_buf = np.empty((0, 2, self.n_freqs)) if self.psd else None                   # buffered segment powers
+        # Start at the first segment any window needs (a window range may
+        # begin mid-recording)
+        buf_start = int(lo.min()) if len(lo) else 0   # grid index of the first buffered segment
+        tracks = {}         # window length -> [lo, hi, auto_sum, cross_sum, n_updates, power_sum]
+        seg_done = buf_start
+        w0 = 0
+        while w0 < len(order):
+            # Transform the next block of grid segments
+            seg_end = min(seg_done + self.block_segments, self.n_segments)
+            if seg_end > seg_done:
+                X, P = self._transform(seg_done, seg_end)
+                X_buf = np.concatenate([X_buf, X])
+                if self.psd:
+                    P_buf = np.concatenate([P_buf, P])
+                seg_done = seg_end
+
+            # All windows whose last segment is now available
+            w1 = np.searchsorted(hi_sorted, seg_done, side='right')
+            if w1 > w0:
+                idx = order[w0:w1]
+                C = np.empty(len(idx))
+                psd = np.full((len(idx), 2, self.n_freqs), np.nan) if self.psd else None
+                for k, w in enumerate(idx):
+                    wl, wh = lo[w], hi[w]
+                    if wh <= wl:
+                        C[k] = np.nan
+                        continue
+                    state = tracks.get(lengths[w])
+                    if (state is None or wl < state[0] or wh < state[1] or state[4] >= REFRESH_EVERY
+                            or (wl - state[0]) + (wh - state[1]) >= wh - wl):
+                        auto, cross, power = self._range_sums(X_buf, P_buf, wl - buf_start, wh - buf_start)
+                        state = [wl, wh, auto, cross, 0, power]
+                        tracks[lengths[w]] = state
+                    else:
+                        # Slide: add the segments that entered, remove those that left
+                        if wh > state[1]:
+                            a_in, c_in, p_in = self._range_sums(X_buf, P_buf, state[1] - buf_start, wh - buf_start)
+                            state[2] = state[2] + a_in
+                            state[3] = state[3] + c_in
+                            if self.psd:
+                                state[5] = state[5] + p_in
+                        if wl > state[0]:
+                            a_out, c_out, p_out = self._range_sums(X_buf, P_buf, state[0] - buf_start,
+                                                                   wl - buf_start)
+                            state[2] = state[2] - a_out
+                            state[3] = state[3] - c_out
+                            if self.psd:
+                                state[5] = state[5] - p_out
+                        state[0], state[1] = wl, wh
+                        state[4] += 1
+                    auto, cross = state[2], state[3]
+                    if self.psd:
+                        psd[k] = state[5] * (scale / (wh - wl))
+
+                    # Segment counts cancel in |Sxy|^2 / (Sxx * Syy)
+                    if len(self._iu):
+                        Sxy = cross[:, self._iu, self._ju]
+                        with np.errstate(divide='ignore', invalid='ignore'):
+                            coh = (Sxy.real ** 2 + Sxy.imag ** 2) / (auto[self._iu].T * auto[self._ju].T)
+                        C[k] = coh.mean(axis=0).mean()
+                    else:
+                        C[k] = 0.0
+                if self.psd:
+                    yield idx, C, psd[:, 0], psd[:, 1]
+                else:
+                    yield idx, C, None, None
+                w0 = w1
+
+            # Drop segments no pending window or running sum can reach
+            if w0 < len(order):
+                pending = order[w0:]
+                pending_lengths = set(np.unique(lengths[pending]).tolist())
+                tracks = {L: st for L, st in tracks.items() if L in pending_lengths}
+                keep_from = min([int(lo[pending].min())] + [st[0] for st in tracks.values()])
+                if keep_from > buf_start:
+                    X_buf = X_buf[keep_from - buf_start:]
+                    if self.psd:
+                        P_buf = P_buf[keep_from - buf_start:]
+                    buf_start = keep_from
+
+
+def window_moments(data, starts, stops):
+    """
+    Time-domain TS metrics (GFP, mean amplitude, variance) for many windows
+    via prefix sums, so each window costs O(1) instead of O(window length).
+
+    Matches `np.std(win, axis=0).mean()`, `np.mean(win)` and `np.var(win)`
+    of the per-window loop.
+
+    Returns:
+        tuple: (gfp, mean_amplitude, variance) arrays.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    n_channels = data.shape[0]
+
+    # Only the span covered by the windows is summed
+    s0 = int(starts.min()) if len(starts) else 0
+    s1 = int(stops.max()) if len(stops) else 0
+    data = data[:, s0:s1]
+    starts, stops = starts - s0, stops - s0
+
+    def prefix(v):
+        return np.concatenate([[0.0], np.cumsum(v, dtype=np.float64)])
+
+    gfp_cs = prefix(np.std(data, axis=0, dtype=np.float64))
+    sum_cs = prefix(data.sum(axis=0, dtype=np.float64))
+    sq_cs = prefix(np.einsum('ij,ij->j', data, data, dtype=np.float64))
+
+    n = (stops - starts).astype(float)
+    gfp = (gfp_cs[stops] - gfp_cs[starts]) / n
+    mean_amp = (sum_cs[stops] - sum_cs[starts]) / (n * n_channels)
+    variance = (sq_cs[stops] - sq_cs[starts]) / (n * n_channels) - mean_amp ** 2
+    return gfp, mean_amp, variance
@@ -0,0 +1,201 @@
+# =============================================================================
+# Background subject runs for the GUI
+#
+# KQApp.start_analysis used to run load -> analyze -> save on the Tk main
+# thread, refreshing the window only between stages: the GUI froze for the
+# whole run, a mistaken subject could not be stopped and only one subject
+# could run at a time.
+#
+# BackgroundRunner queues subjects into a pool of worker processes (several
+# subjects run concurrently, the rest wait). Every worker runs
+# pipeline.run_subject under a kqeeg.progress.ProgressReporter that sends
+# stage changes, windows done / ETA and the finished KQ/C/H blocks through
+# one shared queue. The GUI drains it with poll() from a Tk timer, so the
+# main thread only ever renders.
+#
+# Cancelling a queued subject removes it from the queue; a running one sees
+# its cancel event at the next block (kqeeg.progress.check_cancelled) and
+# stops. Its folder keeps the checkpoint (kqeeg.checkpoint), so queuing the
+# subject again resumes from the windows saved so far.
+#
+# Workers run at a lower scheduling priority (WORKER_NICENESS) so the GUI
+# process keeps getting the CPU when every core is busy with analysis.
+# =============================================================================
+
+import itertools
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# Subjects analyzed at the same time by default
+DEFAULT_CONCURRENT_SUBJECTS = max(1, min(2, os.cpu_count() or 1))
+
+# Priority decrease of the worker processes (POSIX nice), keeps the GUI responsive
+WORKER_NICENESS = 10
+
+# Job states
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Job ids are unique within the process, across runners
+_job_ids = itertools.count()
+
+
+def _run_job(job_id, messages, cancel_event, dataset_path, subject_id, out_dir, kwargs):
+    """Worker process: one subject, reporting into `messages` as (job_id, message)."""
+    import warnings
+    warnings.filterwarnings("ignore")  # same console behaviour as the GUI (MNE warnings)
+    if hasattr(os, "nice"):
+        os.nice(WORKER_NICENESS)
+
+    from .pipeline import run_subject
+    from .progress import Cancelled, ProgressReporter
+
+    def send(message):
+        messages.put((job_id, message))
+
+    send({"kind": "started", "pid": os.getpid()})
+    t0 = time.perf_counter()
+    try:
+        with ProgressReporter(send, cancel_event):
+            run_subject(dataset_path, subject_id, out_dir=out_dir, live_plot=False, **kwargs)
+        send({"kind": DONE, "out_dir": out_dir, "elapsed_sec": time.perf_counter() - t0})
+    except Cancelled:
+        send({"kind": CANCELLED, "elapsed_sec": time.perf_counter() - t0})
+    except Exception as e:
+        send({"kind": FAILED, "error": f"{type(e).__name__}: {e}", "error_type": type(e).__name__,
+              "traceback": traceback.format_exc(), "elapsed_sec": time.perf_counter() - t0})
+
+
+class AnalysisJob:
+    """
+    State of one queued subject, as last reported by its worker.
+
+    Attributes:
+        job_id (int), subject_id (str), out_dir (str)
+        status (str): queued, running, done, failed or cancelled.
+        stage (str): Current stage (load, window, output).
+        done, total (int): Progress within the stage, in `unit`s
+            (samples while loading, windows while analyzing).
+        eta_sec (float): Estimated time left in the stage (None if unknown).
+        error (str): Error message of a failed run.
+    """
+
+    def __init__(self, job_id, subject_id, out_dir):
+        self.job_id = job_id
+        self.subject_id = subject_id
+        self.out_dir = out_dir
+        self.status = QUEUED
+        self.stage = None
+        self.done = self.total = 0
+        self.unit = None
+        self.eta_sec = None
+        self.elapsed_sec = None
+        self.error = self.error_type = None
+        self.future = None
+        self.cancel_event = None
+
+    @property
+    def fraction(self):
+        """Progress of the current stage in [0, 1] (0 when unknown)."""
+        return self.done / self.total if self.total else 0.0
+
+    def _apply(self, message):
+        kind = message["kind"]
+        if kind == "started":
+            self.status = RUNNING
+        elif kind == "stage":
+            self.stage, self.done, self.total, self.unit, self.eta_sec = message["stage"], 0, 0, None, None
+        elif kind == "progress" and message["done"] is not None:
+            self.done, self.total = message["done"], message["total"]
+            self.unit, self.eta_sec = message["unit"], message["eta_sec"]
+        elif kind in FINISHED:
+            self.status = kind
+            self.elapsed_sec = message.get("elapsed_sec")
+            self.error, self.error_type = message.get("error"), message.get("error_type")
+            self.eta_sec = None
+
+
+class BackgroundRunner:
+    """
+    Pool of worker processes analyzing queued subjects.
+
+    Args:
+        max_workers (int): Subjects analyzed concurrently.
+        **defaults: run_subject keyword arguments used for every job
+            (e.g. cache_dir, n_jobs).
+    """
+
+    def __init__(self, max_workers=DEFAULT_CONCURRENT_SUBJECTS, **defaults):
+        self.max_workers = max(1, int(max_workers))
+        self.defaults = defaults
+        self.jobs = {}
+        ctx = multiprocessing.get_context("spawn")
+        self._manager = ctx.Manager()
+        self._messages = self._manager.Queue()
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+
+    def submit(self, dataset_path, subject_id, out_dir, **kwargs):
+        """Queues a subject; returns its AnalysisJob."""
+        job = AnalysisJob(next(_job_ids), subject_id, out_dir)
+        job.cancel_event = self._manager.Event()
+        job.future = self._pool.submit(_run_job, job.job_id, self._messages, job.cancel_event, dataset_path,
+                                       subject_id, out_dir, {**self.defaults, **kwargs})
+        self.jobs[job.job_id] = job
+        return job
+
+    def cancel(self, job_id):
+        """Cancels a queued or running job (running ones stop at the next block)."""
+        job = self.jobs[job_id]
+        if job.status in FINISHED:
+            return
+        if job.future.cancel():
+            job.status = CANCELLED
+        else:
+            job.cancel_event.set()
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def poll(self, max_messages=1000):
+        """
+        Applies the pending worker messages to the jobs (never blocks).
+
+        Returns:
+            list: (job, message) pairs in arrival order, for the caller to
+            render (e.g. message["block"] of "progress" messages).
+        """
+        updates = []
+        for _ in range(max_messages):
+            try:
+                job_id, message = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            job = self.jobs[job_id]
+            job._apply(message)
+            updates.append((job, message))
+        # Workers that died without reporting (e.g. killed, out of memory)
+        for job in self.jobs.values():
+            if job.status in (QUEUED, RUNNING) and job.future.done() and not job.future.cancelled():
+                error = job.future.exception()
+                if error is not None:
+                    job._apply({"kind": FAILED, "error": f"{type(error).__name__}: {error}",
+                                "error_type": type(error).__name__})
+                    updates.append((job, {"kind": FAILED}))
+        return updates
+
+    @property
+    def busy(self):
+        """True while any job is queued or running."""
+        return any(job.status not in FINISHED for job in self.jobs.values())
+
+    def shutdown(self, cancel=True):
+        """Stops the workers (cancelling every job first by default)."""
+        if cancel:
+            self.cancel_all()
+        self._pool.shutdown(wait=True, cancel_futures=cancel)
+        self._manager.shutdown()
@@ -0,0 +1,312 @@
+# =============================================================================
+# Headless cohort runner
+#
+# Runs the same load -> analyze -> save pipeline as KQApp.start_analysis for
+# many subjects, without Tk and without the live plot, one subject per
+# worker process:
+#
+#   python -m kqeeg /data/ds005620 --subjects all --jobs 32
+#   python -m kqeeg /data/ds005620 --subjects 1022 1024 --win-sec 4 --overlap 75
+#
+# Every subject gets its own folder (sub-<id>/) with the usual
+# kq_timeseries_hybrid table (Parquet by default, --format csv for text),
+# events_full_synchronized.tsv, run_metadata.json and plots/ PNG, under one
+# output folder (--out-dir, by default <dataset>/resultatKQEEG). Each run
+# adds its summary as runs/batch_summary_<timestamp>.json.
+#
+# Re-running into the same output folder is incremental: the dataset manifest
+# (kqeeg.manifest) records which inputs and parameters every subject's
+# outputs came from, and only new or changed subjects are analyzed again
+# (--force recomputes all of them).
+# =============================================================================
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+# Thread pools that would oversubscribe the CPU when every worker runs its
+# own BLAS/FFT threads
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def discover_subjects(dataset_path):
+    """
+    Lists the subject IDs of a BIDS dataset (folders 'sub-<id>' with an 'eeg' folder).
+
+    Returns:
+        list: Sorted subject IDs without the 'sub-' prefix.
+    """
+    subjects = []
+    for name in os.listdir(dataset_path):
+        if name.startswith("sub-") and os.path.isdir(os.path.join(dataset_path, name, "eeg")):
+            subjects.append(name[len("sub-"):])
+    return sorted(subjects)
+
+
+def _run_one(dataset_path, subject_id, out_dir, win_sec, overlap_perc, analysis_kwargs):
+    """Worker: runs one subject and reports the outcome instead of raising."""
+    import warnings
+    warnings.filterwarnings("ignore")  # same console behaviour as the GUI (MNE warnings)
+
+    from .pipeline import run_subject
+
+    t0 = time.perf_counter()
+    try:
+        run_subject(dataset_path, subject_id, out_dir=out_dir, win_sec=win_sec,
+                    overlap_perc=overlap_perc, live_plot=False, **analysis_kwargs)
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "failed", f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+    return {
+        "subject_id": subject_id,
+        "status": status,
+        "out_dir": out_dir,
+        "elapsed_sec": time.perf_counter() - t0,
+        "error": error,
+    }
+
+
+def run_batch(dataset_path, subjects="all", win_sec=2.0, overlap_perc=50, jobs=1, out_root=None, force=False,
+              **analysis_kwargs):
+    """
+    Processes many subjects, in parallel across `jobs` worker processes.
+
+    Args:
+        dataset_path (str): Root of the BIDS dataset (e.g. '.../ds005620').
+        subjects (str or list): "all" or a list of subject IDs.
+        win_sec (float): Window length in seconds.
+        overlap_perc (float): Window overlap in percent.
+        jobs (int): Number of worker processes (subjects run concurrently).
+        out_root (str): Output folder. Defaults to the stable
+            '<dataset_path>/resultatKQEEG', so re-runs are incremental.
+        force (bool): Recompute subjects whose outputs in `out_root` are up
+            to date (see kqeeg.manifest); by default they are skipped.
+        **analysis_kwargs: Passed on to analyze_with_events.
+
+    The event-locked epochs of all subjects are combined into
+    event_epochs_cohort and event_summary_cohort tables (kqeeg.events).
+
+    Returns:
+        list: One status dict per subject, with status "ok", "failed" or
+        "up_to_date" (also saved as runs/batch_summary_<timestamp>.json).
+    """
+    from .manifest import DatasetManifest, analysis_params, default_out_root
+
+    if subjects == "all" or subjects == ["all"]:
+        subjects = discover_subjects(dataset_path)
+    if not subjects:
+        raise FileNotFoundError(f"No subjects found in {dataset_path}")
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if out_root is None:
+        out_root = default_out_root(dataset_path)
+    os.makedirs(os.path.join(out_root, "runs"), exist_ok=True)
+
+    # Headless: never open GUI windows for the summary plots
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    # Index the inputs; subjects whose outputs match them and the parameters are kept
+    manifest = DatasetManifest(out_root, dataset_path)
+    manifest.scan(subjects)
+    params = analysis_params(win_sec, overlap_perc, analysis_kwargs)
+    summary = []
+    pending = []
+    for sid in subjects:
+        if not force and manifest.is_up_to_date(sid, params):
+            summary.append({"subject_id": sid, "status": "up_to_date", "out_dir": manifest.subject_dir(sid),
+                            "elapsed_sec": 0.0, "error": None})
+        else:
+            manifest.discard(sid)
+            pending.append(sid)
+    manifest.save()
+
+    def finished(result):
+        summary.append(result)
+        if result["status"] == "ok":
+            manifest.record(result["subject_id"], params, result["elapsed_sec"])
+            manifest.save()
+        _report(result)
+
+    jobs = max(1, min(jobs, len(pending)))
+    tasks = [(dataset_path, sid, manifest.subject_dir(sid), win_sec, overlap_perc, analysis_kwargs)
+             for sid in pending]
+
+    print(f"Processing {len(pending)} subject(s) with {jobs} worker(s) -> {out_root}"
+          + (f" ({len(subjects) - len(pending)} up to date)" if len(pending) < len(subjects) else ""))
+    if jobs == 1:
+        for task in tasks:
+            finished(_run_one(*task))
+    else:
+        # One subject per process: keep each worker's numeric libraries
+        # single-threaded. Spawned workers inherit this environment.
+        for var in THREAD_ENV_VARS:
+            os.environ.setdefault(var, "1")
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx) as pool:
+            futures = [pool.submit(_run_one, *task) for task in tasks]
+            for fut in as_completed(futures):
+                finished(fut.result())
+    summary.sort(key=lambda r: subjects.index(r["subject_id"]))
+
+    # Event-locked epochs of all subjects in one table (kqeeg.events)
+    from .events import cohort_event_tables
+    from .results import DEFAULT_RESULT_FORMATS, write_results
+    epochs, event_summary = cohort_event_tables({r["subject_id"]: r["out_dir"] for r in summary
+                                                 if r["status"] != "failed"})
+    if not epochs.empty:
+        formats = analysis_kwargs.get("formats", DEFAULT_RESULT_FORMATS)
+        write_results(epochs, os.path.join(out_root, "event_epochs_cohort"), formats)
+        write_results(event_summary, os.path.join(out_root, "event_summary_cohort"), formats)
+
+    # One summary per run (suffixed if another run finished in the same second)
+    summary_path = os.path.join(out_root, "runs", f"batch_summary_{timestamp}.json")
+    n = 1
+    while os.path.exists(summary_path):
+        n += 1
+        summary_path = os.path.join(out_root, "runs", f"batch_summary_{timestamp}_{n}.json")
+    with open(summary_path, "w") as f:
+        json.dump({
+            "dataset_path": dataset_path,
+            "analysis_timestamp": timestamp,
+            "window_length_sec": win_sec,
+            "window_overlap_perc": overlap_perc,
+            "jobs": jobs,
+            "analysis_params": params,
+            "subjects": summary,
+        }, f, indent=4)
+    return summary
+
+
+def _report(result):
+    if result["status"] == "ok":
+        print(f"[ok]     sub-{result['subject_id']} ({result['elapsed_sec']:.1f} s)")
+    elif result["status"] == "up_to_date":
+        print(f"[skip]   sub-{result['subject_id']} (up to date)")
+    else:
+        print(f"[FAILED] sub-{result['subject_id']}: {result['error'].splitlines()[0]}")
+
+
+def build_parser():
+    from .metrics import SPECTRAL_MODES
+    parser = argparse.ArgumentParser(
+        prog="python -m kqeeg",
+        description="Headless KQ/C/H_norm analysis for one or many subjects of a BIDS EEG dataset.")
+    parser.add_argument("dataset", help="Root folder of the dataset (e.g. .../ds005620)")
+    parser.add_argument("--subjects", nargs="+", default=["all"],
+                        help="Subject IDs (e.g. 1022 1024) or 'all' (default)")
+    parser.add_argument("--win-sec", type=float, default=2.0, help="Window length in seconds (default 2.0)")
+    parser.add_argument("--overlap", type=float, default=50, help="Window overlap in percent (default 50)")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Subjects processed in parallel (default 1; 0 = one per CPU core)")
+    parser.add_argument("--out-dir", default=None,
+                        help="Output folder (default: <dataset>/resultatKQEEG)")
+    parser.add_argument("--coh-channels", type=int, default=20,
+                        help="Channels used for the naive coherence C (default 20; 0 = all)")
+    parser.add_argument("--window-jobs", type=int, default=1,
+                        help="Worker processes per subject for the window computation (default 1; 0 = all cores)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Analyze each recording block by block while reading it (bounded memory)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache the preprocessed recordings here and reuse them on later runs")
+    parser.add_argument("--cache-max-gb", type=float, default=20,
+                        help="Size budget of the cache; least recently used entries are evicted (default 20)")
+    parser.add_argument("--format", nargs="+", choices=["parquet", "hdf5", "csv"], default=["parquet"],
+                        dest="formats", help="Result table format(s) (default parquet; add csv for text output)")
+    parser.add_argument("--float32", action="store_true",
+                        help="Store the metric columns as float32 (half the size)")
+    parser.add_argument("--compression", default=None,
+                        help="Codec for parquet/hdf5 (default zstd / gzip)")
+    parser.add_argument("--load-jobs", type=int, default=None,
+                        help="Runs of a subject loaded concurrently (default up to 4 with --jobs 1, else 1; "
+                             "always 1 with --stream)")
+    parser.add_argument("--resampler", choices=["fft", "polyphase"], default="fft",
+                        help="'fft' (MNE, default) or 'polyphase' (faster, integer-related rates)")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64",
+                        help="Computation precision: float32 halves the signal in memory and uses complex64 FFTs "
+                             "(see python -m benchmarks.precision for the deviation)")
+    parser.add_argument("--event-window", type=float, nargs=2, default=None, metavar=("PRE", "POST"),
+                        help="Seconds before/after each event for the event-locked analysis (default 30 30)")
+    parser.add_argument("--spectral-cube", nargs="?", const="gzip", choices=["gzip", "lzf", "none"], default=None,
+                        help="Also store the per-window PSD and band coherence matrices in spectral_cube.h5 "
+                             "(codec, default gzip; 'none' = uncompressed, memory-mappable)")
+    parser.add_argument("--checkpoint-sec", type=float, default=None,
+                        help="Save finished windows to <subject out dir>/.kq_checkpoint at most every N seconds "
+                             "(default 30; 0 = off); rerunning into the same --out-dir resumes from it")
+    parser.add_argument("--derivative", choices=["backward", "central"], default=None,
+                        help="Finite difference of dKQ_dt (default backward)")
+    parser.add_argument("--variance-window", type=int, default=None,
+                        help="Windows of the centered rolling KQ variance (default 5)")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute subjects whose outputs in --out-dir are already up to date")
+    parser.add_argument("--profile", action="store_true",
+                        help="Also write a cProfile dump (profile.prof) per subject")
+    parser.add_argument("--spectral-mode", choices=SPECTRAL_MODES, default=None,
+                        help="Per-window spectra: 'exact' (default), shared 'accumulator' or "
+                             "'accumulator_window_psd' (shared coherence, exact band powers and H_norm)")
+    parser.add_argument("--sweep-win-sec", type=float, nargs="+", default=None,
+                        help="Sweep these window lengths in one pass (e.g. 1 2 4 8)")
+    parser.add_argument("--sweep-overlap", type=float, nargs="+", default=None,
+                        help="Sweep these overlaps in one pass (e.g. 0 50 75)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    analysis_kwargs = {}
+    if args.spectral_mode:
+        analysis_kwargs["spectral_mode"] = args.spectral_mode
+    if args.event_window:
+        analysis_kwargs["event_window"] = tuple(args.event_window)
+    if args.spectral_cube:
+        analysis_kwargs["spectral_cube"] = args.spectral_cube
+    if args.checkpoint_sec is not None:
+        analysis_kwargs["checkpoint_sec"] = args.checkpoint_sec
+    if args.derivative:
+        analysis_kwargs["derivative"] = args.derivative
+    if args.variance_window:
+        analysis_kwargs["variance_window"] = args.variance_window
+    if args.sweep_win_sec or args.sweep_overlap:
+        from .sweep import sweep_settings
+        analysis_kwargs["sweep"] = sweep_settings(args.sweep_win_sec or [args.win_sec],
+                                                  args.sweep_overlap or [args.overlap])
+    if args.load_jobs is None:
+        from .stream import DEFAULT_LOAD_JOBS
+        args.load_jobs = DEFAULT_LOAD_JOBS if jobs == 1 else 1  # subjects already run in parallel
+    summary = run_batch(
+        args.dataset,
+        subjects=args.subjects,
+        win_sec=args.win_sec,
+        overlap_perc=args.overlap,
+        jobs=jobs,
+        out_root=args.out_dir,
+        force=args.force,
+        coh_channels=args.coh_channels or None,
+        n_jobs=args.window_jobs or None,
+        stream=args.stream,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=int(args.cache_max_gb * 2**30),
+        formats=args.formats,
+        float32=args.float32,
+        compression=args.compression,
+        profile=args.profile,
+        load_jobs=args.load_jobs,
+        resampler=args.resampler,
+        precision=args.precision,
+        **analysis_kwargs,
+    )
+    failed = [r for r in summary if r["status"] == "failed"]
+    skipped = [r for r in summary if r["status"] == "up_to_date"]
+    print(f"Done: {len(summary) - len(failed) - len(skipped)} succeeded, {len(skipped)} up to date, "
+          f"{len(failed)} failed.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+# =============================================================================
+# On-disk cache of the preprocessed recording
+#
+# Parsing the BrainVision runs, resampling to 500 Hz, intersecting the
+# channels and band-pass filtering cost the same on every run, even when
+# only the window parameters changed. The result of that preprocessing is
+# stored once per subject:
+#
+#   <cache_dir>/<key>/data.npy     filtered (channels, samples) float64 (or,
+#                                  with precision="float32", float32) array,
+#                                  opened again with np.load(mmap_mode='r')
+#   <cache_dir>/<key>/events.pkl   synchronized events_df
+#   <cache_dir>/<key>/meta.json    sfreq, phase_labels, duration, channels
+#
+# The key hashes the source files (names, sizes, mtimes; small files also by
+# content) and the preprocessing parameters, so editing or replacing a run
+# invalidates the entry. Entries of the same subject with an outdated key
+# are deleted when the new one is written, and the least recently used
+# entries are evicted once the cache exceeds its size budget.
+# =============================================================================
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from .profiling import stage
+from .progress import advance
+from .stream import DEFAULT_LOAD_JOBS, FILTER_BAND_HZ, FILTER_ORDER, TARGET_SFREQ, SubjectStream, run_order
+
+# Bump when the preprocessing or the entry layout changes
+CACHE_VERSION = 1
+
+# Cache location (overridable with the KQEEG_CACHE_DIR environment variable)
+DEFAULT_CACHE_DIR = os.environ.get("KQEEG_CACHE_DIR",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "kqeeg"))
+
+# Total size above which least recently used entries are evicted
+DEFAULT_MAX_CACHE_BYTES = 20 * 2**30
+
+# Source files up to this size are hashed by content (headers, markers,
+# events); larger ones (the .eeg data) by size and mtime only
+HASH_MAX_BYTES = 1 * 2**20
+
+
+def source_files(dataset_path, subject_id):
+    """
+    Every file the preprocessing of a subject reads: each run's .vhdr and
+    the .vmrk/.eeg files it references, plus the events .tsv files.
+
+    Returns:
+        list: Existing file paths, in a fixed order.
+    """
+    eeg_path = os.path.join(dataset_path, f"sub-{subject_id}", "eeg")
+    files = []
+    for _, fname in run_order(subject_id):
+        vhdr = os.path.join(eeg_path, fname)
+        if not os.path.exists(vhdr):
+            continue
+        files.append(vhdr)
+        with open(vhdr, encoding="latin-1") as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key in ("DataFile", "MarkerFile") and value:
+                    files.append(os.path.join(eeg_path, value))
+    for task in ["sed", "sed2"]:
+        for run in [1, 2, 3]:
+            files.append(os.path.join(eeg_path, f"sub-{subject_id}_task-{task}_acq-rest_run-{run}_events.tsv"))
+    return [path for path in files if os.path.exists(path)]
+
+
+def file_fingerprint(path, previous=None):
+    """
+    Name, size and mtime of a file, plus its SHA-256 when it is small
+    (<= HASH_MAX_BYTES).
+
+    Args:
+        previous (dict): An earlier fingerprint of the same file; its hash is
+            reused when size and mtime are unchanged.
+    """
+    st = os.stat(path)
+    item = {"name": os.path.basename(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if st.st_size <= HASH_MAX_BYTES:
+        if previous and "sha256" in previous and all(previous.get(k) == item[k] for k in ("size", "mtime_ns")):
+            item["sha256"] = previous["sha256"]
+        else:
+            with open(path, "rb") as f:
+                item["sha256"] = hashlib.sha256(f.read()).hexdigest()
+    return item
+
+
+def _params(subject_id, sfreq, resampler="fft", precision="float64"):
+    """Preprocessing parameters that determine the cached array."""
+    from importlib.metadata import version
+    params = {
+        "cache_version": CACHE_VERSION,
+        "mne_version": version("mne"),  # without importing mne (about a second)
+        "subject_id": str(subject_id),
+        "sfreq": float(sfreq),
+        "filter_band_hz": list(FILTER_BAND_HZ),
+        "filter_order": FILTER_ORDER,
+    }
+    if resampler != "fft":
+        params["resampler"] = resampler  # FFT entries keep their original keys
+    if precision != "float64":
+        params["precision"] = precision
+    return params
+
+
+def _digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def cache_key(dataset_path, subject_id, sfreq=TARGET_SFREQ, resampler="fft", precision="float64"):
+    """
+    Fingerprint of a subject's source files and the preprocessing parameters.
+
+    Returns:
+        tuple: (key, source_id). `key` changes whenever a source file or a
+        parameter changes; `source_id` identifies the subject + parameters
+        regardless of file contents (used to drop outdated entries).
+    """
+    files = [file_fingerprint(path) for path in source_files(dataset_path, subject_id)]
+    params = _params(subject_id, sfreq, resampler, precision)
+    source_id = _digest({"dataset_path": os.path.abspath(dataset_path), "params": params})
+    return _digest({"files": files, "params": params}), source_id
+
+
+def _entry_bytes(entry_dir):
+    return sum(e.stat().st_size for e in os.scandir(entry_dir) if e.is_file())
+
+
+def cache_entries(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Lists the complete cache entries.
+
+    Returns:
+        list: Dicts (key, path, bytes, last_used, meta), least recently used first.
+    """
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for e in os.scandir(cache_dir):
+        meta_path = os.path.join(e.path, "meta.json")
+        if not e.is_dir() or not os.path.exists(meta_path):
+            continue  # incomplete or foreign
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        entries.append({
+            "key": e.name,
+            "path": e.path,
+            "bytes": _entry_bytes(e.path),
+            "last_used": os.stat(meta_path).st_mtime,
+            "meta": meta,
+        })
+    return sorted(entries, key=lambda entry: entry["last_used"])
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES, keep=()):
+    """
+    Deletes least recently used entries until the cache fits in `max_bytes`.
+
+    Args:
+        keep (iterable): Keys that are never evicted (e.g. the entry in use).
+
+    Returns:
+        list: Keys of the deleted entries.
+    """
+    entries = cache_entries(cache_dir)
+    total = sum(entry["bytes"] for entry in entries)
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry["key"] in keep:
+            continue
+        shutil.rmtree(entry["path"], ignore_errors=True)
+        total -= entry["bytes"]
+        removed.append(entry["key"])
+    return removed
+
+
+def clear_cache(cache_dir=DEFAULT_CACHE_DIR, subject_id=None):
+    """Deletes every entry (or only those of `subject_id`)."""
+    for entry in cache_entries(cache_dir):
+        if subject_id is None or entry["meta"]["params"]["subject_id"] == str(subject_id):
+            shutil.rmtree(entry["path"], ignore_errors=True)
+
+
+def _read_entry(entry_dir):
+    """Opens a cache entry; the signal is memory-mapped, not read."""
+    meta_path = os.path.join(entry_dir, "meta.json")
+    with open(meta_path) as f:
+        meta = json.load(f)
+    data = np.load(os.path.join(entry_dir, "data.npy"), mmap_mode="r")
+    if list(data.shape) != meta["shape"]:
+        raise ValueError(f"Corrupt cache entry {entry_dir}: shape {data.shape} != {meta['shape']}")
+    events_df = pd.read_pickle(os.path.join(entry_dir, "events.pkl"))
+    os.utime(meta_path)  # mark as recently used
+    phase_labels = [tuple(p) for p in meta["phase_labels"]]
+    return data, meta["sfreq"], phase_labels, meta["duration"], events_df
+
+
+def _write_entry(entry_dir, stream, source_id, params):
+    """Writes the filtered stream into a new entry (atomically renamed into place)."""
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        data = np.lib.format.open_memmap(os.path.join(tmp_dir, "data.npy"), mode="w+",
+                                         dtype=stream.dtype, shape=stream.shape)
+        pos = 0
+        for block in stream:
+            data[:, pos:pos + block.shape[1]] = block
+            pos += block.shape[1]
+            advance(pos, stream.n_samples, "samples")
+        data.flush()
+        del data
+
+        stream.events_df.to_pickle(os.path.join(tmp_dir, "events.pkl"))
+        meta = {
+            "source_id": source_id,
+            "params": params,
+            "created": time.time(),
+            "shape": list(stream.shape),
+            "sfreq": stream.sfreq,
+            "duration": stream.duration,
+            "phase_labels": stream.phase_labels,
+            "ch_names": stream.ch_names,
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=4)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(entry_dir, "meta.json")):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_full_cycle_cached(dataset_path, subject_id, cache_dir=DEFAULT_CACHE_DIR,
+                           max_bytes=DEFAULT_MAX_CACHE_BYTES, load_jobs=DEFAULT_LOAD_JOBS, resampler="fft",
+                           precision="float64"):
+    """
+    Cached drop-in for load_full_cycle_and_events.
+
+    On a hit the preprocessed signal is memory-mapped from the cache (no
+    BrainVision parsing, resampling or filtering). On a miss the subject is
+    streamed through the usual preprocessing straight into a new entry.
+
+    Args:
+        dataset_path (str): The path to the root of the dataset (e.g., '.../ds005620').
+        subject_id (str): The subject identifier (e.g., '1022').
+        cache_dir (str): Cache folder.
+        max_bytes (int): Size budget of the whole cache.
+        load_jobs, resampler, precision: Loading options on a miss (see
+            SubjectStream); the resampler and precision are part of the cache key.
+
+    Returns:
+        tuple: (data, sfreq, phase_labels, duration, events_df), where `data`
+        is a read-only np.memmap.
+    """
+    key, source_id = cache_key(dataset_path, subject_id, resampler=resampler, precision=precision)
+    params = _params(subject_id, TARGET_SFREQ, resampler, precision)
+    entry_dir = os.path.join(cache_dir, key)
+
+    if os.path.exists(os.path.join(entry_dir, "meta.json")):
+        try:
+            print(f"Using cached preprocessed data: {entry_dir}")
+            with stage("load"), stage("load/cache_read"):
+                return _read_entry(entry_dir)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Discarding unreadable cache entry {entry_dir}: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with stage("load"):
+        stream = SubjectStream(dataset_path, subject_id, load_jobs=load_jobs, resampler=resampler,
+                               precision=precision)
+
+    # Drop entries of this subject whose source files have changed
+    for entry in cache_entries(cache_dir):
+        if entry["meta"].get("source_id") == source_id and entry["key"] != key:
+            shutil.rmtree(entry["path"], ignore_errors=True)
+
+    print(f"Loading and filtering EEG files (0.5 - 45 Hz) into the cache: {entry_dir}")
+    with stage("load"), stage("load/cache_write"):
+        _write_entry(entry_dir, stream, source_id, params)
+    evict(cache_dir, max_bytes, keep=(key,))
+    data, sfreq, phase_labels, duration, events_df = _read_entry(entry_dir)
+    print(f"Total duration loaded: {duration:.2f} seconds")
+    return data, sfreq, phase_labels, duration, events_df
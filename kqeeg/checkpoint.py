@@ -0,0 +1,159 @@
+# =============================================================================
+# Checkpointed, resumable window analysis
+#
+# The per-window results used to reach disk only once the whole recording
+# was analyzed and the outputs were written: a crash, an out-of-memory kill
+# or a preempted batch node lost hours of windows. During a run_subject
+# the window loop now keeps a checkpoint in <out_dir>/.kq_checkpoint/:
+#
+#   windows.npy   (len(METRIC_COLUMNS), n_windows) float64 memmap; every
+#                 finished block of windows is written into it
+#   state.json    the checkpoint key (input fingerprint of the subject's
+#                 files + the analysis parameters), the window count, the
+#                 columns and `windows_done`, the length of the prefix of
+#                 windows that is safely on disk
+#
+# state.json is rewritten (atomically, after the memmap is flushed) at most
+# every `interval_sec`, and once more when the loop ends. A run with the
+# same key finds the checkpoint, restores the first `windows_done` windows
+# and computes only the rest: the derived columns are rebuilt by feeding
+# the restored windows to kqeeg.derived first, and every window's metrics
+# depend only on its samples, so the output is identical to an
+# uninterrupted run (exact spectral mode; accumulator mode agrees to
+# round-off, as with --window-jobs). A different key discards the
+# checkpoint. It is deleted once the outputs are written.
+# =============================================================================
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .metrics import METRIC_COLUMNS
+
+CHECKPOINT_DIR = ".kq_checkpoint"
+
+# Seconds between two checkpoint saves
+DEFAULT_CHECKPOINT_SEC = 30.0
+
+# Bump when the checkpoint layout changes
+CHECKPOINT_VERSION = 1
+
+
+class WindowCheckpoint:
+    """
+    Periodic checkpoint of the finished windows of one run.
+
+    Args:
+        path (str): Checkpoint folder (e.g. <out_dir>/.kq_checkpoint).
+        key (dict): JSON-ready identity of the run (input fingerprint and
+            analysis parameters); a checkpoint is only resumed by a run
+            with the same key.
+        interval_sec (float): Minimum time between two saves.
+    """
+
+    def __init__(self, path, key, interval_sec=DEFAULT_CHECKPOINT_SEC):
+        self.path = path
+        self.key = json.loads(json.dumps(key, sort_keys=True, default=str))
+        self.interval_sec = interval_sec
+        self.columns = list(METRIC_COLUMNS)
+        self.n_windows = 0
+        self.windows_done = 0   # windows written into the memmap (a prefix)
+        self.windows_saved = 0  # windows covered by state.json
+        self._data = None
+        self._last_save = time.monotonic()
+
+    @property
+    def _state_path(self):
+        return os.path.join(self.path, "state.json")
+
+    @property
+    def _data_path(self):
+        return os.path.join(self.path, "windows.npy")
+
+    def _state(self):
+        return {"checkpoint_version": CHECKPOINT_VERSION, "key": self.key, "n_windows": self.n_windows,
+                "columns": self.columns, "windows_done": self.windows_saved}
+
+    def _load_state(self):
+        try:
+            with open(self._state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def open(self, results, n_windows):
+        """
+        Restores a matching checkpoint into `results` or starts a new one.
+
+        Args:
+            results (dict): Column name -> array of n_windows, filled in place
+                for the restored windows.
+            n_windows (int): Windows of the run.
+
+        Returns:
+            int: Number of restored windows (0 when starting over); they are
+            always the first ones.
+        """
+        self.n_windows = int(n_windows)
+        state = self._load_state()
+        expected = {"checkpoint_version": CHECKPOINT_VERSION, "key": self.key, "n_windows": self.n_windows,
+                    "columns": self.columns}
+        if state is not None and all(state.get(name) == value for name, value in expected.items()):
+            try:
+                self._data = np.lib.format.open_memmap(self._data_path, mode="r+")
+            except (OSError, ValueError):
+                self._data = None
+            if self._data is not None and self._data.shape == (len(self.columns), self.n_windows):
+                done = int(state["windows_done"])
+                for k, name in enumerate(self.columns):
+                    results[name][:done] = self._data[k, :done]
+                self.windows_done = self.windows_saved = done
+                self._last_save = time.monotonic()
+                return done
+            self._data = None
+        elif state is not None:
+            print("Checkpoint is from other inputs or parameters, starting over.")
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        self._data = np.lib.format.open_memmap(self._data_path, mode="w+", dtype=np.float64,
+                                               shape=(len(self.columns), self.n_windows))
+        self.windows_done = self.windows_saved = 0
+        self.save()
+        return 0
+
+    def reset(self):
+        """Forgets the restored windows (e.g. when data kept beside them is lost)."""
+        self.windows_done = 0
+        self.save()
+
+    def write(self, w0, block):
+        """Stores a finished block of windows starting at `w0` (blocks come in time order)."""
+        w1 = int(w0) + len(block[self.columns[0]])
+        for k, name in enumerate(self.columns):
+            self._data[k, w0:w1] = block[name]
+        if w0 <= self.windows_done:
+            self.windows_done = max(self.windows_done, w1)
+
+    def due(self):
+        """True when the next save is due (interval elapsed and new windows written)."""
+        return (self.windows_done > self.windows_saved
+                and time.monotonic() - self._last_save >= self.interval_sec)
+
+    def save(self):
+        """Flushes the windows and records them as done."""
+        self._data.flush()
+        self.windows_saved = self.windows_done
+        tmp = f"{self._state_path}.tmp-{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(self._state(), f)
+        os.replace(tmp, self._state_path)
+        self._last_save = time.monotonic()
+
+    def remove(self):
+        """Deletes the checkpoint (the outputs it protected are written)."""
+        self._data = None
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,266 @@
+# =============================================================================
+# Persisted spectral / connectivity cube
+#
+# The window loop computes a full PSD per channel and the coherence of every
+# channel pair, and used to keep only their scalar summaries (band powers,
+# H_norm, C). Any new question (another band definition, one channel pair)
+# meant re-running the whole spectral pipeline. With --spectral-cube the
+# spectra are also written, block by block as the windows are computed, to
+# spectral_cube.h5 in the subject output folder:
+#
+#   psd             (windows, channels, freqs)  density PSD of every channel
+#                                               (the window-long periodogram
+#                                               the band powers come from)
+#   band_coherence  (windows, bands, c, c)      magnitude-squared coherence
+#                                               averaged over the bins of each
+#                                               COHERENCE_BANDS band ("all" =
+#                                               the average behind C_naive)
+#   t_start_sec, t_mid_sec, t_end_sec, freqs, coherence_freqs
+#
+# Datasets are chunked along the windows (about CHUNK_BYTES per chunk, one
+# band per coherence chunk) and gzip/lzf-compressed, so SpectralCube reads
+# only the chunks a time range / band / pair slice touches. Written without
+# compression, psd and band_coherence are contiguous and SpectralCube.memmap
+# maps them directly.
+# =============================================================================
+
+import json
+import os
+
+import numpy as np
+
+from .spectral import COH_NPERSEG
+
+CUBE_NAME = "spectral_cube.h5"
+
+# Codecs of --spectral-cube (None = uncompressed, memory-mappable)
+CUBE_COMPRESSIONS = ("gzip", "lzf", None)
+
+# Target size of one chunk of psd / band_coherence
+CHUNK_BYTES = 2**20
+
+CUBE_TIME_COLUMNS = ("t_start_sec", "t_mid_sec", "t_end_sec")
+
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError("The spectral cube needs h5py (pip install h5py)") from e
+    return h5py
+
+
+class SpectralCubeWriter:
+    """
+    Writes the spectra of consecutive window blocks into a cube file.
+
+    Args:
+        path (str): Output file (.h5).
+        n_windows (int): Windows of the whole recording.
+        sfreq (float): Sampling rate in Hz.
+        win_samples (int): Window length in samples (PSD frequency grid).
+        bands (dict): Band name -> (f_low, f_high) of the coherence matrices.
+        compression (str): "gzip", "lzf" or None (contiguous, memmap-able).
+        ch_names (list): Channel names, when known.
+        attrs (dict): Extra file attributes (e.g. subject_id, win_sec).
+        resume (bool): Keep the windows already in an existing file (a
+            resumed run, kqeeg.checkpoint); flush() makes them durable.
+    """
+
+    def __init__(self, path, n_windows, sfreq, win_samples, bands, compression="gzip", ch_names=None,
+                 attrs=None, resume=False):
+        if compression not in CUBE_COMPRESSIONS:
+            raise ValueError(f"Unknown cube compression {compression!r} (expected one of {CUBE_COMPRESSIONS})")
+        h5py = _h5py()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.n_windows = int(n_windows)
+        self.compression = compression
+        self._file = h5py.File(path, "a" if resume and os.path.exists(path) else "w")
+        f = self._file
+        f.attrs["sfreq"] = float(sfreq)
+        f.attrs["win_samples"] = int(win_samples)
+        f.attrs["bands"] = json.dumps({name: [lo, None if np.isinf(hi) else hi] for name, (lo, hi) in bands.items()})
+        f.attrs["ch_names"] = json.dumps(list(ch_names) if ch_names is not None else None)
+        for name, value in (attrs or {}).items():
+            f.attrs[name] = value
+        if "freqs" in f:  # resumed
+            return
+        f.create_dataset("freqs", data=np.fft.rfftfreq(win_samples, 1.0 / sfreq))
+        f.create_dataset("coherence_freqs", data=np.fft.rfftfreq(min(COH_NPERSEG, win_samples), 1.0 / sfreq))
+        for name in CUBE_TIME_COLUMNS:
+            f.create_dataset(name, shape=(self.n_windows,), dtype=np.float64)
+
+    def _dataset(self, name, block, chunk_tail):
+        """Creates `name` on the first block (shape and dtype follow the data)."""
+        if name in self._file:
+            return self._file[name]
+        shape = (self.n_windows,) + block.shape[1:]
+        chunks = None
+        if self.compression is not None and self.n_windows:
+            per_window = block.dtype.itemsize * int(np.prod(chunk_tail))
+            chunks = (max(1, min(self.n_windows, CHUNK_BYTES // max(1, per_window))),) + chunk_tail
+        return self._file.create_dataset(name, shape=shape, dtype=block.dtype, chunks=chunks,
+                                         compression=self.compression,
+                                         shuffle=self.compression is not None)
+
+    def write(self, w0, columns):
+        """Stores a block of windows starting at window `w0` (psd, band_coherence and the times)."""
+        psd, coh = columns["psd"], columns["band_coherence"]
+        w1 = w0 + len(psd)
+        for name in CUBE_TIME_COLUMNS:
+            self._file[name][w0:w1] = columns[name]
+        self._dataset("psd", psd, psd.shape[1:])[w0:w1] = psd
+        self._dataset("band_coherence", coh, (1,) + coh.shape[2:])[w0:w1] = coh
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class SpectralCube:
+    """
+    Lazy reader of a spectral cube: only the requested slices are read.
+
+    Windows are selected by their midpoint time (t0 <= t_mid_sec <= t1),
+    channels by index or name.
+
+    Example:
+        with SpectralCube("sub-1022/spectral_cube.h5") as cube:
+            alpha = cube.band_power((8, 12), t0=600, t1=1200)     # (windows, channels)
+            fz_cz = cube.coherence("alpha", pair=("Fz", "Cz"))    # (windows,)
+
+    Attributes:
+        t_mid_sec (np.ndarray): Window midpoints.
+        freqs, coherence_freqs (np.ndarray): Frequency grids of psd and of
+            the coherence bands.
+        bands (dict): Band name -> (f_low, f_high) of band_coherence.
+        ch_names (list): Channel names (None when not recorded).
+        attrs (dict): File attributes (sfreq, subject_id, win_sec, ...).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = _h5py().File(path, "r")
+        f = self._file
+        self.attrs = {name: f.attrs[name] for name in f.attrs if name not in ("bands", "ch_names")}
+        self.bands = {name: (lo, np.inf if hi is None else hi)
+                      for name, (lo, hi) in json.loads(f.attrs["bands"]).items()}
+        self.ch_names = json.loads(f.attrs["ch_names"])
+        self.t_mid_sec = f["t_mid_sec"][()]
+        self.freqs = f["freqs"][()]
+        self.coherence_freqs = f["coherence_freqs"][()]
+
+    @property
+    def n_windows(self):
+        return len(self.t_mid_sec)
+
+    def windows(self, t0=None, t1=None):
+        """Slice of the windows with t0 <= t_mid_sec <= t1."""
+        lo = 0 if t0 is None else int(np.searchsorted(self.t_mid_sec, t0, side="left"))
+        hi = self.n_windows if t1 is None else int(np.searchsorted(self.t_mid_sec, t1, side="right"))
+        return slice(lo, max(lo, hi))
+
+    def times(self, t0=None, t1=None, column="t_mid_sec"):
+        """Window times (t_start_sec, t_mid_sec or t_end_sec) of a time range."""
+        return self._file[column][self.windows(t0, t1)]
+
+    def _channel(self, channel):
+        if isinstance(channel, str):
+            if self.ch_names is None or channel not in self.ch_names:
+                raise KeyError(f"Unknown channel {channel!r}")
+            return self.ch_names.index(channel)
+        return int(channel)
+
+    def psd(self, t0=None, t1=None, channels=None, fmin=None, fmax=None):
+        """
+        Per-channel PSD of a time range.
+
+        Args:
+            channels (list): Channel indices or names (None = all).
+            fmin, fmax (float): Frequency range (inclusive).
+
+        Returns:
+            np.ndarray: (windows, channels, freqs); the frequencies are
+            self.freqs[self.freq_slice(fmin, fmax)].
+        """
+        psd = self._file["psd"][self.windows(t0, t1), :, self.freq_slice(fmin, fmax)]
+        if channels is not None:
+            psd = psd[:, [self._channel(c) for c in channels]]
+        return psd
+
+    def freq_slice(self, fmin=None, fmax=None):
+        """Slice of self.freqs within [fmin, fmax]."""
+        lo = 0 if fmin is None else int(np.searchsorted(self.freqs, fmin, side="left"))
+        hi = len(self.freqs) if fmax is None else int(np.searchsorted(self.freqs, fmax, side="right"))
+        return slice(lo, max(lo, hi))
+
+    def band_power(self, band, t0=None, t1=None, channels=None):
+        """
+        Power in a band (f_low <= f < f_high, summed PSD bins as the
+        band_power_* columns) per window and channel.
+
+        Args:
+            band (str or tuple): A name of kqeeg.metrics.BANDS or (f_low, f_high).
+
+        Returns:
+            np.ndarray: (windows, channels).
+        """
+        if isinstance(band, str):
+            from .metrics import BANDS
+            band = BANDS[band]
+        f_low, f_high = band
+        psd = self.psd(t0, t1, channels, f_low, f_high)
+        return psd[..., self.freqs[self.freq_slice(f_low, f_high)] < f_high].sum(axis=-1)
+
+    def coherence(self, band="all", t0=None, t1=None, pair=None):
+        """
+        Band-averaged coherence of a time range.
+
+        Args:
+            band (str): A name of self.bands.
+            pair (tuple): (channel, channel) by index or name; None returns
+                every pair.
+
+        Returns:
+            np.ndarray: (windows,) for a pair, else (windows, c, c).
+        """
+        if band not in self.bands:
+            raise KeyError(f"Unknown band {band!r} (stored: {list(self.bands)})")
+        b = list(self.bands).index(band)
+        rows = self.windows(t0, t1)
+        if pair is None:
+            return self._file["band_coherence"][rows, b]
+        i, j = (self._channel(c) for c in pair)
+        return self._file["band_coherence"][rows, b, i, j]
+
+    def memmap(self, name="psd"):
+        """
+        The whole `name` dataset as a read-only np.memmap (cubes written
+        without compression only).
+        """
+        ds = self._file[name]
+        offset = ds.id.get_offset()
+        if offset is None or ds.chunks is not None:
+            raise ValueError(f"{name} of {self.path} is chunked/compressed; write the cube with "
+                             "compression None to memory-map it")
+        return np.memmap(self.path, dtype=ds.dtype, mode="r", shape=ds.shape, offset=offset)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,317 @@
+# =============================================================================
+# Derived TS metrics, computed incrementally as windows are produced
+#
+# dKQ_dt, KQ_local_variance (centered rolling variance over 5 windows) and
+# KQ_zscore (against the first 'awake' phase) used to be added after the
+# whole run, from the complete DataFrame: pandas diff(), rolling(center=True)
+# .var() and a second pass over the baseline slice.
+#
+# DerivedMetrics takes the windows in time order, one block at a time, and
+# releases every window as soon as its three columns are final:
+#
+#   dKQ_dt             backward difference (default) or central difference
+#                      (one window later)
+#   KQ_local_variance  RollingVariance, the add/remove Welford update with
+#                      Kahan compensation of pandas' roll_var (including its
+#                      recompute on cancellation), so the values are the ones
+#                      rolling().var() gives. A centered window of w releases
+#                      a window (w - 1) // 2 windows after it arrives
+#   KQ_zscore          mean / std of the baseline windows with the two-pass
+#                      sums of pandas' Series.mean() / .std(). Windows up to
+#                      the end of the baseline phase are held until it ends
+#                      (their z-score needs the whole baseline); afterwards
+#                      every window is released at once
+#
+# Memory is bounded by the rolling window once the baseline has ended,
+# whatever the recording length. add_derived_metrics (kqeeg.pipeline) runs
+# the same code over a finished table, so streaming, chunked and post-hoc
+# runs produce identical columns.
+# =============================================================================
+
+from collections import deque
+
+import numpy as np
+
+DERIVED_COLUMNS = ("dKQ_dt", "KQ_local_variance", "KQ_zscore")
+
+# dKQ_dt: "backward" (KQ[i] - KQ[i-1]) / dt, "central" (KQ[i+1] - KQ[i-1]) / 2dt
+# (one-sided at both ends, as np.gradient)
+DERIVATIVE_METHODS = ("backward", "central")
+
+# Windows of the rolling KQ variance
+DEFAULT_VARIANCE_WINDOW = 5
+
+# Relative drop of the sum of squares treated as cancellation (pandas' InvCondTol)
+_INV_COND_TOL = np.finfo(np.float64).eps * 1e3
+
+
+def derivative_dt(t_mid, win_sec, overlap_perc):
+    """Time step of dKQ_dt: the mean spacing of the window midpoints (the window step as fallback)."""
+    t_mid = np.asarray(t_mid, dtype=np.float64)
+    diffs = np.full(len(t_mid), np.nan)
+    diffs[1:] = np.diff(t_mid)
+    dt = _nanmean(diffs)  # Series.diff().mean()
+    if np.isnan(dt) or dt == 0:
+        dt = win_sec * (1 - overlap_perc / 100.0)
+    return dt
+
+
+def baseline_interval(phases):
+    """(start, end) of the first phase whose name contains 'awake', or None."""
+    for s, e, name in phases:
+        if 'awake' in name:
+            return (s, e)
+    return None
+
+
+def _nanmean(values):
+    """Series.mean() of a float64 array: NaN skipped, one summation over the NaN-filled values."""
+    mask = np.isnan(values)
+    count = len(values) - mask.sum()
+    return np.where(mask, 0.0, values).sum(dtype=np.float64) / np.float64(count) if count > 0 else np.nan
+
+
+def baseline_stats(values):
+    """
+    Mean and std of the baseline KQ values, as Series.mean() / .std() compute
+    them (NaN skipped, two-pass variance); (0, 1) without baseline windows
+    and std 1 when it is undefined or below 1e-6.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return 0.0, 1.0
+    mask = np.isnan(values)
+    filled = np.where(mask, 0.0, values)
+    count = np.float64(len(values) - mask.sum())
+    mean = filled.sum(dtype=np.float64) / count if count > 0 else np.nan
+    std = np.nan
+    if count > 1:
+        sqr = (mean - filled) ** 2
+        np.putmask(sqr, mask, 0)
+        std = np.sqrt(sqr.sum(dtype=np.float64) / (count - 1))
+    if std < 1e-6 or np.isnan(std):
+        std = 1.0
+    return mean, std
+
+
+class RollingVariance:
+    """
+    Rolling sample variance (ddof=1, NaN skipped, at least one value) over
+    `window` values, updated one value at a time.
+
+    Mirrors pandas' rolling(window, min_periods=1, center=center).var(): the
+    same window bounds and the same floating-point updates, so the results
+    are identical. push() returns the variance of every window that became
+    complete; finish() those of the last positions (a centered window
+    needs (window - 1) // 2 later values).
+    """
+
+    def __init__(self, window=DEFAULT_VARIANCE_WINDOW, center=True):
+        if window < 1:
+            raise ValueError(f"Rolling window must be >= 1, got {window}")
+        self.window = int(window)
+        self.offset = (self.window - 1) // 2 if center else 0
+        self.values = deque()   # values[k] is value self.first + k
+        self.first = 0
+        self.n_values = 0
+        self.i = 0              # next output position
+        self.prev_end = 0       # end bound of output i - 1
+        self.prev_start = 0
+
+    def _reset(self):
+        self.nobs = self.mean = self.ssqdm = self.comp_add = self.comp_remove = 0.0
+        self.unstable = False
+
+    def _add(self, val):
+        if val != val:
+            return
+        prev_m2 = self.ssqdm
+        self.nobs += 1
+        prev_mean = self.mean - self.comp_add
+        y = val - self.comp_add
+        t = y - self.mean
+        self.comp_add = t + self.mean - y
+        self.mean = self.mean + t / self.nobs if self.nobs else 0.0
+        self.ssqdm = self.ssqdm + (val - prev_mean) * (val - self.mean)
+        if prev_m2 * _INV_COND_TOL > self.ssqdm:
+            self.unstable = True
+
+    def _remove(self, val):
+        if val != val:
+            return
+        prev_m2 = self.ssqdm
+        self.nobs -= 1
+        if self.nobs:
+            prev_mean = self.mean - self.comp_remove
+            y = val - self.comp_remove
+            t = y - self.mean
+            self.comp_remove = t + self.mean - y
+            self.mean = self.mean - t / self.nobs
+            self.ssqdm = self.ssqdm - (val - prev_mean) * (val - self.mean)
+            if prev_m2 * _INV_COND_TOL > self.ssqdm:
+                self.unstable = True
+        else:
+            self.mean = self.ssqdm = 0.0
+            self.unstable = False
+
+    def _value(self, j):
+        return self.values[j - self.first]
+
+    def _output(self, n_total):
+        """Variance at position self.i, with the values [0, n_total) known."""
+        i = self.i
+        end = min(i + 1 + self.offset, n_total)
+        start = min(max(i + 1 + self.offset - self.window, 0), n_total)
+        if i == 0 or start >= self.prev_end:
+            self._reset()
+            for j in range(start, end):
+                self._add(self._value(j))
+            self.unstable = False
+        else:
+            for j in range(self.prev_start, start):
+                self._remove(self._value(j))
+            for j in range(self.prev_end, end):
+                self._add(self._value(j))
+            if self.unstable:
+                self._reset()
+                for j in range(start, end):
+                    self._add(self._value(j))
+                self.unstable = False
+        self.prev_start, self.prev_end = start, end
+        while self.first < start:  # values left of every later window
+            self.values.popleft()
+            self.first += 1
+        self.i += 1
+        return self.ssqdm / (self.nobs - 1) if self.nobs > 1 else np.nan
+
+    def push(self, val):
+        """Adds the next value; returns the list of newly complete variances."""
+        self.values.append(float(val))
+        self.n_values += 1
+        out = []
+        while self.i + self.offset < self.n_values:
+            out.append(self._output(float("inf")))
+        return out
+
+    def finish(self):
+        """Variances of the positions still waiting for later values."""
+        return [self._output(self.n_values) for _ in range(self.i, self.n_values)]
+
+
+class DerivedMetrics:
+    """
+    dKQ_dt, KQ_local_variance and KQ_zscore of windows fed in time order.
+
+    Args:
+        dt (float): Time step of the derivative (see derivative_dt).
+        baseline (tuple): (start, end) of the z-score baseline in seconds
+            (windows with start <= t_mid <= end); None = mean 0, std 1.
+        derivative (str): One of DERIVATIVE_METHODS.
+        variance_window (int): Windows of the rolling KQ variance.
+        center (bool): Centered rolling window (False: the last windows).
+    """
+
+    def __init__(self, dt, baseline=None, derivative="backward", variance_window=DEFAULT_VARIANCE_WINDOW,
+                 center=True):
+        if derivative not in DERIVATIVE_METHODS:
+            raise ValueError(f"Unknown derivative method {derivative!r} (expected one of {DERIVATIVE_METHODS})")
+        self.dt = dt
+        self.baseline = baseline
+        self.derivative = derivative
+        self.variance = RollingVariance(variance_window, center)
+        self.n_in = 0           # windows fed
+        self.n_out = 0          # windows released
+        self.kq = deque()       # KQ of windows not released (+ the one before them)
+        self.dkq = deque()
+        self.var = deque()
+        self.prev_kq = np.nan   # KQ of the window before self.kq[0]
+        self.baseline_values = []
+        self.stats = None if baseline is not None else (0.0, 1.0)
+
+    def update(self, t_mid, kq):
+        """
+        Feeds the next block of windows.
+
+        Args:
+            t_mid (array): Window midpoints in seconds.
+            kq (array): KQ_naive of the windows.
+
+        Returns:
+            tuple: (first, columns): index of the first released window and
+            DERIVED_COLUMNS -> array for the windows that became final
+            (possibly none, possibly from earlier blocks).
+        """
+        for t, value in zip(np.asarray(t_mid, dtype=float), np.asarray(kq, dtype=float)):
+            if self.stats is None:
+                if t > self.baseline[1]:
+                    self.stats = baseline_stats(self.baseline_values)
+                    self.baseline_values = []
+                elif t >= self.baseline[0]:
+                    self.baseline_values.append(value)
+            self._add(value)
+        return self._release(final=False)
+
+    def finish(self):
+        """Releases the remaining windows (end of the recording)."""
+        if self.stats is None:
+            self.stats = baseline_stats(self.baseline_values)
+            self.baseline_values = []
+        self.var.extend(self.variance.finish())
+        if self.derivative == "central" and self.n_in:
+            self._set_last_derivative()
+        return self._release(final=True)
+
+    def _add(self, value):
+        self.kq.append(value)
+        self.n_in += 1
+        self.var.extend(self.variance.push(value))
+        if self.derivative == "backward":
+            before = self.kq[-2] if len(self.kq) > 1 else self.prev_kq
+            self.dkq.append((value - before) / self.dt if self.n_in > 1 else np.nan)
+        elif self.n_in == 2:
+            self.dkq.append((self.kq[-1] - self.kq[-2]) / self.dt)  # first window: forward difference
+        elif self.n_in > 2:
+            k = len(self.dkq)
+            before = self.kq[k - 1] if k else self.prev_kq
+            self.dkq.append((value - before) / (2 * self.dt))
+
+    def _set_last_derivative(self):
+        """Central differences: the last window gets the backward difference."""
+        if self.n_in == 1:
+            self.dkq.append(np.nan)
+        else:
+            before = self.kq[-2] if len(self.kq) > 1 else self.prev_kq
+            self.dkq.append((self.kq[-1] - before) / self.dt)
+
+    def _release(self, final):
+        n = min(len(self.dkq), len(self.var)) if self.stats is not None else 0
+        first = self.n_out
+        if n == 0:
+            return first, {name: np.empty(0) for name in DERIVED_COLUMNS}
+        kq = np.array([self.kq.popleft() for _ in range(n)])
+        self.prev_kq = kq[-1]
+        dkq = np.array([self.dkq.popleft() for _ in range(n)])
+        var = np.array([self.var.popleft() for _ in range(n)])
+        mean, std = self.stats
+        self.n_out += n
+        return first, {
+            "dKQ_dt": np.where(np.isnan(dkq), 0.0, dkq),
+            "KQ_local_variance": np.where(np.isnan(var), 0.0, var),
+            "KQ_zscore": (kq - mean) / (std + 1e-12),
+        }
+
+
+def derived_columns(t_mid, kq, dt, baseline=None, **kwargs):
+    """
+    DERIVED_COLUMNS of a complete series (DerivedMetrics fed at once).
+
+    Args:
+        t_mid, kq (array): Window midpoints and KQ_naive, in time order.
+        dt, baseline, **kwargs: See DerivedMetrics.
+
+    Returns:
+        dict: Column name -> array of len(kq).
+    """
+    derived = DerivedMetrics(dt, baseline, **kwargs)
+    parts = [derived.update(t_mid, kq), derived.finish()]
+    return {name: np.concatenate([columns[name] for _, columns in parts]) for name in DERIVED_COLUMNS}
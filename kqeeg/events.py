@@ -0,0 +1,243 @@
+# =============================================================================
+# Event-locked KQ analysis
+#
+# Awakenings, inductions and dream reports used to be drawn as vertical lines
+# only; peri-event KQ had to be cut out of the CSV by hand. Here every
+# event's onset_global is mapped onto the window grid with a vectorized
+# binary search over the (sorted) window midpoints, and everything is
+# computed for all events at once:
+#
+#   epochs        one row per event: the window at the onset, and the mean
+#                 of KQ/C/H over the pre-event baseline and the post-event
+#                 interval (prefix sums, O(1) per event), their difference
+#                 and the post-event z-score against the baseline
+#   trajectories  long table of KQ/C/H at every window lag around each
+#                 event (raw and baseline-corrected), NaN past the recording
+#   summary       per trial_type and lag: number of events, mean, std and
+#                 standard error of the baseline-corrected trajectories
+#
+# The cost is O(n_windows + n_events * n_lags), so thousands of events per
+# cohort are cheap. cohort_event_tables combines the per-subject epoch
+# tables of a batch run.
+# =============================================================================
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .liveplot import event_color
+from .results import DEFAULT_RESULT_FORMATS, RESULT_EXTENSIONS, read_results, write_results
+
+# Metrics followed around the events
+EVENT_METRICS = ("KQ_naive", "C_naive", "H_norm_naive")
+
+# Peri-event interval: baseline [-pre, 0), response [0, post]
+DEFAULT_PRE_SEC = 30.0
+DEFAULT_POST_SEC = 30.0
+
+
+def event_labels(events_df):
+    """trial_type of every event (falling back to 'value', as the plots do)."""
+    labels = pd.Series("", index=events_df.index, dtype=object)
+    for column in ("value", "trial_type"):  # trial_type wins where both exist
+        if column in events_df.columns:
+            values = events_df[column]
+            labels = labels.where(values.isna() | (values.astype(str) == ""), values.astype(str))
+    return labels.replace("", "event").to_numpy(dtype=object)
+
+
+def nearest_window(t_mid, onsets):
+    """Index of the window whose midpoint is closest to each onset (binary search)."""
+    idx = np.clip(np.searchsorted(t_mid, onsets), 1, len(t_mid) - 1)
+    left_closer = (onsets - t_mid[idx - 1]) <= (t_mid[idx] - onsets)
+    return np.where(left_closer, idx - 1, idx)
+
+
+def _interval_stats(values, t_mid, t0, t1):
+    """
+    Count, mean and std of `values` over windows with t0 <= t_mid < t1
+    (one interval per event), from prefix sums; NaN windows are skipped.
+    """
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0.0)
+    n_cum = np.concatenate([[0], np.cumsum(valid)])
+    s_cum = np.concatenate([[0.0], np.cumsum(x)])
+    q_cum = np.concatenate([[0.0], np.cumsum(x * x)])
+    lo = np.searchsorted(t_mid, t0, side="left")
+    hi = np.searchsorted(t_mid, t1, side="left")
+    n = n_cum[hi] - n_cum[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (s_cum[hi] - s_cum[lo]) / n
+        var = ((q_cum[hi] - q_cum[lo]) - n * mean ** 2) / (n - 1)
+    return n, mean, np.sqrt(np.maximum(var, 0.0))
+
+
+def event_locked_analysis(df, events_df, pre_sec=DEFAULT_PRE_SEC, post_sec=DEFAULT_POST_SEC,
+                          metrics=EVENT_METRICS):
+    """
+    Event-locked epochs, trajectories and per-trial_type statistics.
+
+    Args:
+        df (pd.DataFrame): Per-window results (needs 't_mid_sec' and `metrics`).
+        events_df (pd.DataFrame): Events with an 'onset_global' column.
+        pre_sec (float): Baseline length before each onset.
+        post_sec (float): Response length after each onset.
+        metrics (tuple): Columns followed around the events.
+
+    Returns:
+        tuple: (epochs, trajectories, summary) DataFrames; all empty when
+        there are no events or windows.
+    """
+    if df.empty or events_df.empty or "onset_global" not in events_df.columns:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    t_mid = df["t_mid_sec"].to_numpy(dtype=float)
+    order = np.argsort(t_mid, kind="stable")  # windows are normally in time order already
+    t_mid = t_mid[order]
+    values = {m: df[m].to_numpy(dtype=float)[order] for m in metrics}
+
+    onsets = events_df["onset_global"].to_numpy(dtype=float)
+    event_index = np.flatnonzero(np.isfinite(onsets))  # rows of events_df that can be placed
+    events_df, onsets = events_df.iloc[event_index], onsets[event_index]
+    if len(onsets) == 0:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    labels = event_labels(events_df)
+    idx0 = nearest_window(t_mid, onsets) if len(t_mid) > 1 else np.zeros(len(onsets), dtype=int)
+
+    # --- Epoch table: one row per event ---
+    epochs = pd.DataFrame({"event_index": event_index, "trial_type": labels})
+    for column in ("task", "run", "onset", "duration"):
+        if column in events_df.columns:
+            epochs[column] = events_df[column].to_numpy()
+    epochs["onset_global"] = onsets
+    epochs["window_index"] = order[idx0]
+    epochs["window_t_mid_sec"] = t_mid[idx0]
+    baseline, counts = {}, []
+    for m in metrics:
+        n_pre, pre_mean, pre_std = _interval_stats(values[m], t_mid, onsets - pre_sec, onsets)
+        n_post, post_mean, _ = _interval_stats(values[m], t_mid, onsets, np.nextafter(onsets + post_sec, np.inf))
+        baseline[m] = pre_mean
+        counts = counts or [n_pre, n_post]  # window counts of the first metric
+        epochs[f"{m}_at_onset"] = values[m][idx0]
+        epochs[f"{m}_baseline_mean"] = pre_mean
+        epochs[f"{m}_baseline_std"] = pre_std
+        epochs[f"{m}_post_mean"] = post_mean
+        epochs[f"{m}_delta"] = post_mean - pre_mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            epochs[f"{m}_post_zscore"] = (post_mean - pre_mean) / np.where(pre_std > 0, pre_std, np.nan)
+    epochs.insert(epochs.columns.get_loc("window_index"), "n_baseline_windows", counts[0])
+    epochs.insert(epochs.columns.get_loc("window_index"), "n_post_windows", counts[1])
+
+    # --- Trajectories on the window grid: lags of whole window steps ---
+    dt = np.median(np.diff(t_mid)) if len(t_mid) > 1 else 0.0
+    if dt > 0:
+        lags = np.arange(-int(np.floor(pre_sec / dt)), int(np.floor(post_sec / dt)) + 1)
+    else:
+        lags = np.zeros(1, dtype=int)
+    idx = idx0[:, None] + lags[None, :]
+    inside = (idx >= 0) & (idx < len(t_mid))
+    idx = np.clip(idx, 0, len(t_mid) - 1)
+    trajectories = pd.DataFrame({
+        "event_index": np.repeat(event_index, len(lags)),
+        "trial_type": np.repeat(labels, len(lags)),
+        "lag": np.tile(lags, len(onsets)),
+        "lag_sec": np.tile(lags * dt, len(onsets)),
+        "t_rel_sec": np.where(inside, t_mid[idx] - onsets[:, None], np.nan).ravel(),
+    })
+    for m in metrics:
+        traj = np.where(inside, values[m][idx], np.nan)
+        trajectories[m] = traj.ravel()
+        trajectories[f"{m}_corrected"] = (traj - baseline[m][:, None]).ravel()
+
+    # --- Peri-event statistics per trial_type and lag ---
+    corrected = [f"{m}_corrected" for m in metrics]
+    grouped = trajectories.groupby(["trial_type", "lag"], sort=True)
+    summary = grouped[corrected].agg(["count", "mean", "std"])
+    summary.columns = [f"{m}_{stat}" for m, stat in summary.columns]
+    for m in corrected:
+        summary[f"{m}_sem"] = summary[f"{m}_std"] / np.sqrt(summary[f"{m}_count"])
+    summary.insert(0, "n_events", grouped["event_index"].nunique())
+    summary = summary.reset_index()
+    summary.insert(2, "lag_sec", summary["lag"] * dt)
+    return epochs, trajectories, summary
+
+
+def plot_event_locked(summary, subject_id, plot_filename, metrics=EVENT_METRICS):
+    """Saves the baseline-corrected mean ± SEM trajectory of every trial_type."""
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(len(metrics), 1, figsize=(12, 3.5 * len(metrics)), sharex=True)
+    axes = np.atleast_1d(axes)
+    fig.suptitle(f"Event-locked KQ, C, H_norm (baseline-corrected) — sub-{subject_id}", fontsize=14)
+    for label, g in summary.groupby("trial_type", sort=True):
+        color = event_color(label)
+        for ax, m in zip(axes, metrics):
+            mean, sem = g[f"{m}_corrected_mean"], g[f"{m}_corrected_sem"].fillna(0)
+            ax.plot(g["lag_sec"], mean, color=color, lw=1.5, label=f"{label} (n={g['n_events'].max()})")
+            ax.fill_between(g["lag_sec"], mean - sem, mean + sem, color=color, alpha=0.2)
+    for ax, m in zip(axes, metrics):
+        ax.axvline(0, color="black", lw=1, ls="--")
+        ax.axhline(0, color="gray", lw=0.5)
+        ax.set_ylabel(f"Δ {m}")
+        ax.grid(True)
+    axes[0].legend(loc="upper left", fontsize=9)
+    axes[-1].set_xlabel("Time from event onset (s)")
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+    plt.savefig(plot_filename, dpi=150)
+    plt.close(fig)
+
+
+def write_event_outputs(out_dir, df, events_df, subject_id, pre_sec=DEFAULT_PRE_SEC, post_sec=DEFAULT_POST_SEC,
+                        formats=DEFAULT_RESULT_FORMATS, float32=False, compression=None):
+    """
+    Writes event_epochs, event_trajectories and event_summary tables and
+    plots/KQ_event_locked_sub-<id>.png into `out_dir` (nothing without events).
+
+    Returns:
+        list: The written table paths.
+    """
+    epochs, trajectories, summary = event_locked_analysis(df, events_df, pre_sec, post_sec)
+    if epochs.empty:
+        return []
+    paths = []
+    for name, table in [("event_epochs", epochs), ("event_trajectories", trajectories),
+                        ("event_summary", summary)]:
+        paths += write_results(table, os.path.join(out_dir, name), formats, float32, compression)
+    plot_event_locked(summary, subject_id, os.path.join(out_dir, "plots", f"KQ_event_locked_sub-{subject_id}.png"))
+    return paths
+
+
+def cohort_event_tables(subject_dirs):
+    """
+    Combines the per-subject event_epochs tables of a batch run.
+
+    Args:
+        subject_dirs (dict): subject_id -> output folder.
+
+    Returns:
+        tuple: (epochs, summary) where `epochs` has a leading 'subject_id'
+        column and `summary` has, per trial_type, the number of events and
+        subjects and the mean / std / SEM of every *_delta column.
+    """
+    frames = []
+    for subject_id, out_dir in subject_dirs.items():
+        for ext in RESULT_EXTENSIONS.values():
+            path = os.path.join(out_dir, "event_epochs" + ext)
+            if os.path.exists(path):
+                epochs = read_results(path)
+                epochs.insert(0, "subject_id", str(subject_id))
+                frames.append(epochs)
+                break
+    if not frames:
+        return pd.DataFrame(), pd.DataFrame()
+    epochs = pd.concat(frames, ignore_index=True)
+
+    deltas = [c for c in epochs.columns if c.endswith("_delta")]
+    grouped = epochs.groupby("trial_type", sort=True)
+    summary = grouped[deltas].agg(["mean", "std", "count"])
+    summary.columns = [f"{c}_{stat}" for c, stat in summary.columns]
+    for c in deltas:
+        summary[f"{c}_sem"] = summary[f"{c}_std"] / np.sqrt(summary[f"{c}_count"])
+    summary.insert(0, "n_events", grouped.size())
+    summary.insert(1, "n_subjects", grouped["subject_id"].nunique())
+    return epochs, summary.reset_index()
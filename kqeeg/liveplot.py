@@ -0,0 +1,237 @@
+# =============================================================================
+# Incremental live plot for analyze_with_events
+#
+# The original live view cleared all three axes on every update, re-plotted
+# the whole KQ/C/H history, re-added every phase band and looped over
+# events_df to redraw every event line, then ran tight_layout: the rendering
+# cost grew quadratically with the recording length.
+#
+# LivePlot draws the phases and events ONCE and keeps one line artist per
+# metric. New windows are appended to those lines and only the lines are
+# redrawn on top of a cached background (blitting). Refreshes are throttled
+# by wall-clock time, not by window count, so the rendering overhead stays
+# bounded however fast the windows are computed. Phase bands and event lines
+# are added in bulk (draw_phases_and_events: one collection for the bands,
+# one per event colour), as in the summary plot (kqeeg.pyramid).
+# iter_in_background lets the computation run in a worker thread while the
+# calling (GUI) thread renders.
+# =============================================================================
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Minimum wall-clock time between two refreshes
+DEFAULT_REFRESH_SEC = 0.5
+
+
+def event_color(label):
+    """Marker colour of an event, from its trial_type/value label."""
+    label = str(label).lower()
+    return 'red' if 'awakening' in label else \
+           'green' if 'induction' in label else \
+           'purple' if 'dream' in label else 'orange'
+
+
+def draw_phases_and_events(axes, phase_labels, events_df, fontsize=9, dream_fontsize=10, dream_y=0.8,
+                           dream_weight='normal'):
+    """
+    Phase bands and event lines on every axis, in bulk: one collection for
+    all phase bands and one per event colour, whatever their number.
+
+    Args:
+        axes (list): Axes sharing the time axis; "DREAM" labels go on the first.
+        phase_labels (list): (start, end, name) phase labels.
+        events_df (pd.DataFrame): Events with an 'onset_global' column.
+        fontsize (int): Phase name size.
+        dream_fontsize, dream_y, dream_weight: "DREAM" label size, height
+            (axes fraction) and weight.
+    """
+    from matplotlib.collections import LineCollection, PolyCollection
+    onsets, labels = np.empty(0), np.empty(0, dtype=object)
+    if not events_df.empty and 'onset_global' in events_df.columns:
+        onsets = events_df['onset_global'].to_numpy(dtype=float)
+        labels = np.full(len(onsets), '', dtype=object)
+        for column in ('value', 'trial_type'):  # trial_type wins where both are set
+            if column in events_df.columns:
+                values = events_df[column].fillna('').astype(str).to_numpy(dtype=object)
+                labels = np.where(values != '', values, labels)
+    colors = np.array([event_color(label) for label in labels], dtype=object)
+
+    bands = [[(t0, 0), (t0, 1), (t1, 1), (t1, 0)] for t0, t1, _ in phase_labels]
+    for ax in axes:
+        blend = ax.get_xaxis_transform()  # x in data, y in axes fraction
+        ax.add_collection(PolyCollection(bands, facecolors='gray', edgecolors='none', alpha=0.1,
+                                         transform=blend), autolim=False)
+        for t0, t1, name in phase_labels:
+            ax.text(t0 + 5, 0.97, name, rotation=90, fontsize=fontsize, va='top', transform=blend)
+        for color in dict.fromkeys(colors):
+            xs = onsets[colors == color]
+            segments = np.stack([np.column_stack([xs, np.zeros(len(xs))]),
+                                 np.column_stack([xs, np.ones(len(xs))])], axis=1)
+            ax.add_collection(LineCollection(segments, colors=color, linestyles='--', alpha=0.7,
+                                             transform=blend), autolim=False)
+    for t, label in zip(onsets, labels):
+        if 'dream' in str(label).lower():
+            axes[0].text(t, dream_y, "DREAM", color='purple', fontsize=dream_fontsize, ha='center',
+                         weight=dream_weight, transform=axes[0].get_xaxis_transform())
+
+
+class LivePlot:
+    """
+    Live KQ / C / H_norm figure that is extended, not redrawn.
+
+    Args:
+        subject_id (str): Subject identifier (for the title).
+        phase_labels (list): (start, end, name) phase labels.
+        events_df (pd.DataFrame): Events with an 'onset_global' column.
+        t_max (float): Length of the recording in seconds (x range).
+        refresh_sec (float): Minimum wall-clock time between refreshes.
+    """
+
+    def __init__(self, subject_id, phase_labels, events_df, t_max, refresh_sec=DEFAULT_REFRESH_SEC):
+        import matplotlib.pyplot as plt
+        self.refresh_sec = refresh_sec
+        self._last_refresh = float("-inf")
+        self._chunks = []       # appended (t, kq, c, h) blocks not yet merged
+        self._data = np.empty((4, 0))
+        self._background = None
+
+        plt.ion()
+        self.fig, self.axes = plt.subplots(3, 1, figsize=(16, 12), sharex=True)
+        self.fig.suptitle(f"KQ, C, H_norm + Events — sub-{subject_id}", fontsize=16)
+        self.canvas = self.fig.canvas
+        self._blit = getattr(self.canvas, "supports_blit", False)
+
+        styles = [("KQ", 'b-', 2, 1.0, "KQ"),
+                  ("C (Coherence)", 'g-', 1, 0.7, "C (Coherence)"),
+                  ("H_norm (Entropy)", 'r-', 1, 0.7, "H_norm (Entropy)")]
+        self.lines = []
+        for ax, (label, fmt, lw, alpha, ylabel) in zip(self.axes, styles):
+            line, = ax.plot([], [], fmt, lw=lw, label=label, alpha=alpha, animated=self._blit)
+            self.lines.append(line)
+            ax.set_ylabel(ylabel)
+            ax.legend(loc='upper left')
+            ax.grid(True)
+            ax.set_ylim(-0.1, 1.1)  # C and H_norm are 0-1; KQ grows as needed
+        self.axes[2].set_xlabel("Time (s)")
+        self.axes[0].set_xlim(0, max(t_max, 1e-9))
+
+        # --- Static layers: phases and events, drawn once ---
+        draw_phases_and_events(self.axes, phase_labels, events_df)
+
+        plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.draw()
+        self.flush_events()
+
+    def _on_draw(self, event):
+        """Full redraws (first draw, resize, rescale) re-cache the background."""
+        if self._blit:
+            self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+            self._draw_lines()
+
+    def _draw_lines(self):
+        for ax, line in zip(self.axes, self.lines):
+            ax.draw_artist(line)
+
+    def append(self, t, kq, c, h):
+        """Queues new windows; they appear at the next refresh."""
+        # Prevent plotting from crashing if old calcs produce NaN
+        self._chunks.append(np.nan_to_num(np.vstack([t, kq, c, h]), nan=0.0, posinf=0.0, neginf=0.0))
+
+    def refresh(self, force=False):
+        """Redraws the lines if `refresh_sec` has passed (or `force`)."""
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.refresh_sec:
+            return
+        self._last_refresh = now
+        if self._chunks:
+            self._data = np.concatenate([self._data] + self._chunks, axis=1)
+            self._chunks = []
+        t, kq, c, h = self._data
+        for line, y in zip(self.lines, (kq, c, h)):
+            line.set_data(t, y)
+
+        # KQ outside the current range: rescale, which needs a full redraw
+        lo, hi = self.axes[0].get_ylim()
+        if len(kq) and (kq.min() - 0.1 < lo or kq.max() + 0.1 > hi):
+            self.axes[0].set_ylim(min(lo, kq.min() - 0.1), max(hi, kq.max() + 0.1))
+            self.canvas.draw()
+        elif self._blit and self._background is not None:
+            self.canvas.restore_region(self._background)
+            self._draw_lines()
+            self.canvas.blit(self.fig.bbox)
+        else:
+            self.canvas.draw_idle()
+        self.flush_events()
+
+    def flush_events(self):
+        """Lets the GUI process pending events (keeps the window responsive)."""
+        self.canvas.flush_events()
+
+    def finish(self):
+        """Final refresh; the lines become regular artists again."""
+        import matplotlib.pyplot as plt
+        self.refresh(force=True)
+        for line in self.lines:
+            line.set_animated(False)
+        self.canvas.draw_idle()
+        self.flush_events()
+        plt.ioff()  # Turn off interactive mode
+
+
+def iter_in_background(iterable, idle=None, maxsize=4, poll_sec=0.05):
+    """
+    Iterates `iterable` in a worker thread and yields its items here.
+
+    The numerical work releases the GIL, so the caller can render while the
+    next items are computed.
+
+    Args:
+        iterable (iterable): The (expensive) producer.
+        idle (callable): Called while waiting for the next item, e.g.
+            LivePlot.flush_events to keep a GUI responsive.
+        maxsize (int): Items computed ahead at most.
+        poll_sec (float): Interval between `idle` calls while waiting.
+
+    Yields:
+        The items of `iterable`, in order. Exceptions are re-raised here.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(("item", item), timeout=poll_sec)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            items.put(("done", None))
+        except BaseException as e:
+            items.put(("error", e))
+
+    worker = threading.Thread(target=produce, name="kqeeg-compute", daemon=True)
+    worker.start()
+    try:
+        while True:
+            try:
+                kind, value = items.get(timeout=poll_sec)
+            except queue.Empty:
+                if idle is not None:
+                    idle()
+                continue
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
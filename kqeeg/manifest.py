@@ -0,0 +1,238 @@
+# =============================================================================
+# Dataset manifest and incremental cohort runs
+#
+# A cohort run used to probe every subject's hardcoded run / events file
+# names and write everything into a fresh resultatKQEEG<timestamp> folder,
+# so a re-run recomputed the whole dataset. Runs now default to one stable
+# folder per dataset (<dataset>/resultatKQEEG, see default_out_root), and
+# the manifest (<out_root>/dataset_manifest.json) records:
+#
+#   subjects   per subject, the runs and events files found in one listing
+#              of its eeg/ folder, the fingerprint of every input file
+#              (name, size, mtime; small files also SHA-256, as the cache)
+#              and one input fingerprint over all of them
+#   outputs    per subject, the input and parameter fingerprints the outputs
+#              in sub-<id>/ were produced from, and the list of those files
+#
+# kqeeg.batch and the GUI queue, re-running into the same output folder,
+# analyze only the subjects whose inputs or parameters changed (or whose
+# outputs are missing) and report the others as "up_to_date". Unchanged
+# files keep their hash from the previous scan, so re-scanning a large
+# dataset costs one stat() per file.
+#
+# Parameters that do not change the outputs (worker counts, streaming,
+# cache location, profiling) are left out of the parameter fingerprint.
+# =============================================================================
+
+import functools
+import hashlib
+import json
+import os
+import time
+
+from .cache import file_fingerprint
+from .stream import run_order
+
+MANIFEST_NAME = "dataset_manifest.json"
+
+# Default output folder inside the dataset (shared by the batch runner, the GUI and run_subject)
+OUT_ROOT_NAME = "resultatKQEEG"
+
+# Bump when the manifest layout changes
+MANIFEST_VERSION = 1
+
+# Bump when the analysis produces different outputs for the same parameters,
+# so every subject is recomputed once
+ANALYSIS_VERSION = 3
+
+# run_subject arguments that do not affect the outputs
+OUTPUT_NEUTRAL_PARAMS = ("n_jobs", "load_jobs", "stream", "cache_dir", "cache_max_bytes", "profile",
+                         "live_plot", "refresh_sec", "compute_thread", "checkpoint_sec")
+
+
+def default_out_root(dataset_path):
+    """The stable default output folder of a dataset: '<dataset_path>/resultatKQEEG'."""
+    return os.path.join(dataset_path, OUT_ROOT_NAME)
+
+
+def _digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def scan_subject(dataset_path, subject_id, previous=None):
+    """
+    Indexes the inputs of one subject from a single listing of its eeg/ folder.
+
+    Args:
+        dataset_path (str): Root of the BIDS dataset.
+        subject_id (str): Subject identifier.
+        previous (dict): The subject's entry of an earlier scan (hashes of
+            unchanged files are reused).
+
+    Returns:
+        dict: "runs" ([phase, vhdr] found, in concatenation order),
+        "events_files", "files" (name -> fingerprint) and "input_fingerprint".
+    """
+    eeg_path = os.path.join(dataset_path, f"sub-{subject_id}", "eeg")
+    present = set(os.listdir(eeg_path)) if os.path.isdir(eeg_path) else set()
+    known = (previous or {}).get("files", {})
+
+    runs, names = [], []
+    for phase, vhdr in run_order(subject_id):
+        if vhdr not in present:
+            continue
+        runs.append([phase, vhdr])
+        names.append(vhdr)
+        with open(os.path.join(eeg_path, vhdr), encoding="latin-1") as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key in ("DataFile", "MarkerFile") and value in present:
+                    names.append(value)
+    events_files = [f"sub-{subject_id}_task-{task}_acq-rest_run-{run}_events.tsv"
+                    for task in ("sed", "sed2") for run in (1, 2, 3)]
+    events_files = [name for name in events_files if name in present]
+    names += events_files
+
+    files = {name: file_fingerprint(os.path.join(eeg_path, name), known.get(name)) for name in names}
+    return {
+        "runs": runs,
+        "events_files": events_files,
+        "files": files,
+        "input_fingerprint": _digest([files[name] for name in names]),
+    }
+
+
+def _json_value(value):
+    return json.loads(json.dumps(list(value) if isinstance(value, tuple) else value, default=str))
+
+
+@functools.lru_cache(maxsize=None)
+def _argument_defaults():
+    """Default values of the run_subject and analyze_with_events arguments, JSON-ready."""
+    import inspect
+
+    from .pipeline import analyze_with_events, run_subject
+
+    defaults = {}
+    for func in (analyze_with_events, run_subject):
+        for name, param in inspect.signature(func).parameters.items():
+            if param.default is not inspect.Parameter.empty:
+                defaults[name] = _json_value(param.default)
+    return defaults
+
+
+def analysis_params(win_sec, overlap_perc, analysis_kwargs):
+    """
+    The parameters that determine a subject's outputs, JSON-ready.
+
+    Arguments left at their run_subject / analyze_with_events default are
+    omitted, so the GUI (which passes few) and the batch runner (which passes
+    every option) agree on the parameters of the same analysis.
+    """
+    params = {"analysis_version": ANALYSIS_VERSION, "win_sec": float(win_sec), "overlap_perc": float(overlap_perc)}
+    defaults = _argument_defaults()
+    for name, value in sorted(analysis_kwargs.items()):
+        value = _json_value(value)
+        if name not in OUTPUT_NEUTRAL_PARAMS and (name not in defaults or defaults[name] != value):
+            params[name] = value
+    return params
+
+
+def params_fingerprint(params):
+    return _digest(params)
+
+
+def output_files(out_dir):
+    """Every file under `out_dir`, as sorted paths relative to it."""
+    files = []
+    for root, _, names in os.walk(out_dir):
+        files += [os.path.relpath(os.path.join(root, name), out_dir) for name in names]
+    return sorted(files)
+
+
+class DatasetManifest:
+    """
+    Inputs and outputs of the subjects of one output folder.
+
+    Args:
+        out_root (str): Cohort output folder (holds dataset_manifest.json
+            and one sub-<id>/ folder per subject).
+        dataset_path (str): Root of the BIDS dataset.
+    """
+
+    def __init__(self, out_root, dataset_path):
+        self.path = os.path.join(out_root, MANIFEST_NAME)
+        self.out_root = out_root
+        self.dataset_path = os.path.abspath(dataset_path)
+        self.subjects = {}
+        self.outputs = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Warning: Ignoring unreadable manifest {self.path}: {e}")
+                data = {}
+            if data.get("manifest_version") == MANIFEST_VERSION and data.get("dataset_path") == self.dataset_path:
+                self.subjects = data.get("subjects", {})
+                self.outputs = data.get("outputs", {})
+
+    def scan(self, subjects):
+        """Re-indexes the inputs of `subjects` (hashes of unchanged files are reused)."""
+        for subject_id in subjects:
+            self.subjects[subject_id] = scan_subject(self.dataset_path, subject_id, self.subjects.get(subject_id))
+
+    def subject_dir(self, subject_id):
+        return os.path.join(self.out_root, f"sub-{subject_id}")
+
+    def is_up_to_date(self, subject_id, params):
+        """True when the recorded outputs match the current inputs and `params` and all still exist."""
+        entry = self.outputs.get(subject_id)
+        inputs = self.subjects.get(subject_id)
+        if entry is None or inputs is None:
+            return False
+        if (entry["input_fingerprint"] != inputs["input_fingerprint"]
+                or entry["params_fingerprint"] != params_fingerprint(params)):
+            return False
+        out_dir = self.subject_dir(subject_id)
+        return all(os.path.exists(os.path.join(out_dir, name)) for name in entry["files"])
+
+    def discard(self, subject_id):
+        """
+        Deletes the recorded outputs of `subject_id` before it is recomputed,
+        so files of the previous parameters (e.g. another format) do not linger.
+        """
+        entry = self.outputs.pop(subject_id, None)
+        if entry is None:
+            return
+        out_dir = self.subject_dir(subject_id)
+        for name in entry["files"]:
+            path = os.path.join(out_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record(self, subject_id, params, elapsed_sec=None):
+        """Records the outputs just written for `subject_id`."""
+        files = output_files(self.subject_dir(subject_id))
+        self.outputs[subject_id] = {
+            "input_fingerprint": self.subjects[subject_id]["input_fingerprint"],
+            "params_fingerprint": params_fingerprint(params),
+            "params": params,
+            "files": files,
+            "completed": time.time(),
+            "elapsed_sec": elapsed_sec,
+        }
+
+    def save(self):
+        """Writes the manifest (atomically renamed into place)."""
+        os.makedirs(self.out_root, exist_ok=True)
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump({
+                "manifest_version": MANIFEST_VERSION,
+                "dataset_path": self.dataset_path,
+                "updated": time.time(),
+                "subjects": self.subjects,
+                "outputs": self.outputs,
+            }, f, indent=1)
+        os.replace(tmp, self.path)
@@ -0,0 +1,385 @@
+# =============================================================================
+# Batched window metrics (KQ_naive, C_naive, H_norm_naive + TS metrics)
+#
+# The original sliding-window loop ran np.std / np.mean / np.var and two
+# identical welch() calls one window at a time and built a dict per window,
+# so interpreter overhead grew with the number of windows. Here all windows
+# are taken from ONE zero-copy strided view of the recording,
+# (n_windows, channels, win_samples), and every metric is computed for a
+# whole block of windows with a handful of array operations. Blocks are
+# sized from a memory budget so multi-hour recordings stay bounded.
+#
+# The formulas are exactly those of the per-window loop in
+# analyze_with_events (see the comments there); only the iteration changed.
+#
+# A float32 recording (precision="float32", kqeeg.stream) is windowed and
+# transformed in float32 / complex64, halving the memory traffic of the
+# FFTs. The reductions that lose accuracy in single precision (time-domain
+# moments, channel-averaged PSDs, and from there band powers, the entropy
+# sum and C) are accumulated in float64.
+#
+# With spectra=True (exact mode) every block also carries the per-channel
+# PSD and the band-averaged coherence matrices it was computed from, for the
+# persisted spectral cube (kqeeg.cube).
+# =============================================================================
+
+import warnings
+
+import numpy as np
+from scipy import fft as sp_fft
+
+from .profiling import stage
+from .spectral import (COH_NPERSEG, DEFAULT_COH_CHANNELS, naive_coherence, naive_coherence_bands, segment_fft,
+                       welch_density_scale)
+
+# Standard EEG bands (for TS metrics)
+BANDS = {
+    'delta': (0.5, 4),
+    'theta': (4, 8),
+    'alpha': (8, 12),
+    'beta': (12, 30),
+    'gamma': (30, 45)
+}
+
+# Per-window output columns, in CSV order
+METRIC_COLUMNS = [
+    "t_start_sec", "t_end_sec", "t_mid_sec",
+    "KQ_naive", "C_naive", "H_norm_naive",
+    "gfp", "mean_amplitude", "variance",
+] + [f"{kind}_{band}" for band in BANDS for kind in ("band_power", "relative_power")]
+
+# Bands of the stored coherence matrices ("all" = every bin, the average behind C_naive)
+COHERENCE_BANDS = {'all': (0.0, np.inf), **BANDS}
+
+# Extra per-block arrays with spectra=True: per-channel PSD (n, channels, n_freqs)
+# and band-averaged coherence (n, len(COHERENCE_BANDS), coh_channels, coh_channels)
+SPECTRA_KEYS = ("psd", "band_coherence")
+
+# Working-set budget for one block of windows
+DEFAULT_BLOCK_BYTES = 64 * 2**20
+
+# spectral_mode values: window-long periodogram and coherence per window;
+# coherence and PSD from the shared segment grid (kqeeg.accumulator); grid
+# coherence with the window-long periodogram of exact mode
+SPECTRAL_MODES = ("exact", "accumulator", "accumulator_window_psd")
+
+
+def window_starts(n_samples, win_samples, step):
+    """Start sample of every full window, as in the original range() loop."""
+    return np.arange(0, n_samples - win_samples + 1, step)
+
+
+def window_view(data, win_samples, step):
+    """
+    Zero-copy strided view of all windows.
+
+    Args:
+        data (np.ndarray): Signal (channels, samples).
+        win_samples (int): Window length in samples.
+        step (int): Hop between window starts in samples.
+
+    Returns:
+        np.ndarray: Read-only view (n_windows, channels, win_samples).
+    """
+    view = np.lib.stride_tricks.sliding_window_view(data, win_samples, axis=1)[:, ::step]
+    return np.swapaxes(view, 0, 1)
+
+
+def spectral_summary(f, psd_mean, psd_nanmean):
+    """
+    Band powers and H_norm (naive) from channel-averaged PSDs.
+
+    Args:
+        f (np.ndarray): Frequencies (n_freqs,).
+        psd_mean (np.ndarray): Channel-mean PSD per window (n, n_freqs),
+            used for H_norm exactly like `psd_naive.mean(axis=0)`.
+        psd_nanmean (np.ndarray): Channel-nanmean PSD per window (n, n_freqs),
+            used for the TS band powers.
+
+    Returns:
+        dict: Column name -> array (n,).
+    """
+    out = {}
+
+    # --- TS band powers ---
+    psd_avg_ts = np.nan_to_num(psd_nanmean)
+    total_power = psd_avg_ts.sum(axis=1)
+    total_power[total_power <= 0] = 1e-12
+    for band, (f_low, f_high) in BANDS.items():
+        band_mask = (f >= f_low) & (f < f_high)
+        power_in_band = psd_avg_ts[:, band_mask].sum(axis=1)
+        out[f'band_power_{band}'] = power_in_band
+        out[f'relative_power_{band}'] = power_in_band / total_power
+
+    # --- H_norm (Naive) ---
+    p = psd_mean / (psd_mean.sum(axis=1, keepdims=True) + 1e-12)
+    out['H_norm_naive'] = -np.sum(p * np.log2(p + 1e-12), axis=1) / np.log2(psd_mean.shape[1])
+    return out
+
+
+def _channel_means(psd):
+    """Channel mean and nanmean of a (n, channels, n_freqs) PSD block (float64)."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN windows
+        return psd.mean(axis=1, dtype=np.float64), np.nanmean(psd, axis=1, dtype=np.float64)
+
+
+def iter_window_metrics(data, sfreq, win_samples, step, coh_channels=DEFAULT_COH_CHANNELS,
+                        spectral_mode="exact", block_bytes=DEFAULT_BLOCK_BYTES, window_range=None, spectra=False):
+    """
+    Computes every per-window metric in memory-bounded blocks of windows.
+
+    Args:
+        data (np.ndarray): Filtered signal (channels, samples).
+        sfreq (float): Sampling rate in Hz.
+        win_samples (int): Window length in samples.
+        step (int): Hop between windows in samples.
+        coh_channels (int or None): Leading channels used for C (None = all).
+        spectral_mode (str): "exact" (one window-long periodogram and
+            256-sample coherence per window, as the original loop),
+            "accumulator" (C and PSD from a shared short-time decomposition,
+            see kqeeg.accumulator) or "accumulator_window_psd" (C from the
+            decomposition, PSD columns as in exact mode). Windows shorter
+            than one coherence segment always use the exact path.
+        block_bytes (int): Approximate memory budget for one block.
+        window_range (tuple): Optional (first, stop) window indices to compute
+            only part of the recording (used by kqeeg.parallel). Indices in
+            the output stay relative to the whole recording.
+        spectra (bool): Also return the SPECTRA_KEYS arrays of every block
+            (exact mode only).
+
+    Yields:
+        tuple: (first_window_index, columns) where `columns` maps every name
+        in METRIC_COLUMNS (and SPECTRA_KEYS with spectra=True) to an array
+        for the consecutive windows of the block.
+    """
+    if spectral_mode not in SPECTRAL_MODES:
+        raise ValueError(f"Unknown spectral_mode: {spectral_mode!r} (expected one of {SPECTRAL_MODES})")
+    if spectra and spectral_mode != "exact":
+        raise ValueError("The spectral cube needs spectral_mode='exact'")
+
+    starts = window_starts(data.shape[1], win_samples, step)
+    first, stop = (0, len(starts)) if window_range is None else window_range
+    stop = min(stop, len(starts))
+    if first >= stop:
+        return
+
+    if spectral_mode != "exact" and win_samples >= COH_NPERSEG:
+        yield from _iter_accumulator_metrics(data, sfreq, starts, win_samples, step, coh_channels, block_bytes,
+                                             first, stop, window_psd=spectral_mode == "accumulator_window_psd")
+        return
+
+    windows = window_view(data, win_samples, step)
+    f = sp_fft.rfftfreq(win_samples, 1.0 / sfreq)
+    scale = welch_density_scale(win_samples, sfreq).astype(data.dtype)
+    # Detrended/tapered copies, FFT output and coherence segments per window
+    bytes_per_window = 6 * data.shape[0] * win_samples * data.itemsize
+    block = max(1, int(block_bytes // bytes_per_window))
+
+    for w0 in range(first, stop, block):
+        w1 = min(w0 + block, stop)
+        win = windows[w0:w1]                               # (n, channels, win_samples), a view
+        yield w0, _exact_columns(win, starts[w0:w1], sfreq, f, scale, coh_channels, spectra)
+
+
+def _exact_columns(win, starts, sfreq, f, scale, coh_channels, spectra=False):
+    """Exact-mode METRIC_COLUMNS (and SPECTRA_KEYS) of a block of windows (n, channels, win_samples)."""
+    # --- TS metrics ---
+    with stage("window/ts_metrics"):
+        gfp = np.std(win, axis=1, dtype=np.float64).mean(axis=-1)
+        mean_amp = np.mean(win, axis=(1, 2), dtype=np.float64)
+        variance = np.var(win, axis=(1, 2), dtype=np.float64)
+
+    with stage("window/welch"):
+        psd = _periodogram(win, scale)
+        psd_mean, psd_nanmean = _channel_means(psd)
+
+    with stage("window/coherence"), np.errstate(divide='ignore', invalid='ignore'):
+        if spectra:
+            C, band_coh = naive_coherence_bands(win, sfreq, COHERENCE_BANDS, max_channels=coh_channels)
+        else:
+            C = naive_coherence(win, max_channels=coh_channels)
+        C = np.asarray(C, dtype=float)
+
+    with stage("window/assemble"):
+        columns = _assemble(starts, win.shape[-1], sfreq, gfp, mean_amp, variance, f, psd_mean, psd_nanmean, C)
+        if spectra:
+            columns.update(psd=psd, band_coherence=band_coh)
+    return columns
+
+
+def iter_exact_metrics_at(data, sfreq, starts, win_samples, coh_channels=DEFAULT_COH_CHANNELS,
+                          block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Exact-mode metrics of windows at arbitrary start samples (e.g. the
+    distinct windows of several settings, kqeeg.sweep); every window gets
+    the values iter_window_metrics gives it.
+
+    Yields:
+        tuple: (k0, columns) for starts[k0:k0 + n].
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    f = sp_fft.rfftfreq(win_samples, 1.0 / sfreq)
+    scale = welch_density_scale(win_samples, sfreq).astype(data.dtype)
+    block = max(1, int(block_bytes // (6 * data.shape[0] * win_samples * data.itemsize)))
+    for k0 in range(0, len(starts), block):
+        sub = starts[k0:k0 + block]
+        yield k0, _exact_columns(_gather_windows(data, sub, win_samples), sub, sfreq, f, scale, coh_channels)
+
+
+def iter_stream_window_metrics(blocks, sfreq, win_samples, step, window_range=None, **kwargs):
+    """
+    iter_window_metrics for a recording that arrives as consecutive blocks
+    (e.g. a kqeeg.stream.SubjectStream).
+
+    Windows that straddle a block boundary are cut from a small carry-over
+    buffer, so only about one block plus one window is held in memory. Window
+    indices and times refer to the whole recording, exactly as if the blocks
+    had been concatenated first.
+
+    Args:
+        blocks (iterable): (channels, n) arrays in time order.
+        sfreq (float): Sampling rate in Hz.
+        win_samples (int): Window length in samples.
+        step (int): Hop between windows in samples.
+        window_range (tuple): Optional (first, stop) window indices of the
+            whole recording; the blocks before are still read (the filter
+            state needs them) but no window outside is computed.
+        **kwargs: Passed on to iter_window_metrics (coh_channels, spectral_mode, ...).
+            In accumulator mode the running sums restart with every block.
+
+    Yields:
+        tuple: (first_window_index, columns), as iter_window_metrics.
+    """
+    buf = None      # samples from the next window start onwards
+    offset = 0      # absolute sample index of buf[:, 0]
+    next_window = 0
+    first, stop = (0, None) if window_range is None else window_range
+    for block in blocks:
+        buf = block if buf is None else np.concatenate([buf, block], axis=1)
+        starts = window_starts(buf.shape[1], win_samples, step)
+        if len(starts) == 0:
+            continue
+        local_range = (max(0, first - next_window),
+                       len(starts) if stop is None else max(0, min(len(starts), stop - next_window)))
+        for w0, columns in iter_window_metrics(buf, sfreq, win_samples, step, window_range=local_range, **kwargs):
+            w1 = w0 + len(columns["KQ_naive"])
+            columns.update(_window_times(offset + starts[w0:w1], win_samples, sfreq))
+            yield next_window + w0, columns
+        next_window += len(starts)
+        offset += len(starts) * step
+        buf = buf[:, len(starts) * step:]
+
+
+def _periodogram(win, scale):
+    """
+    Density PSD of a block of windows (n, channels, samples): welch(win,
+    nperseg=win_samples) is a single tapered periodogram.
+    """
+    X = segment_fft(win, nperseg=win.shape[-1])[..., 0, :]
+    return (X.real ** 2 + X.imag ** 2) * scale
+
+
+def _gather_windows(data, starts, win_samples):
+    """
+    Windows at arbitrary `starts` as (n, channels, win_samples), laid out
+    channel-major like window_view so the moments reduce in the same order.
+    """
+    win = np.empty((data.shape[0], len(starts), win_samples), dtype=data.dtype).transpose(1, 0, 2)
+    for k, start in enumerate(starts):
+        win[k] = data[:, start:start + win_samples]
+    return win
+
+
+def window_psd_means(data, sfreq, starts, win_samples, block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Channel mean / nanmean of the window-long periodogram (the exact-mode
+    PSD) of the windows starting at `starts`, in memory-bounded blocks.
+
+    Returns:
+        tuple: (freqs, psd_mean, psd_nanmean), the latter (n, n_freqs).
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    f = sp_fft.rfftfreq(win_samples, 1.0 / sfreq)
+    scale = welch_density_scale(win_samples, sfreq).astype(data.dtype)
+    block = max(1, int(block_bytes // (6 * data.shape[0] * win_samples * data.itemsize)))
+    means, nanmeans = [], []
+    for k in range(0, len(starts), block):
+        win = _gather_windows(data, starts[k:k + block], win_samples)
+        psd_mean, psd_nanmean = _channel_means(_periodogram(win, scale))
+        means.append(psd_mean)
+        nanmeans.append(psd_nanmean)
+    if not means:
+        return f, np.empty((0, len(f))), np.empty((0, len(f)))
+    return f, np.concatenate(means), np.concatenate(nanmeans)
+
+
+def _iter_accumulator_metrics(data, sfreq, starts, win_samples, step, coh_channels, block_bytes, first, stop,
+                              window_psd=False):
+    """
+    Accumulator-mode blocks (windows of one length complete in start order).
+    The PSD columns come from the grid, or with `window_psd` from the
+    window-long periodogram.
+    """
+    from .accumulator import SlidingSpectralAccumulator, aligned_hop, window_moments
+
+    starts = starts[first:stop]
+    acc = SlidingSpectralAccumulator(data, sfreq, coh_channels=coh_channels, block_bytes=block_bytes,
+                                     hop=aligned_hop([step], [win_samples]), psd=not window_psd)
+    with stage("window/ts_metrics"):
+        gfp, mean_amp, variance = window_moments(data, starts, starts + win_samples)
+    windows = acc.iter_windows(starts, starts + win_samples)
+    while True:
+        # Segment FFTs, cross-spectra and running sums of the coherence (and grid PSD)
+        with stage("window/coherence"):
+            item = next(windows, None)
+        if item is None:
+            return
+        idx, C, psd_mean, psd_nanmean = item
+        w0, w1 = idx[0], idx[-1] + 1
+        if window_psd:
+            with stage("window/welch"):
+                f, psd_mean, psd_nanmean = window_psd_means(data, sfreq, starts[w0:w1], win_samples, block_bytes)
+        else:
+            f, psd_mean, psd_nanmean = grid_psd_means(acc, win_samples, psd_mean, psd_nanmean)
+        with stage("window/assemble"):
+            columns = _assemble(starts[w0:w1], win_samples, sfreq, gfp[w0:w1], mean_amp[w0:w1],
+                                variance[w0:w1], f, psd_mean, psd_nanmean, C)
+        yield first + w0, columns
+
+
+def grid_psd_means(acc, win_samples, psd_mean, psd_nanmean):
+    """
+    Grid PSDs of SlidingSpectralAccumulator(psd=True) windows scaled to the
+    bin width of a window-long periodogram, so that band powers (sums of
+    PSD bins) keep the magnitude of exact mode.
+
+    Returns:
+        tuple: (freqs, psd_mean, psd_nanmean), as window_psd_means.
+    """
+    bins = win_samples / acc.nperseg
+    return acc.freqs, psd_mean * bins, psd_nanmean * bins
+
+
+def _window_times(starts, win_samples, sfreq):
+    """t_start_sec, t_end_sec and t_mid_sec columns of windows starting at `starts`."""
+    return {
+        "t_start_sec": starts / sfreq,
+        "t_end_sec": (starts + win_samples) / sfreq,
+        "t_mid_sec": (starts + win_samples // 2) / sfreq,
+    }
+
+
+def _assemble(starts, win_samples, sfreq, gfp, mean_amp, variance, f, psd_mean, psd_nanmean, C):
+    """Builds the METRIC_COLUMNS dict for one block of windows."""
+    spec = spectral_summary(f, psd_mean, psd_nanmean)
+    columns = _window_times(starts, win_samples, sfreq)
+    columns.update({
+        "KQ_naive": C * (1 - spec['H_norm_naive']),
+        "C_naive": C,
+        "gfp": gfp,
+        "mean_amplitude": mean_amp,
+        "variance": variance,
+    })
+    columns.update(spec)
+    return {name: columns[name] for name in METRIC_COLUMNS}
@@ -0,0 +1,448 @@
+# =============================================================================
+# Real-time (online) KQ mode
+#
+# Instead of a complete BIDS recording, samples arrive as blocks from a
+# source (a TCP socket, or a file replay that paces a recorded subject at
+# real-time speed). Every block goes through the same causal 0.5-45 Hz
+# Butterworth filter as the offline loader (kqeeg.stream.BandpassFilter,
+# state carried between blocks) into a ring buffer. As soon as a window is
+# complete, its KQ_naive / C_naive / H_norm_naive and TS metrics are
+# computed with the offline code (kqeeg.metrics) and emitted at once,
+# together with causal estimates of its derived metrics and its latency:
+#
+#   dKQ_dt             backward difference
+#   KQ_local_variance  variance of the last variance_window windows
+#   KQ_zscore          against the baseline windows seen so far (the whole
+#                      baseline once it has ended)
+#
+# The offline derived columns (kqeeg.derived: central rolling variance,
+# z-score against the complete baseline) need later windows. They are
+# released separately as soon as they are final (final_rows(), --final-out)
+# and are the same values as the offline columns.
+#
+#   python -m kqeeg.online replay /data/ds005620 1022
+#   python -m kqeeg.online socket 127.0.0.1 5555 --channels 64 --sfreq 500
+#
+# Latency is measured from the arrival of the block that completes a window
+# to the moment the window is emitted; it has to stay well below the window
+# step (1 s at the default 2 s / 50%).
+# =============================================================================
+
+import argparse
+import csv
+import socket
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from .derived import (DEFAULT_VARIANCE_WINDOW, DERIVED_COLUMNS, DerivedMetrics, RollingVariance,
+                      baseline_interval, baseline_stats)
+from .metrics import METRIC_COLUMNS, _window_times, iter_window_metrics
+from .spectral import DEFAULT_COH_CHANNELS
+from .stream import BandpassFilter, SubjectStream
+
+# Derived columns emitted with every online window (causal estimates)
+ONLINE_DERIVED_COLUMNS = list(DERIVED_COLUMNS)
+
+# Columns of the final derived rows (the offline values)
+FINAL_COLUMNS = ["window"] + list(DERIVED_COLUMNS)
+
+# Per-window timing columns
+LATENCY_COLUMNS = ["latency_sec", "compute_sec"]
+
+
+class RingBuffer:
+    """
+    Fixed-size multichannel sample buffer.
+
+    Samples are addressed by their absolute index since the start of the
+    session; only the last `capacity` samples can be read back.
+
+    Args:
+        n_channels (int): Number of channels.
+        capacity (int): Samples kept.
+    """
+
+    def __init__(self, n_channels, capacity):
+        self.capacity = int(capacity)
+        self.buf = np.zeros((n_channels, self.capacity))
+        self.n_written = 0
+
+    def write(self, block):
+        """Appends a (channels, n) block, overwriting the oldest samples."""
+        n = block.shape[1]
+        if n > self.capacity:
+            self.n_written += n - self.capacity
+            block = block[:, -self.capacity:]
+            n = self.capacity
+        pos = self.n_written % self.capacity
+        first = min(n, self.capacity - pos)
+        self.buf[:, pos:pos + first] = block[:, :first]
+        self.buf[:, :n - first] = block[:, first:]
+        self.n_written += n
+
+    def read(self, start, stop):
+        """
+        Copies samples [start, stop) (absolute indices) out of the buffer.
+
+        Raises:
+            ValueError: If the range was already overwritten or not written yet.
+        """
+        if start < self.n_written - self.capacity or stop > self.n_written or start > stop:
+            raise ValueError(f"Samples [{start}, {stop}) are not in the buffer "
+                             f"(holds [{max(0, self.n_written - self.capacity)}, {self.n_written}))")
+        pos = start % self.capacity
+        n = stop - start
+        if pos + n <= self.capacity:
+            return self.buf[:, pos:pos + n].copy()
+        return np.concatenate([self.buf[:, pos:], self.buf[:, :pos + n - self.capacity]], axis=1)
+
+
+class LatencyStats:
+    """Collects per-window latencies and summarizes them against a budget."""
+
+    def __init__(self, budget_sec):
+        self.budget_sec = budget_sec
+        self.latencies = []
+        self.compute = []
+
+    def add(self, latency_sec, compute_sec):
+        self.latencies.append(latency_sec)
+        self.compute.append(compute_sec)
+
+    def summary(self):
+        """
+        Returns:
+            dict: Window count, mean/p50/p95/max latency, mean compute time,
+            the budget and the number of windows over budget.
+        """
+        lat = np.asarray(self.latencies)
+        if len(lat) == 0:
+            return {"windows": 0, "budget_sec": self.budget_sec}
+        return {
+            "windows": len(lat),
+            "latency_mean_sec": float(lat.mean()),
+            "latency_p50_sec": float(np.percentile(lat, 50)),
+            "latency_p95_sec": float(np.percentile(lat, 95)),
+            "latency_max_sec": float(lat.max()),
+            "compute_mean_sec": float(np.mean(self.compute)),
+            "budget_sec": self.budget_sec,
+            "over_budget": int((lat > self.budget_sec).sum()),
+        }
+
+    def report(self):
+        s = self.summary()
+        if s["windows"] == 0:
+            return "No windows processed."
+        return (f"{s['windows']} windows, latency mean {s['latency_mean_sec'] * 1e3:.1f} ms, "
+                f"p95 {s['latency_p95_sec'] * 1e3:.1f} ms, max {s['latency_max_sec'] * 1e3:.1f} ms "
+                f"(budget {s['budget_sec'] * 1e3:.0f} ms, {s['over_budget']} over)")
+
+
+class OnlineKQ:
+    """
+    Incremental KQ engine: push raw sample blocks, get finished windows back.
+
+    Args:
+        sfreq (float): Sampling rate in Hz.
+        n_channels (int): Number of channels per block.
+        win_sec (float): Window length in seconds.
+        overlap_perc (float): Window overlap in percent.
+        coh_channels (int or None): Leading channels used for C (None = all).
+        buffer_sec (float): Ring buffer length; must exceed one window plus
+            the largest block.
+        baseline_sec (float): Session start used as z-score baseline.
+        baseline (tuple): (start, end) of the z-score baseline in seconds,
+            instead of the session start (e.g. the 'awake' phase of a replay).
+        derivative, variance_window: Derived metric options (kqeeg.derived).
+
+    Every window is emitted by the push() that completes it, with causal
+    estimates of the derived columns (backward dKQ_dt, trailing variance,
+    z-score against the baseline windows seen so far). The offline derived
+    columns (kqeeg.derived, dt = the window step) become final
+    (variance_window - 1) // 2 windows later, and for the baseline windows
+    once the baseline is complete; final_rows() returns them.
+    """
+
+    def __init__(self, sfreq, n_channels, win_sec=2.0, overlap_perc=50, coh_channels=DEFAULT_COH_CHANNELS,
+                 buffer_sec=30.0, baseline_sec=60.0, baseline=None, derivative="backward",
+                 variance_window=DEFAULT_VARIANCE_WINDOW):
+        self.sfreq = float(sfreq)
+        self.win_samples = int(win_sec * sfreq)
+        self.step = int(self.win_samples * (1 - overlap_perc / 100))
+        if self.win_samples < 1 or self.step < 1:
+            raise ValueError(f"Invalid window setting: {win_sec} s at {overlap_perc}% overlap")
+        self.coh_channels = coh_channels
+        self.filter = BandpassFilter(self.sfreq, n_channels)
+        self.ring = RingBuffer(n_channels, max(int(buffer_sec * self.sfreq), 2 * self.win_samples))
+        self.derived = DerivedMetrics(self.step / self.sfreq, baseline or (0.0, baseline_sec), derivative,
+                                      variance_window)
+        self.trailing = RollingVariance(variance_window, center=False)
+        self.prev_kq = np.nan
+        self.final = deque()  # final derived rows not collected yet
+        self.latency = LatencyStats(self.step / self.sfreq)
+        self.next_window = 0
+
+    def push(self, block):
+        """
+        Filters and buffers a raw (channels, n) block and computes every
+        window it completes.
+
+        Returns:
+            list: One dict per completed window (window index, METRIC_COLUMNS,
+            causal derived and latency columns), in time order.
+        """
+        t_arrival = time.perf_counter()
+        self.ring.write(self.filter(np.asarray(block, dtype=float)))
+
+        n_ready = (self.ring.n_written - self.win_samples) // self.step + 1 - self.next_window
+        if n_ready <= 0:
+            return []
+        first = self.next_window * self.step
+        span = self.ring.read(first, first + (n_ready - 1) * self.step + self.win_samples)
+
+        rows = []
+        t0 = time.perf_counter()
+        for w0, columns in iter_window_metrics(span, self.sfreq, self.win_samples, self.step,
+                                               coh_channels=self.coh_channels):
+            n = len(columns["KQ_naive"])
+            starts = first + (w0 + np.arange(n)) * self.step
+            columns.update(_window_times(starts, self.win_samples, self.sfreq))
+            for k in range(n):
+                row = {"window": self.next_window + w0 + k}
+                row.update({name: float(columns[name][k]) for name in METRIC_COLUMNS})
+                row.update(self._causal_derived(row["t_mid_sec"], row["KQ_naive"]))
+                row["compute_sec"] = time.perf_counter() - t0
+                rows.append(row)
+            t0 = time.perf_counter()
+        self.next_window += n_ready
+        t_emit = time.perf_counter()
+        for row in rows:
+            row["latency_sec"] = t_emit - t_arrival
+            self.latency.add(row["latency_sec"], row["compute_sec"])
+        return rows
+
+    def _causal_derived(self, t_mid, kq):
+        """Derived columns of the next window from the windows up to it."""
+        self._store_final(self.derived.update([t_mid], [kq]))
+        dkq = (kq - self.prev_kq) / self.derived.dt
+        self.prev_kq = kq
+        var = self.trailing.push(kq)[0]
+        mean, std = self.derived.stats or baseline_stats(self.derived.baseline_values)
+        return {
+            "dKQ_dt": 0.0 if np.isnan(dkq) else dkq,
+            "KQ_local_variance": 0.0 if np.isnan(var) else var,
+            "KQ_zscore": (kq - mean) / (std + 1e-12),
+        }
+
+    def _store_final(self, released):
+        d0, columns = released
+        for k in range(len(columns["KQ_zscore"])):
+            row = {"window": d0 + k}
+            row.update({name: float(columns[name][k]) for name in DERIVED_COLUMNS})
+            self.final.append(row)
+
+    def final_rows(self):
+        """Final (offline) derived columns of the windows released since the last call."""
+        rows = list(self.final)
+        self.final.clear()
+        return rows
+
+    def finish(self):
+        """End of the session: the final derived columns of the remaining windows."""
+        self._store_final(self.derived.finish())
+        return self.final_rows()
+
+
+class FileReplaySource:
+    """
+    Replays recorded, unfiltered samples at real-time speed.
+
+    Args:
+        blocks (iterable or np.ndarray): Raw (channels, n) blocks, or one
+            (channels, samples) array.
+        sfreq (float): Sampling rate in Hz.
+        n_channels (int): Number of channels.
+        block_sec (float): Size of the delivered blocks.
+        speed (float): Replay speed (1.0 = real time, None = as fast as possible).
+    """
+
+    def __init__(self, blocks, sfreq, n_channels, block_sec=0.1, speed=1.0):
+        self.blocks = [blocks] if isinstance(blocks, np.ndarray) else blocks
+        self.sfreq = float(sfreq)
+        self.n_channels = n_channels
+        self.block_samples = max(1, int(block_sec * sfreq))
+        self.speed = speed
+
+    @classmethod
+    def from_subject(cls, dataset_path, subject_id, **kwargs):
+        """
+        Replays a subject of the dataset: the same resampled, channel-aligned
+        runs load_full_cycle_and_events reads, but before the band-pass (the
+        online engine filters them itself).
+        """
+        stream = SubjectStream(dataset_path, subject_id)
+        source = cls(stream.raw_blocks(), stream.sfreq, stream.n_channels, **kwargs)
+        source.phase_labels = stream.phase_labels
+        source.events_df = stream.events_df
+        return source
+
+    def __iter__(self):
+        t_start = time.monotonic()
+        sent = 0
+        for block in self.blocks:
+            for s0 in range(0, block.shape[1], self.block_samples):
+                piece = block[:, s0:s0 + self.block_samples]
+                sent += piece.shape[1]
+                if self.speed:
+                    # A block is delivered once its last sample "was recorded"
+                    delay = t_start + sent / (self.sfreq * self.speed) - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield piece
+
+
+class SocketSource:
+    """
+    TCP client for a sample stream of interleaved frames: every sample is
+    `n_channels` values of `dtype` (little-endian float32 by default).
+
+    Args:
+        host (str): Server address.
+        port (int): Server port.
+        n_channels (int): Values per frame.
+        sfreq (float): Sampling rate of the stream in Hz.
+        dtype (str): NumPy dtype of one value.
+        timeout (float): Socket timeout in seconds (None = blocking).
+    """
+
+    def __init__(self, host, port, n_channels, sfreq, dtype='<f4', timeout=None):
+        self.host = host
+        self.port = port
+        self.n_channels = n_channels
+        self.sfreq = float(sfreq)
+        self.dtype = np.dtype(dtype)
+        self.timeout = timeout
+
+    def __iter__(self):
+        frame = self.n_channels * self.dtype.itemsize
+        pending = bytearray()
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return  # server closed the stream
+                pending += chunk
+                n = len(pending) // frame
+                if n == 0:
+                    continue
+                samples = np.frombuffer(bytes(pending[:n * frame]), dtype=self.dtype)
+                del pending[:n * frame]
+                yield samples.reshape(n, self.n_channels).T.astype(float)
+
+
+def run_online(source, win_sec=2.0, overlap_perc=50, coh_channels=DEFAULT_COH_CHANNELS, on_window=None,
+               out_csv=None, final_csv=None, **engine_kwargs):
+    """
+    Runs the online engine on a source until it ends.
+
+    Args:
+        source: FileReplaySource, SocketSource or any iterable of raw
+            (channels, n) blocks with `sfreq` and `n_channels` attributes.
+        on_window (callable): Called with every finished window (dict).
+        out_csv (str): Optional CSV file, one row appended per window.
+        final_csv (str): Optional CSV file of the final derived columns
+            (window, dKQ_dt, KQ_local_variance, KQ_zscore), appended as they
+            become final.
+        **engine_kwargs: Further OnlineKQ options (baseline_sec, derivative, ...).
+            A replayed subject's 'awake' phase is the default baseline, as
+            offline.
+
+    Returns:
+        LatencyStats: Per-window latencies of the session.
+    """
+    if getattr(source, "phase_labels", None) is not None:
+        engine_kwargs.setdefault("baseline", baseline_interval(source.phase_labels))
+    engine = OnlineKQ(source.sfreq, source.n_channels, win_sec, overlap_perc, coh_channels, **engine_kwargs)
+    columns = ["window"] + METRIC_COLUMNS + ONLINE_DERIVED_COLUMNS + LATENCY_COLUMNS
+    f = open(out_csv, "w", newline="") if out_csv else None
+    f_final = open(final_csv, "w", newline="") if final_csv else None
+    try:
+        writer = csv.DictWriter(f, fieldnames=columns) if f else None
+        final_writer = csv.DictWriter(f_final, fieldnames=FINAL_COLUMNS) if f_final else None
+        for w in (writer, final_writer):
+            if w:
+                w.writeheader()
+
+        def emit(rows):
+            for row in rows:
+                if writer:
+                    writer.writerow(row)
+                    f.flush()
+                if on_window:
+                    on_window(row)
+
+        def emit_final(rows):
+            if final_writer and rows:
+                final_writer.writerows(rows)
+                f_final.flush()
+
+        try:
+            for block in source:
+                emit(engine.push(block))
+                emit_final(engine.final_rows())
+        except KeyboardInterrupt:
+            print("Stopped.")
+        emit_final(engine.finish())
+    finally:
+        for handle in (f, f_final):
+            if handle:
+                handle.close()
+    print(engine.latency.report())
+    return engine.latency
+
+
+def _print_window(row):
+    print(f"t={row['t_end_sec']:8.1f} s  KQ={row['KQ_naive']:.4f}  C={row['C_naive']:.4f}  "
+          f"H={row['H_norm_naive']:.4f}  z={row['KQ_zscore']:+.2f}  latency={row['latency_sec'] * 1e3:.1f} ms")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m kqeeg.online",
+                                     description="Real-time KQ/C/H_norm from a live or replayed EEG stream.")
+    sub = parser.add_subparsers(dest="source", required=True)
+    replay = sub.add_parser("replay", help="Replay a recorded subject at real-time speed")
+    replay.add_argument("dataset", help="Root folder of the dataset (e.g. .../ds005620)")
+    replay.add_argument("subject", help="Subject ID (e.g. 1022)")
+    replay.add_argument("--speed", type=float, default=1.0, help="Replay speed (default 1.0; 0 = as fast as possible)")
+    sock = sub.add_parser("socket", help="Read interleaved float32 frames from a TCP server")
+    sock.add_argument("host")
+    sock.add_argument("port", type=int)
+    sock.add_argument("--channels", type=int, required=True, help="Channels per frame")
+    sock.add_argument("--sfreq", type=float, required=True, help="Sampling rate in Hz")
+    for p in (replay, sock):
+        p.add_argument("--win-sec", type=float, default=2.0, help="Window length in seconds (default 2.0)")
+        p.add_argument("--overlap", type=float, default=50, help="Window overlap in percent (default 50)")
+        p.add_argument("--coh-channels", type=int, default=20,
+                       help="Channels used for the naive coherence C (default 20; 0 = all)")
+        p.add_argument("--out", default=None, help="Append every window to this CSV file")
+        p.add_argument("--final-out", default=None,
+                       help="Append the final (offline) derived columns of every window to this CSV file")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.source == "replay":
+        source = FileReplaySource.from_subject(args.dataset, args.subject, speed=args.speed or None)
+    else:
+        source = SocketSource(args.host, args.port, args.channels, args.sfreq)
+    run_online(source, args.win_sec, args.overlap, args.coh_channels or None, on_window=_print_window,
+               out_csv=args.out, final_csv=args.final_out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
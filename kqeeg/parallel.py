@@ -0,0 +1,158 @@
+# =============================================================================
+# Intra-subject parallel window computation
+#
+# Once the filtered `data` array exists, analysis windows are independent.
+# This module splits the window range of ONE subject into chunks and computes
+# them in a pool of worker processes. The signal is never pickled: it is
+# placed once in shared memory (or, when it already is a np.memmap, the
+# workers simply re-open the same file) and every worker attaches a
+# zero-copy ndarray view to it.
+#
+# At most IN_FLIGHT_PER_JOB chunks per worker are submitted at a time; the
+# next one is submitted as each finished chunk is handed on, so finished
+# but not yet consumed results stay bounded however long the recording.
+#
+# Chunks are returned in time order, so the merged output is identical to
+# the serial computation: bit-for-bit in exact mode for the C-contiguous
+# arrays the loader produces, and to round-off in accumulator mode (its
+# running sums restart at chunk boundaries).
+# =============================================================================
+
+import itertools
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .metrics import iter_window_metrics, window_starts
+
+# Chunks per worker: several, so uneven chunk costs still balance out
+CHUNKS_PER_JOB = 4
+
+# Chunks submitted ahead per worker (bounds the results held in memory)
+IN_FLIGHT_PER_JOB = 2
+
+# Keep per-worker BLAS/FFT libraries single-threaded (one process per core)
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+# Set in each worker by _attach()
+_worker_data = None
+_worker_shm = None
+
+
+def _attach(handle):
+    """Worker initializer: maps the shared signal into this process."""
+    global _worker_data, _worker_shm
+    kind, name, shape, dtype, offset = handle
+    if kind == "memmap":
+        _worker_data = np.memmap(name, dtype=dtype, mode="r", shape=shape, offset=offset)
+    else:
+        _worker_shm = shared_memory.SharedMemory(name=name)
+        _worker_data = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+
+
+def _compute_chunk(first, stop, sfreq, win_samples, step, kwargs):
+    """Worker task: every metric block of windows [first, stop)."""
+    return list(iter_window_metrics(_worker_data, sfreq, win_samples, step,
+                                    window_range=(first, stop), **kwargs))
+
+
+@contextmanager
+def shared_signal(data):
+    """
+    Exposes `data` to worker processes without pickling it.
+
+    Yields:
+        tuple: A small, picklable handle for _attach().
+    """
+    if isinstance(data, np.memmap) and data.filename and data.flags.c_contiguous:
+        base = data
+        while isinstance(base.base, np.memmap):
+            base = base.base
+        offset = data.offset + (data.__array_interface__['data'][0] - base.__array_interface__['data'][0])
+        yield ("memmap", data.filename, data.shape, data.dtype.str, offset)
+        return
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+        yield ("shm", shm.name, data.shape, data.dtype.str, 0)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+@contextmanager
+def _single_threaded_env():
+    """Temporarily sets THREAD_ENV_VARS=1 so spawned workers inherit it."""
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = "1"
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def iter_window_metrics_parallel(data, sfreq, win_samples, step, n_jobs=None, chunk_windows=None, window_range=None,
+                                 **kwargs):
+    """
+    Parallel drop-in for kqeeg.metrics.iter_window_metrics.
+
+    Args:
+        data (np.ndarray): Filtered signal (channels, samples).
+        sfreq (float): Sampling rate in Hz.
+        win_samples (int): Window length in samples.
+        step (int): Hop between windows in samples.
+        n_jobs (int): Worker processes (None = one per CPU core).
+        chunk_windows (int): Windows per task. Defaults to an even split
+            into CHUNKS_PER_JOB tasks per worker.
+        window_range (tuple): Optional (first, stop) window indices to compute.
+        **kwargs: Passed on to iter_window_metrics (coh_channels, spectral_mode, ...).
+
+    Yields:
+        tuple: (first_window_index, columns) blocks, in time order.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    n_total = len(window_starts(data.shape[1], win_samples, step))
+    first, stop = (0, n_total) if window_range is None else (window_range[0], min(window_range[1], n_total))
+    n_windows = max(0, stop - first)
+    if n_jobs <= 1 or n_windows == 0:
+        yield from iter_window_metrics(data, sfreq, win_samples, step, window_range=window_range, **kwargs)
+        return
+
+    if chunk_windows is None:
+        chunk_windows = -(-n_windows // (n_jobs * CHUNKS_PER_JOB))
+    chunk_windows = max(1, chunk_windows)
+    chunks = [(w0, min(w0 + chunk_windows, stop)) for w0 in range(first, stop, chunk_windows)]
+    n_jobs = min(n_jobs, len(chunks))
+
+    ctx = multiprocessing.get_context("spawn")
+    with shared_signal(data) as handle, _single_threaded_env(), \
+            ProcessPoolExecutor(max_workers=n_jobs, mp_context=ctx, initializer=_attach,
+                                initargs=(handle,)) as pool:
+        todo = iter(chunks)
+
+        def submit(n):
+            for w0, w1 in itertools.islice(todo, n):
+                in_flight.append(pool.submit(_compute_chunk, w0, w1, sfreq, win_samples, step, kwargs))
+
+        in_flight = deque()
+        submit(n_jobs * IN_FLIGHT_PER_JOB)
+        try:
+            # Merge in time order as chunks complete, topping the queue up before handing each one on
+            while in_flight:
+                blocks = in_flight.popleft().result()
+                submit(1)
+                yield from blocks
+        finally:
+            for fut in in_flight:
+                fut.cancel()
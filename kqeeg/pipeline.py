@@ -0,0 +1,522 @@
+# =============================================================================
+# KQ subject pipeline (load -> analyze -> save), independent of the GUI
+#
+# These are the functions behind KQApp.start_analysis. They live here so the
+# same pipeline can run headless (see kqeeg.batch) and produce exactly the
+# same CSV/TSV/JSON/PNG outputs as a GUI session.
+# =============================================================================
+
+import os
+import json
+from contextlib import nullcontext
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from .cache import DEFAULT_MAX_CACHE_BYTES, load_full_cycle_cached
+from .checkpoint import CHECKPOINT_DIR, DEFAULT_CHECKPOINT_SEC, WindowCheckpoint
+from .cube import CUBE_NAME, SpectralCubeWriter
+from .derived import (DEFAULT_VARIANCE_WINDOW, DERIVED_COLUMNS, DerivedMetrics, baseline_interval,
+                      derivative_dt, derived_columns)
+from .events import DEFAULT_POST_SEC, DEFAULT_PRE_SEC, write_event_outputs
+from .spectral import DEFAULT_COH_CHANNELS
+from .liveplot import DEFAULT_REFRESH_SEC, LivePlot, iter_in_background
+from .manifest import analysis_params, default_out_root, scan_subject
+from .metrics import (COHERENCE_BANDS, METRIC_COLUMNS, _window_times, iter_stream_window_metrics, iter_window_metrics,
+                      window_starts)
+from .parallel import iter_window_metrics_parallel
+from .profiling import RunProfile, active_profile, count, stage
+from .progress import advance, check_cancelled, publish, set_stage
+from .pyramid import DecimationPyramid, plot_pyramid, write_pyramid
+from .results import DEFAULT_RESULT_FORMATS, write_results
+from .stream import DEFAULT_LOAD_JOBS, STREAM_LOAD_JOBS, SubjectStream
+
+# Default analysis parameters (as used by the GUI)
+DEFAULT_WIN_SEC = 2.0
+DEFAULT_OVERLAP_PERC = 50
+
+# =============================================================================
+# 2. Load full cycle + events
+# =============================================================================
+def load_full_cycle_and_events(dataset_path, subject_id, load_jobs=DEFAULT_LOAD_JOBS, resampler="fft",
+                               precision="float64"):
+    """
+    Loads and concatenates all EEG files for a single subject from a BIDS-like directory.
+    Also loads and synchronizes event data from .tsv files.
+
+    The runs are read, resampled and band-pass filtered one block at a time
+    (kqeeg.stream) into a single preallocated array, so the recording is
+    held in memory once instead of several times. Only the EEG channels
+    common to all runs are read, and up to `load_jobs` runs are read and
+    resampled concurrently.
+
+    Args:
+        dataset_path (str): The path to the root of the dataset (e.g., '.../ds005620').
+        subject_id (str): The subject identifier (e.g., '1022').
+        load_jobs (int): Runs loaded concurrently (1 = sequential, least memory).
+        resampler (str): "fft" (MNE raw.resample, default) or "polyphase"
+            (scipy resample_poly for integer-related rates).
+        precision (str): "float64" (default) or "float32": dtype of the
+            filtered signal, and so of all window FFTs (kqeeg.metrics).
+
+    Returns:
+        tuple: (data, sfreq, phase_labels, duration, events_df)
+    """
+    with stage("load"):
+        stream = SubjectStream(dataset_path, subject_id, load_jobs=load_jobs, resampler=resampler,
+                               precision=precision)
+
+        # --- Load, resample and band-pass filter (0.5 - 45 Hz), run by run ---
+        print("Loading and filtering EEG files (0.5 - 45 Hz)...")
+        data = stream.read()
+
+    print(f"Total duration loaded: {stream.duration:.2f} seconds")
+    return data, stream.sfreq, stream.phase_labels, stream.duration, stream.events_df
+
+# =============================================================================
+# 3. KQ + Event Analyzer
+# =============================================================================
+def analyze_with_events(data, sfreq, phase_labels, events_df, subject_id, win_sec, overlap_perc,
+                        coh_channels=DEFAULT_COH_CHANNELS, spectral_mode="exact", live_plot=True,
+                        n_jobs=1, refresh_sec=DEFAULT_REFRESH_SEC, compute_thread=True, derivative="backward",
+                        variance_window=DEFAULT_VARIANCE_WINDOW, spectral_cube=None, cube_compression="gzip",
+                        checkpoint=None):
+    """
+    Calculates KQ, C, H_norm using the SIMPLE/ORIGINAL logic.
+    Collects all other TS metrics.
+    Plots all 3 metrics on separate subplots.
+
+    Args:
+        data (np.ndarray or SubjectStream): Filtered signal (channels, samples),
+            or a kqeeg.stream.SubjectStream whose blocks are analyzed as they
+            are read, without ever holding the whole recording.
+        coh_channels (int or None): Number of leading channels used for the
+            naive coherence C (the original engine uses 20). None uses the
+            full montage.
+        spectral_mode (str): "exact" recomputes Welch/coherence for every
+            window (original behaviour). "accumulator" computes one
+            short-time spectral decomposition of the whole recording and
+            slides running sums over it for the coherence and the PSD
+            (kqeeg.accumulator), so its cost per window no longer depends
+            on the window length. C agrees to round-off when the step is a
+            multiple of 128 samples and by a few percent on average
+            otherwise;
+            band powers and H_norm come from the coarser 256-sample grid
+            PSD. "accumulator_window_psd" keeps the exact-mode band powers
+            and H_norm (one window-long periodogram per window again).
+        live_plot (bool): Show and refresh the live KQ/C/H plot
+            (kqeeg.liveplot). Headless runs (kqeeg.batch) switch it off.
+        n_jobs (int or None): Worker processes for the window computation
+            (kqeeg.parallel). 1 computes in this process, None uses every
+            CPU core. Results are merged in time order and match the serial run.
+            Streams are always analyzed in this process.
+        refresh_sec (float): Minimum wall-clock time between live plot refreshes.
+        compute_thread (bool): With the live plot, compute the windows in a
+            worker thread while this (GUI) thread renders.
+        derivative (str): dKQ_dt method, "backward" (default) or "central".
+        variance_window (int): Windows of the centered rolling KQ variance.
+        spectral_cube (str): Also write the per-channel PSD and the
+            band-averaged coherence matrices of every window to this file
+            (kqeeg.cube; exact spectral mode only).
+        cube_compression (str): Codec of the cube, "gzip", "lzf" or None
+            (uncompressed, memory-mappable).
+        checkpoint (kqeeg.checkpoint.WindowCheckpoint): Save the finished
+            windows periodically; the windows of a matching checkpoint are
+            restored instead of computed (a resumed run).
+
+    Returns:
+        tuple: (results, events_df) where `results` maps every metric
+        column and the derived columns (dKQ_dt, KQ_local_variance,
+        KQ_zscore; computed as the windows are produced, kqeeg.derived) to a
+        per-window array (pd.DataFrame(results) gives the CSV).
+    """
+    with stage("window"):
+        results = _analyze(data, sfreq, phase_labels, events_df, subject_id, win_sec, overlap_perc, coh_channels,
+                           spectral_mode, live_plot, n_jobs, refresh_sec, compute_thread, derivative,
+                           variance_window, spectral_cube, cube_compression, checkpoint)
+    print("Analysis complete.")
+    return results, events_df
+
+
+def _analyze(data, sfreq, phase_labels, events_df, subject_id, win_sec, overlap_perc, coh_channels,
+             spectral_mode, live_plot, n_jobs, refresh_sec, compute_thread, derivative, variance_window,
+             spectral_cube, cube_compression, checkpoint):
+    """Window loop of analyze_with_events; returns the results columns."""
+    from tqdm import tqdm
+    # --- Analysis parameters ---
+    overlap = overlap_perc
+    win_samples = int(win_sec * sfreq)
+    step = int(win_samples * (1 - overlap/100))
+
+    starts = window_starts(data.shape[1], win_samples, step)
+    n_windows = len(starts)
+    # Columns for every window, filled block by block (same names/order as the CSV)
+    results = {name: np.empty(n_windows) for name in METRIC_COLUMNS + list(DERIVED_COLUMNS)}
+
+    # Derived columns, released as soon as they are final (kqeeg.derived)
+    t_mid = _window_times(starts, win_samples, sfreq)["t_mid_sec"]
+    derived = DerivedMetrics(derivative_dt(t_mid, win_sec, overlap_perc), baseline_interval(phase_labels),
+                             derivative, variance_window)
+
+    def store_derived(released):
+        d0, columns = released
+        for name, values in columns.items():
+            results[name][d0:d0 + len(values)] = values
+
+    # --- Windows of an interrupted run (kqeeg.checkpoint) ---
+    first = 0
+    if checkpoint is not None:
+        first = checkpoint.open(results, n_windows)
+    spectra = spectral_cube is not None
+    cube = None
+    if spectra:
+        cube_args = (spectral_cube, n_windows, sfreq, win_samples, COHERENCE_BANDS, cube_compression,
+                     getattr(data, "ch_names", None),
+                     {"subject_id": subject_id, "win_sec": win_sec, "overlap_perc": overlap_perc})
+        try:
+            cube = SpectralCubeWriter(*cube_args, resume=first > 0)
+        except OSError:
+            if not first:
+                raise
+            print("The spectral cube of the checkpoint is unreadable, starting over.")
+            first = 0
+            checkpoint.reset()
+            cube = SpectralCubeWriter(*cube_args)
+    if first:
+        print(f"Resuming from checkpoint: {first}/{n_windows} windows already analyzed.")
+        store_derived(derived.update(t_mid[:first], results["KQ_naive"][:first]))
+    
+    # --- Setup live plot (phases and events are drawn once) ---
+    if live_plot:
+        with stage("window/plot"):
+            plot = LivePlot(subject_id, phase_labels, events_df, t_max=data.shape[1] / sfreq,
+                            refresh_sec=refresh_sec)
+    
+    # --- Sliding window analysis ---
+    # KQ, C, H_norm are calculated EXACTLY as per the user-provided "old"
+    # script, and all TS metrics (GFP, variance, band powers) as per the new
+    # code, but for whole blocks of windows at once (kqeeg.metrics).
+    window_range = (first, n_windows)
+    if not isinstance(data, np.ndarray):
+        blocks = iter_stream_window_metrics(data, sfreq, win_samples, step, window_range=window_range,
+                                            coh_channels=coh_channels, spectral_mode=spectral_mode, spectra=spectra)
+    elif n_jobs == 1:
+        blocks = iter_window_metrics(data, sfreq, win_samples, step, coh_channels=coh_channels,
+                                     spectral_mode=spectral_mode, window_range=window_range, spectra=spectra)
+    else:
+        blocks = iter_window_metrics_parallel(data, sfreq, win_samples, step, n_jobs=n_jobs,
+                                              window_range=window_range, coh_channels=coh_channels,
+                                              spectral_mode=spectral_mode, spectra=spectra)
+    if live_plot and compute_thread:
+        blocks = iter_in_background(blocks, idle=plot.flush_events)
+    n_coh = data.shape[0] if coh_channels is None else min(coh_channels, data.shape[0])
+    done = first
+    if first:
+        restored = {name: results[name][:first] for name in METRIC_COLUMNS}
+        advance(done, n_windows, "windows", restored)
+        if live_plot:
+            with stage("window/plot"):
+                plot.append(restored["t_mid_sec"], restored["KQ_naive"], restored["C_naive"],
+                            restored["H_norm_naive"])
+    with tqdm(total=n_windows, initial=first, desc="Calculating KQ") as pbar, cube or nullcontext():
+        for w0, block in blocks:
+            w1 = w0 + len(block["KQ_naive"])
+            if cube is not None:
+                with stage("window/cube"):
+                    cube.write(w0, block)
+            for name in METRIC_COLUMNS:
+                results[name][w0:w1] = block[name]
+            store_derived(derived.update(block["t_mid_sec"], block["KQ_naive"]))
+            if checkpoint is not None:
+                checkpoint.write(w0, block)
+                if checkpoint.due():
+                    with stage("window/checkpoint"):
+                        if cube is not None:
+                            cube.flush()  # the cube holds every window the checkpoint records
+                        checkpoint.save()
+            pbar.update(w1 - w0)
+            done += w1 - w0
+            advance(done, n_windows, "windows", block)  # background runs (kqeeg.progress)
+            check_cancelled()
+            count("windows", w1 - w0)
+            count("coherence_pairs", (w1 - w0) * (n_coh * (n_coh - 1) // 2))
+            if live_plot:
+                with stage("window/plot"):
+                    plot.append(block["t_mid_sec"], block["KQ_naive"], block["C_naive"], block["H_norm_naive"])
+                    plot.refresh()
+        if checkpoint is not None:
+            if cube is not None:
+                cube.flush()
+            checkpoint.save()
+
+    store_derived(derived.finish())
+
+    if live_plot:
+        with stage("window/plot"):
+            plot.finish()
+    return results
+
+# =============================================================================
+# 4. Derived metrics + outputs
+# =============================================================================
+def add_derived_metrics(df, phases, win_sec, overlap_perc, derivative="backward",
+                        variance_window=DEFAULT_VARIANCE_WINDOW):
+    """
+    Adds the derived TS columns (dKQ_dt, KQ_local_variance, KQ_zscore) in place.
+
+    analyze_with_events already computes them while the windows are
+    produced (kqeeg.derived); this runs the same computation over a
+    finished table (e.g. sweeps, or results without the columns).
+
+    Args:
+        df (pd.DataFrame): Per-window results.
+        phases (list): (start, end, name) phase labels; the first 'awake'
+            phase is the z-score baseline.
+        win_sec (float): Window length in seconds (fallback for dt).
+        overlap_perc (float): Window overlap in percent (fallback for dt).
+        derivative (str): dKQ_dt method (kqeeg.derived.DERIVATIVE_METHODS).
+        variance_window (int): Windows of the rolling KQ variance.
+
+    Returns:
+        pd.DataFrame: The same DataFrame.
+    """
+    if not df.empty:
+        t_mid = df['t_mid_sec'].to_numpy(dtype=float)
+        columns = derived_columns(t_mid, df['KQ_naive'].to_numpy(dtype=float),
+                                  derivative_dt(t_mid, win_sec, overlap_perc), baseline_interval(phases),
+                                  derivative=derivative, variance_window=variance_window)
+        for name in DERIVED_COLUMNS:
+            df[name] = columns[name]
+    return df
+
+
+def plot_summary(df, phases, events, subject_id, plot_filename, pyramid=None):
+    """
+    Saves the final 3-panel KQ / C / H_norm summary plot with phases and events.
+
+    The series are drawn from the decimation pyramid (kqeeg.pyramid): the
+    min..max envelope and mean of at most MAX_PLOT_POINTS bins per axis, so
+    the rendering time does not grow with the recording length.
+
+    Args:
+        pyramid (DecimationPyramid): Pyramid of `df` (built when None).
+    """
+    import matplotlib.pyplot as plt
+    print("Saving final plot...")
+    if pyramid is None:
+        pyramid = DecimationPyramid.from_results(df)
+    fig, _, _ = plot_pyramid(pyramid, phases, events, f"KQ, C, H_norm (Naive Calc) + Events — sub-{subject_id}")
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+    plt.savefig(plot_filename, dpi=200)
+    plt.close(fig)
+
+
+def write_outputs(out_dir, dataset_path, subject_id, timestamp, results, events, sfreq, phases,
+                  win_sec, overlap_perc, formats=DEFAULT_RESULT_FORMATS, float32=False, compression=None,
+                  event_window=(DEFAULT_PRE_SEC, DEFAULT_POST_SEC), precision="float64", spectral_cube=None,
+                  spectral_mode="exact"):
+    """
+    Writes every output of a subject run into `out_dir`:
+    kq_timeseries_hybrid.<parquet|h5|csv>, the KQ / C / H_norm decimation
+    pyramid kq_pyramid.<ext> (kqeeg.pyramid), events_full_synchronized.tsv,
+    run_metadata.json and plots/KQ_hybrid_with_events_sub-<id>.png, plus
+    the event-locked tables (event_epochs, event_trajectories,
+    event_summary) and plots/KQ_event_locked_sub-<id>.png when there are
+    events (kqeeg.events).
+
+    Args:
+        formats (iterable): Result table formats (kqeeg.results): any of
+            "parquet" (default), "hdf5", "csv".
+        float32 (bool): Store the metric columns as float32.
+        compression (str): Codec for the binary formats (default per format).
+        event_window (tuple): (pre_sec, post_sec) around every event onset.
+        precision (str): Computation precision of the run (recorded only).
+        spectral_cube (str): The spectral cube written by the window loop, if
+            any (recorded only).
+        spectral_mode (str): Spectral mode of the window loop (recorded, with
+            the coherence grid hop in accumulator mode).
+
+    When a kqeeg.profiling.RunProfile is active, its stage timings and
+    counters are stored under "profile" in run_metadata.json.
+
+    Returns:
+        pd.DataFrame: The per-window results including derived metrics.
+    """
+    os.makedirs(os.path.join(out_dir, "plots"), exist_ok=True)
+    with stage("output"):
+        df = pd.DataFrame(results)
+
+        # --- Add derived metrics (as per TS), unless computed with the windows ---
+        if not all(name in df.columns for name in DERIVED_COLUMNS):
+            with stage("output/derived"):
+                add_derived_metrics(df, phases, win_sec, overlap_perc)
+
+        # Save KQ time-series data (as per TS)
+        with stage("output/results"):
+            result_files = write_results(df, os.path.join(out_dir, "kq_timeseries_hybrid"), formats, float32,
+                                         compression)
+
+        # Min/max/mean pyramid of KQ / C / H_norm for plotting at any zoom level
+        with stage("output/pyramid"):
+            pyramid = DecimationPyramid.from_results(df)
+            pyramid_files = write_pyramid(pyramid, out_dir, formats, float32, compression)
+
+        if not events.empty:
+            events.to_csv(os.path.join(out_dir, "events_full_synchronized.tsv"), sep='\t', index=False)
+
+        # Event-locked epochs, trajectories and per-trial_type statistics
+        with stage("output/events"):
+            event_files = write_event_outputs(out_dir, df, events, subject_id, *event_window,
+                                              formats=formats, float32=float32, compression=compression)
+
+        # --- 7. Save final summary plot ---
+        plot_filename = os.path.join(out_dir, "plots", f"KQ_hybrid_with_events_sub-{subject_id}.png")
+        with stage("output/plot"):
+            plot_summary(df, phases, events, subject_id, plot_filename, pyramid)
+
+    # --- 6. Save Metadata (as per TS), last so the profile covers the outputs ---
+    metadata = {
+        "run_id": f"sub-{subject_id}_{timestamp}",
+        "subject_id": subject_id,
+        "dataset_name": os.path.basename(os.path.normpath(dataset_path)),
+        "analysis_timestamp": timestamp,
+        "calculation_mode": "Hybrid (Naive KQ/C/H, Full TS Metrics)",
+        "sampling_rate_hz_after_resample": sfreq,
+        "window_length_sec": win_sec,
+        "window_overlap_perc": overlap_perc,
+        "filter_band_hz": [0.5, 45.0],
+        "computation_precision": precision,
+        "spectral_mode": spectral_mode,
+        "phases_loaded": phases,
+        "results_files": [os.path.basename(path) for path in result_files],
+        "results_float32": float32,
+        "pyramid_files": [os.path.basename(path) for path in pyramid_files],
+        "event_window_sec": list(event_window),
+        "event_files": [os.path.basename(path) for path in event_files],
+    }
+    if spectral_mode in ("accumulator", "accumulator_window_psd"):
+        from .accumulator import aligned_hop
+        win_samples = int(win_sec * sfreq)
+        metadata["coherence_hop_samples"] = aligned_hop([int(win_samples * (1 - overlap_perc / 100))],
+                                                        [win_samples])
+    if spectral_cube:
+        metadata["spectral_cube_file"] = os.path.basename(spectral_cube)
+    if active_profile() is not None:
+        metadata["profile"] = active_profile().summary()
+    meta_filename = os.path.join(out_dir, "run_metadata.json")
+    try:
+        with open(meta_filename, 'w') as f:
+            json.dump(metadata, f, indent=4)
+    except Exception as e:
+        print(f"Warning: Could not save metadata JSON: {e}")
+    return df
+
+
+def run_subject(dataset_path, subject_id, out_dir=None, win_sec=DEFAULT_WIN_SEC,
+                overlap_perc=DEFAULT_OVERLAP_PERC, live_plot=False, stream=False, cache_dir=None,
+                cache_max_bytes=DEFAULT_MAX_CACHE_BYTES, sweep=None, formats=DEFAULT_RESULT_FORMATS,
+                float32=False, compression=None, profile=False, load_jobs=DEFAULT_LOAD_JOBS, resampler="fft",
+                event_window=(DEFAULT_PRE_SEC, DEFAULT_POST_SEC), precision="float64", spectral_cube=None,
+                checkpoint_sec=DEFAULT_CHECKPOINT_SEC, **analysis_kwargs):
+    """
+    Full headless pipeline for one subject: load, analyze and save.
+
+    Args:
+        dataset_path (str): Root of the BIDS dataset (e.g. '.../ds005620').
+        subject_id (str): Subject identifier (e.g. '1022').
+        out_dir (str): Output folder. Defaults to
+            '<dataset_path>/resultatKQEEG/sub-<subject_id>', the subject's
+            folder in the stable output root of the GUI and the batch runner.
+        win_sec (float): Window length in seconds.
+        overlap_perc (float): Window overlap in percent.
+        live_plot (bool): Show the live plot while analyzing.
+        stream (bool): Analyze the recording block by block while it is read
+            (kqeeg.stream) instead of loading it into memory first.
+        cache_dir (str): Preprocessed-signal cache folder (kqeeg.cache). When
+            set, the filtered recording is memory-mapped from the cache
+            (written on the first run) and `stream` is not needed.
+        cache_max_bytes (int): Size budget of the cache.
+        sweep (list): Optional (win_sec, overlap_perc) settings analyzed in
+            one pass instead of `win_sec`/`overlap_perc` (kqeeg.sweep). The
+            output is a single kq_sweep_timeseries table.
+        formats, float32, compression: Result table output (see write_outputs).
+        event_window (tuple): (pre_sec, post_sec) of the event-locked analysis.
+        spectral_cube (str): Also write spectral_cube.h5 (per-window PSD and
+            band-averaged coherence, kqeeg.cube) with this codec: "gzip",
+            "lzf" or "none" (uncompressed, memory-mappable). None = no cube.
+        checkpoint_sec (float): Save the finished windows to
+            <out_dir>/.kq_checkpoint at most every so many seconds
+            (kqeeg.checkpoint). A run into the same out_dir with the same
+            inputs and parameters resumes from it; 0/None disables it.
+            Removed once the outputs are written; not used for sweeps.
+        profile (bool): Also write a cProfile dump (profile.prof) into the
+            output folder. Stage timings and counters (kqeeg.profiling) are
+            always recorded in run_metadata.json.
+        load_jobs, resampler, precision: Loading options (see
+            load_full_cycle_and_events). precision="float32" carries the
+            filtered signal and every window FFT in single precision.
+            With `stream` the runs are always read one at a time.
+        **analysis_kwargs: Passed on to analyze_with_events
+            (e.g. coh_channels, spectral_mode).
+
+    Returns:
+        str: The output folder.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if out_dir is None:
+        out_dir = os.path.join(default_out_root(dataset_path), f"sub-{subject_id}")
+    cube_path = None
+    if spectral_cube:
+        if sweep:
+            raise ValueError("The spectral cube is not available for parameter sweeps")
+        cube_path = os.path.join(out_dir, CUBE_NAME)
+        analysis_kwargs.update(spectral_cube=cube_path,
+                               cube_compression=None if spectral_cube == "none" else spectral_cube)
+
+    with RunProfile(os.path.join(out_dir, "profile.prof") if profile else None):
+        set_stage("load")
+        if cache_dir:
+            data, sfreq, phases, duration, events = load_full_cycle_cached(dataset_path, subject_id, cache_dir,
+                                                                           cache_max_bytes, load_jobs, resampler,
+                                                                           precision)
+        elif stream:
+            with stage("load"):
+                # One run in flight: resampled runs are held whole
+                data = SubjectStream(dataset_path, subject_id, load_jobs=STREAM_LOAD_JOBS, resampler=resampler,
+                                     precision=precision)
+            sfreq, phases, events = data.sfreq, data.phase_labels, data.events_df
+        else:
+            data, sfreq, phases, duration, events = load_full_cycle_and_events(dataset_path, subject_id, load_jobs,
+                                                                               resampler, precision)
+        publish("loaded", sfreq=sfreq, phase_labels=phases, events_df=events, t_max=data.shape[1] / sfreq)
+        set_stage("window")
+
+        if sweep:
+            from .sweep import sweep_window_metrics, write_sweep_outputs
+            if not isinstance(data, np.ndarray):
+                with stage("load"):
+                    data = data.read()
+            spectral_mode = analysis_kwargs.get("spectral_mode", "exact")
+            with stage("window"):
+                sweeps = sweep_window_metrics(data, sfreq, sweep, spectral_mode=spectral_mode,
+                                              coh_channels=analysis_kwargs.get("coh_channels", DEFAULT_COH_CHANNELS))
+            set_stage("output")
+            write_sweep_outputs(out_dir, dataset_path, subject_id, timestamp, sweeps, events, sfreq, phases,
+                                spectral_mode, formats, float32, compression, precision)
+            return out_dir
+
+        checkpoint = None
+        if checkpoint_sec:
+            key = {"input": scan_subject(dataset_path, subject_id)["input_fingerprint"],
+                   "params": analysis_params(win_sec, overlap_perc, dict(analysis_kwargs, resampler=resampler,
+                                                                         precision=precision))}
+            checkpoint = WindowCheckpoint(os.path.join(out_dir, CHECKPOINT_DIR), key, checkpoint_sec)
+        results, events = analyze_with_events(data, sfreq, phases, events, subject_id, win_sec, overlap_perc,
+                                              live_plot=live_plot, checkpoint=checkpoint, **analysis_kwargs)
+        set_stage("output")
+        write_outputs(out_dir, dataset_path, subject_id, timestamp, results, events, sfreq, phases,
+                      win_sec, overlap_perc, formats, float32, compression, event_window, precision, cube_path,
+                      analysis_kwargs.get("spectral_mode", "exact"))
+        if checkpoint is not None:
+            checkpoint.remove()
+    return out_dir
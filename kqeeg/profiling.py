@@ -0,0 +1,196 @@
+# =============================================================================
+# Per-stage instrumentation of a subject run
+#
+# A RunProfile records, for every named stage (e.g. "load/read",
+# "window/coherence", "output/plot"), how often it ran and its total wall
+# time, CPU time (this process and reaped worker processes) and peak RSS,
+# plus plain counters (windows processed, coherence pairs evaluated, ...).
+# The summary goes into run_metadata.json.
+#
+# The pipeline code calls the module-level stage() / count() helpers, which
+# record into the active profile and do nothing when none is active, so the
+# instrumentation needs no extra arguments and costs a few microseconds per
+# stage. Stages may nest and may run in several threads at once.
+#
+# Peak RSS is per stage on Linux (the kernel high-water mark is reset through
+# /proc/self/clear_refs at every stage start, after folding it into every
+# open stage). Elsewhere it is the process high-water mark so far, and on
+# platforms without the `resource` module (Windows) it is not recorded.
+#
+# An optional cProfile dump (.prof, for pstats/snakeviz) covers the thread
+# that opened the profile.
+# =============================================================================
+
+import contextlib
+import cProfile
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_active = None
+
+
+def _read_hwm():
+    """Peak RSS of this process in bytes (0 if unknown)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _reset_hwm():
+    """Resets the kernel RSS high-water mark (Linux); False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _cpu_time():
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class _Stage:
+    __slots__ = ("name", "wall", "cpu", "peak")
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = _cpu_time()
+        self.peak = 0
+
+
+class RunProfile:
+    """
+    Stage timings, peak memory and counters of one run.
+
+    Use as a context manager; while it is open it is the active profile the
+    stage() / count() helpers record into.
+
+    Args:
+        cprofile_path (str): Optional path of a cProfile dump (.prof)
+            written when the profile is closed.
+    """
+
+    def __init__(self, cprofile_path=None):
+        self.cprofile_path = cprofile_path
+        self.stages = {}     # name -> {"calls", "wall_sec", "cpu_sec", "peak_rss_bytes"}
+        self.counters = {}
+        self._open = []      # running _Stage records, all threads
+        self._peak = 0       # high-water mark over the whole profile
+        self._lock = threading.Lock()
+        self._per_stage_rss = None
+        self._previous = None
+        self._profiler = None
+        self._t0 = None
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        self._t0 = (time.perf_counter(), _cpu_time())
+        self._per_stage_rss = _reset_hwm()
+        if self.cprofile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.cprofile_path)
+            self._profiler = None
+        self.total_wall_sec = time.perf_counter() - self._t0[0]
+        self.total_cpu_sec = _cpu_time() - self._t0[1]
+        _active = self._previous
+        return False
+
+    def _fold_hwm(self):
+        """Folds the current high-water mark into every open stage (lock held)."""
+        hwm = _read_hwm()
+        self._peak = max(self._peak, hwm)
+        for record in self._open:
+            record.peak = max(record.peak, hwm)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the enclosed block as stage `name` (repeated calls add up)."""
+        with self._lock:
+            self._fold_hwm()
+            if self._per_stage_rss:
+                _reset_hwm()
+            record = _Stage(name)
+            self._open.append(record)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - record.wall
+            cpu = _cpu_time() - record.cpu
+            with self._lock:
+                self._fold_hwm()
+                self._open.remove(record)
+                entry = self.stages.setdefault(name, {"calls": 0, "wall_sec": 0.0, "cpu_sec": 0.0,
+                                                      "peak_rss_bytes": 0})
+                entry["calls"] += 1
+                entry["wall_sec"] += wall
+                entry["cpu_sec"] += cpu
+                entry["peak_rss_bytes"] = max(entry["peak_rss_bytes"], record.peak)
+
+    def count(self, name, n=1):
+        """Adds `n` to counter `name`."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def summary(self):
+        """JSON-ready dict of all stages (in first-run order) and counters."""
+        wall, cpu = time.perf_counter() - self._t0[0], _cpu_time() - self._t0[1]
+        with self._lock:
+            self._fold_hwm()
+            stages = {name: {"calls": s["calls"],
+                             "wall_sec": round(s["wall_sec"], 6),
+                             "cpu_sec": round(s["cpu_sec"], 6),
+                             "peak_rss_mb": round(s["peak_rss_bytes"] / 2**20, 1)}
+                      for name, s in self.stages.items()}
+            counters = dict(self.counters)
+        return {
+            "total_wall_sec": round(getattr(self, "total_wall_sec", wall), 6),
+            "total_cpu_sec": round(getattr(self, "total_cpu_sec", cpu), 6),
+            "peak_rss_mb": round(self._peak / 2**20, 1),
+            "peak_rss_scope": "stage" if self._per_stage_rss else "process" if resource else "unavailable",
+            "stages": stages,
+            "counters": counters,
+            "cprofile_dump": self.cprofile_path,
+        }
+
+
+def active_profile():
+    """The open RunProfile, or None."""
+    return _active
+
+
+def stage(name):
+    """Context manager timing `name` in the active profile (no-op without one)."""
+    return _active.stage(name) if _active is not None else contextlib.nullcontext()
+
+
+def count(name, n=1):
+    """Adds `n` to counter `name` in the active profile (no-op without one)."""
+    if _active is not None:
+        _active.count(name, n)
@@ -0,0 +1,152 @@
+# =============================================================================
+# Progress reporting and cancellation of a subject run
+#
+# The pipeline reports where it is (stage, windows or samples done, ETA) and
+# checks for cancellation through the module-level helpers below. They send
+# to the active ProgressReporter and do nothing when none is active, exactly
+# like the stage() / count() helpers of kqeeg.profiling, so batch and
+# library runs are unaffected.
+#
+# A reporter hands every message (a small dict) to a callback, e.g. the
+# put() of a queue read by the GUI (kqeeg.background). Updates are
+# throttled to one per `min_interval` seconds; result blocks passed along
+# for live plotting are buffered in between, so none is lost.
+#
+# One reporter is active per process (as one RunProfile is); worker threads
+# of the run (loading, window computation) report into it.
+# =============================================================================
+
+import threading
+import time
+
+import numpy as np
+
+# Minimum time between two progress messages
+DEFAULT_INTERVAL_SEC = 0.2
+
+# Columns of the result blocks forwarded for live plotting
+PLOT_COLUMNS = ("t_mid_sec", "KQ_naive", "C_naive", "H_norm_naive")
+
+_active = None
+
+
+class Cancelled(Exception):
+    """Raised inside a run whose cancellation was requested."""
+
+
+class ProgressReporter:
+    """
+    Progress messages and cancellation of one run.
+
+    Use as a context manager; while it is open it is the active reporter
+    the module-level helpers send to.
+
+    Args:
+        callback (callable): Called with every message dict.
+        cancel_event: Object with is_set() (threading / multiprocessing
+            Event); when set, the next check_cancelled() raises Cancelled.
+        min_interval (float): Minimum seconds between progress messages.
+
+    Messages have a "kind":
+        "stage"     {"stage"}: the run entered a stage (load, window, output)
+        "progress"  {"stage", "done", "total", "unit", "eta_sec", "block"}:
+                    `block` holds the PLOT_COLUMNS of the windows finished
+                    since the previous message (or None)
+        anything passed to publish(), e.g. "loaded" with the phases
+    """
+
+    def __init__(self, callback, cancel_event=None, min_interval=DEFAULT_INTERVAL_SEC):
+        self.callback = callback
+        self.cancel_event = cancel_event
+        self.min_interval = min_interval
+        self.stage = None
+        self._stage_t0 = None
+        self._last_sent = float("-inf")
+        self._blocks = []
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self._flush_blocks()
+        _active = self._previous
+        return False
+
+    def set_stage(self, name):
+        """Starts stage `name` (the ETA is measured from here)."""
+        with self._lock:
+            self._flush_blocks()
+            self.stage, self._stage_t0 = name, time.perf_counter()
+            self._last_sent = float("-inf")
+        self.callback({"kind": "stage", "stage": name})
+
+    def advance(self, done, total, unit="windows", block=None):
+        """Reports `done` of `total` units; `block` (column -> array) is kept for plotting."""
+        now = time.perf_counter()
+        with self._lock:
+            if block is not None:
+                self._blocks.append({name: np.asarray(block[name]) for name in PLOT_COLUMNS})
+            if now - self._last_sent < self.min_interval and done < total:
+                return
+            self._last_sent = now
+            elapsed = now - (self._stage_t0 if self._stage_t0 is not None else now)
+            eta = elapsed / done * (total - done) if done > 0 else None
+            message = {"kind": "progress", "stage": self.stage, "done": int(done), "total": int(total),
+                       "unit": unit, "eta_sec": eta, "block": self._take_blocks()}
+        self.callback(message)
+
+    def publish(self, kind, **fields):
+        """Sends an arbitrary message of `kind`."""
+        self.callback({"kind": kind, **fields})
+
+    def check(self):
+        """Raises Cancelled if cancellation was requested."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise Cancelled("Analysis cancelled")
+
+    def _take_blocks(self):
+        if not self._blocks:
+            return None
+        blocks, self._blocks = self._blocks, []
+        return {name: np.concatenate([b[name] for b in blocks]) for name in PLOT_COLUMNS}
+
+    def _flush_blocks(self):
+        """Sends buffered plot blocks that no progress message carried yet."""
+        block = self._take_blocks()
+        if block is not None:
+            self.callback({"kind": "progress", "stage": self.stage, "done": None, "total": None, "unit": None,
+                           "eta_sec": None, "block": block})
+
+
+def active_reporter():
+    """The open ProgressReporter, or None."""
+    return _active
+
+
+def set_stage(name):
+    """Reports the start of stage `name` (no-op without an active reporter)."""
+    if _active is not None:
+        _active.set_stage(name)
+
+
+def advance(done, total, unit="windows", block=None):
+    """Reports progress within the current stage (no-op without an active reporter)."""
+    if _active is not None:
+        _active.advance(done, total, unit, block)
+
+
+def publish(kind, **fields):
+    """Sends a message of `kind` (no-op without an active reporter)."""
+    if _active is not None:
+        _active.publish(kind, **fields)
+
+
+def check_cancelled():
+    """Raises Cancelled when the active run was cancelled (no-op without a reporter)."""
+    if _active is not None:
+        _active.check()
@@ -0,0 +1,295 @@
+# =============================================================================
+# Min/max/mean decimation pyramid of the KQ, C and H_norm series
+#
+# The summary plot used to draw every window at 20x15 in / 200 dpi, so the
+# rendering time (and the size of any interactive view) grew with the
+# recording length, and overnight or cohort-length series could not be
+# explored.
+#
+# The pyramid stores the series at several resolutions: level 0 is the
+# window series itself, every level above merges PYRAMID_FACTOR consecutive
+# bins of the level below into one bin holding the min, max and mean of the
+# windows it covers (NaN windows skipped), until a level has at most
+# PYRAMID_FACTOR bins. Building it is O(n_windows) and it is written next to
+# the results as kq_pyramid.<parquet|h5|csv> (one row per bin, 'level'
+# column).
+#
+# A plot of the time range [t0, t1] reads the finest level with at most
+# `max_points` bins in that range (a binary search per level), draws the
+# min..max envelope and the mean, and re-reads on every zoom/pan, so the
+# number of points drawn is bounded whatever the recording length.
+#
+#   python -m kqeeg.pyramid <subject output folder>   # zoomable viewer
+# =============================================================================
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .liveplot import draw_phases_and_events
+from .results import DEFAULT_RESULT_FORMATS, RESULT_EXTENSIONS, read_results, write_results
+
+# Series kept in the pyramid
+PYRAMID_METRICS = ("KQ_naive", "C_naive", "H_norm_naive")
+
+# Bins of a level merged into one bin of the next level
+PYRAMID_FACTOR = 4
+
+# Bins drawn per axis at most (the summary PNG is ~3500 px wide)
+MAX_PLOT_POINTS = 2000
+
+PYRAMID_NAME = "kq_pyramid"
+
+# Axis styles of the KQ / C / H_norm panels: (metric, label, color, lw, alpha)
+PANEL_STYLES = [("KQ_naive", "KQ", "b", 2, 1.0),
+                ("C_naive", "C (Coherence)", "g", 1.5, 0.8),
+                ("H_norm_naive", "H_norm (Entropy)", "r", 1.5, 0.8)]
+
+
+def _coarsen(level, metrics, factor):
+    """Merges every `factor` consecutive bins of `level` (dict of arrays) into one."""
+    n = len(level["n_windows"])
+    groups = -(-n // factor)
+    pad = groups * factor - n
+
+    def fold(x, fill):
+        return np.concatenate([x, np.full(pad, fill, dtype=x.dtype)]).reshape(groups, factor)
+
+    n_windows = fold(level["n_windows"], 0).sum(axis=1)
+    out = {
+        "t_start_sec": level["t_start_sec"][::factor],
+        "t_end_sec": fold(level["t_end_sec"], -np.inf).max(axis=1),
+        "t_mid_sec": fold(level["t_mid_sec"] * level["n_windows"], 0.0).sum(axis=1) / n_windows,
+        "n_windows": n_windows,
+    }
+    for m in metrics:
+        count = fold(level[f"{m}_count"], 0)
+        total = fold(np.where(level[f"{m}_count"] > 0, level[f"{m}_mean"] * level[f"{m}_count"], 0.0), 0.0)
+        out[f"{m}_count"] = count.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[f"{m}_mean"] = total.sum(axis=1) / out[f"{m}_count"]
+        out[f"{m}_min"] = np.fmin.reduce(fold(level[f"{m}_min"], np.nan), axis=1)  # fmin/fmax skip NaN
+        out[f"{m}_max"] = np.fmax.reduce(fold(level[f"{m}_max"], np.nan), axis=1)
+    return out
+
+
+class DecimationPyramid:
+    """
+    Min/max/mean pyramid of per-window series.
+
+    Attributes:
+        levels (list): Level 0 (the windows) first; every level is a dict of
+            arrays 't_start_sec', 't_end_sec', 't_mid_sec', 'n_windows' and
+            '<metric>_min', '<metric>_max', '<metric>_mean' per metric.
+        metrics (tuple): The metric names.
+    """
+
+    def __init__(self, levels, metrics=PYRAMID_METRICS):
+        self.levels = levels
+        self.metrics = tuple(metrics)
+
+    @classmethod
+    def from_results(cls, results, metrics=PYRAMID_METRICS, factor=PYRAMID_FACTOR):
+        """
+        Builds the pyramid of `results` (DataFrame or dict with 't_start_sec',
+        't_end_sec', 't_mid_sec' and `metrics`, windows in time order).
+        """
+        t_mid = np.asarray(results["t_mid_sec"], dtype=float)
+        level = {
+            "t_start_sec": np.asarray(results["t_start_sec"], dtype=float),
+            "t_end_sec": np.asarray(results["t_end_sec"], dtype=float),
+            "t_mid_sec": t_mid,
+            "n_windows": np.ones(len(t_mid), dtype=np.int64),
+        }
+        for m in metrics:
+            values = np.asarray(results[m], dtype=float)
+            values = np.where(np.isfinite(values), values, np.nan)
+            level[f"{m}_count"] = (~np.isnan(values)).astype(np.int64)
+            level[f"{m}_mean"] = level[f"{m}_min"] = level[f"{m}_max"] = values
+        levels = [level]
+        while len(levels[-1]["n_windows"]) > factor:
+            levels.append(_coarsen(levels[-1], metrics, factor))
+        for level in levels:  # finite counts are only needed while building
+            for m in metrics:
+                del level[f"{m}_count"]
+        return cls(levels, metrics)
+
+    @classmethod
+    def from_table(cls, table):
+        """The pyramid of a table written by to_table (e.g. read_pyramid)."""
+        metrics = tuple(c[:-len("_mean")] for c in table.columns if c.endswith("_mean"))
+        level_ids = table["level"].to_numpy()
+        n_levels = int(level_ids.max()) + 1 if len(level_ids) else 1
+        bounds = np.searchsorted(level_ids, np.arange(n_levels + 1))
+        levels = [{c: table[c].to_numpy()[lo:hi] for c in table.columns if c != "level"}
+                  for lo, hi in zip(bounds[:-1], bounds[1:])]
+        return cls(levels, metrics)
+
+    def to_table(self):
+        """All levels as one long DataFrame with a leading 'level' column."""
+        frames = [pd.DataFrame({"level": np.full(len(level["n_windows"]), i, dtype=np.int32), **level})
+                  for i, level in enumerate(self.levels)]
+        return pd.concat(frames, ignore_index=True)
+
+    @property
+    def n_windows(self):
+        return len(self.levels[0]["n_windows"])
+
+    @property
+    def t_range(self):
+        """(first window start, last window end) in seconds."""
+        level = self.levels[-1]
+        if not len(level["n_windows"]):
+            return 0.0, 0.0
+        return float(level["t_start_sec"][0]), float(level["t_end_sec"][-1])
+
+    def value_range(self, metric):
+        """(min, max) of `metric` over all windows (NaN when none is finite)."""
+        level = self.levels[-1]
+        if not len(level["n_windows"]):
+            return np.nan, np.nan
+        return float(np.fmin.reduce(level[f"{metric}_min"])), float(np.fmax.reduce(level[f"{metric}_max"]))
+
+    def _bounds(self, level, t0, t1):
+        """Bins of `level` overlapping [t0, t1], plus one on each side (so lines reach the edges)."""
+        t_mid = self.levels[level]["t_mid_sec"]
+        lo = max(int(np.searchsorted(t_mid, t0, side="left")) - 1, 0)
+        hi = min(int(np.searchsorted(t_mid, t1, side="right")) + 1, len(t_mid))
+        return lo, hi
+
+    def level_for(self, t0, t1, max_points=MAX_PLOT_POINTS):
+        """Finest level with at most `max_points` bins in [t0, t1]."""
+        for level in range(len(self.levels)):
+            lo, hi = self._bounds(level, t0, t1)
+            if hi - lo <= max_points:
+                return level
+        return len(self.levels) - 1
+
+    def view(self, t0, t1, max_points=MAX_PLOT_POINTS):
+        """
+        The bins to draw for the time range [t0, t1].
+
+        Returns:
+            tuple: (level, dict of array slices of that level).
+        """
+        level = self.level_for(t0, t1, max_points)
+        lo, hi = self._bounds(level, t0, t1)
+        return level, {name: values[lo:hi] for name, values in self.levels[level].items()}
+
+
+def write_pyramid(pyramid, out_dir, formats=DEFAULT_RESULT_FORMATS, float32=False, compression=None):
+    """Writes kq_pyramid.<ext> into `out_dir`; returns the written paths."""
+    return write_results(pyramid.to_table(), os.path.join(out_dir, PYRAMID_NAME), formats, float32, compression)
+
+
+def read_pyramid(out_dir):
+    """The pyramid stored in a subject output folder (None when there is none)."""
+    for ext in RESULT_EXTENSIONS.values():
+        path = os.path.join(out_dir, PYRAMID_NAME + ext)
+        if os.path.exists(path):
+            return DecimationPyramid.from_table(read_results(path))
+    return None
+
+
+class PyramidPlot:
+    """
+    KQ / C / H_norm panels drawn from a pyramid: the min..max envelope and
+    the mean of the level matching the visible time range, re-read whenever
+    the x range changes (zoom, pan).
+
+    Args:
+        axes (list): One axis per PANEL_STYLES entry, sharing x.
+        pyramid (DecimationPyramid): The series.
+        max_points (int): Bins drawn per axis at most.
+    """
+
+    def __init__(self, axes, pyramid, max_points=MAX_PLOT_POINTS):
+        self.axes = list(axes)
+        self.pyramid = pyramid
+        self.max_points = max_points
+        self.level = None
+        self.lines, self.envelopes = [], []
+        for ax, (metric, label, color, lw, alpha) in zip(self.axes, PANEL_STYLES):
+            line, = ax.plot([], [], color=color, lw=lw, alpha=alpha, label=label)
+            self.lines.append(line)
+            self.envelopes.append(None)
+        t0, t1 = pyramid.t_range
+        self.axes[0].set_xlim(t0, max(t1, t0 + 1e-9))
+        self.update(t0, t1)
+        self.axes[0].callbacks.connect("xlim_changed", self._on_xlim)
+
+    def update(self, t0, t1):
+        """Draws the bins of the level matching [t0, t1]."""
+        self.level, bins = self.pyramid.view(t0, t1, self.max_points)
+        for i, (ax, (metric, _, color, _, _)) in enumerate(zip(self.axes, PANEL_STYLES)):
+            self.lines[i].set_data(bins["t_mid_sec"], bins[f"{metric}_mean"])
+            if self.envelopes[i] is not None:
+                self.envelopes[i].remove()
+            self.envelopes[i] = None
+            if self.level > 0:  # level 0 has min == max
+                self.envelopes[i] = ax.fill_between(bins["t_mid_sec"], bins[f"{metric}_min"], bins[f"{metric}_max"],
+                                                    color=color, alpha=0.25, lw=0)
+
+    def _on_xlim(self, ax):
+        self.update(*ax.get_xlim())
+        ax.figure.canvas.draw_idle()
+
+
+def plot_pyramid(pyramid, phases, events, title, max_points=MAX_PLOT_POINTS, figsize=(20, 15)):
+    """
+    The 3-panel KQ / C / H_norm figure with phases and events.
+
+    Returns:
+        tuple: (fig, axes, PyramidPlot).
+    """
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(3, 1, figsize=figsize, sharex=True)
+    fig.suptitle(title, fontsize=16)
+    plot = PyramidPlot(axes, pyramid, max_points)
+    for ax, (_, label, _, _, _) in zip(axes, PANEL_STYLES):
+        ax.set_ylabel(label, fontsize=12)
+        ax.legend(loc='upper left')
+        ax.grid(True)
+    axes[2].set_xlabel("Time (s)", fontsize=12)
+
+    # Sane Y-limits: KQ from its range, C and H_norm are 0-1
+    kq_max = pyramid.value_range("KQ_naive")[1] if "KQ_naive" in pyramid.metrics else np.nan
+    axes[0].set_ylim(-0.1, kq_max + 0.1 if np.isfinite(kq_max) and kq_max + 0.1 > 0 else 1.1)
+    axes[1].set_ylim(-0.1, 1.1)
+    axes[2].set_ylim(-0.1, 1.1)
+
+    draw_phases_and_events(axes, phases, events, fontsize=10, dream_fontsize=12, dream_y=0.85,
+                           dream_weight='bold')
+    return fig, axes, plot
+
+
+def main(argv=None):
+    import matplotlib.pyplot as plt
+    parser = argparse.ArgumentParser(description="Zoomable KQ / C / H_norm view of a subject output folder.")
+    parser.add_argument("out_dir", help="Subject output folder (holds kq_pyramid.*)")
+    parser.add_argument("--max-points", type=int, default=MAX_PLOT_POINTS, help="Bins drawn per axis at most")
+    args = parser.parse_args(argv)
+
+    pyramid = read_pyramid(args.out_dir)
+    if pyramid is None:
+        parser.error(f"No {PYRAMID_NAME} table in {args.out_dir}")
+    phases, subject_id = [], ""
+    meta_path = os.path.join(args.out_dir, "run_metadata.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        phases, subject_id = meta.get("phases_loaded", []), meta.get("subject_id", "")
+    events_path = os.path.join(args.out_dir, "events_full_synchronized.tsv")
+    events = pd.read_csv(events_path, sep='\t') if os.path.exists(events_path) else pd.DataFrame()
+
+    fig, _, _ = plot_pyramid(pyramid, phases, events, f"KQ, C, H_norm + Events — sub-{subject_id}",
+                             args.max_points, figsize=(16, 12))
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# =============================================================================
+# Columnar result files
+#
+# The per-window table used to be written only as kq_timeseries_hybrid.csv,
+# i.e. every float64 as a ~20 character repr string that has to be parsed
+# back in full. Results are now written to a columnar binary format:
+#
+#   parquet  kq_timeseries_hybrid.parquet (pyarrow, zstd-compressed)
+#   hdf5     kq_timeseries_hybrid.h5      (h5py, one compressed dataset per column)
+#   csv      kq_timeseries_hybrid.csv     (opt-in, the previous text format)
+#
+# Both binary formats can be read one column at a time (read_results). With
+# float32=True, every metric column is stored as float32; the time columns
+# stay float64 so window times remain exact.
+# =============================================================================
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# Formats written when none are requested
+DEFAULT_RESULT_FORMATS = ("parquet",)
+
+RESULT_EXTENSIONS = {"parquet": ".parquet", "hdf5": ".h5", "csv": ".csv"}
+
+# Default compression per format
+DEFAULT_COMPRESSION = {"parquet": "zstd", "hdf5": "gzip"}
+
+# Never downcast (window times must stay exact)
+FLOAT64_COLUMNS = ("t_start_sec", "t_end_sec", "t_mid_sec", "win_sec", "overlap_perc")
+
+
+def _downcast(df):
+    """float64 columns -> float32, except FLOAT64_COLUMNS."""
+    return df.astype({name: np.float32 for name in df.columns
+                      if df[name].dtype == np.float64 and name not in FLOAT64_COLUMNS})
+
+
+def write_results(df, path_base, formats=DEFAULT_RESULT_FORMATS, float32=False, compression=None):
+    """
+    Writes a per-window table in one or more formats.
+
+    Args:
+        df (pd.DataFrame): Per-window results.
+        path_base (str): Output path without extension
+            (e.g. '<out_dir>/kq_timeseries_hybrid').
+        formats (iterable): Any of "parquet", "hdf5", "csv".
+        float32 (bool): Store metric columns as float32 (binary formats).
+        compression (str): Codec for the binary formats. Defaults to
+            zstd (Parquet) and gzip (HDF5).
+
+    Returns:
+        list: The written file paths.
+    """
+    unknown = set(formats) - set(RESULT_EXTENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown result format(s): {sorted(unknown)} (expected {list(RESULT_EXTENSIONS)})")
+
+    paths = []
+    binary = _downcast(df) if float32 else df
+    for fmt in formats:
+        path = path_base + RESULT_EXTENSIONS[fmt]
+        codec = compression or DEFAULT_COMPRESSION.get(fmt)
+        if fmt == "csv":
+            df.to_csv(path, index=False)
+        elif fmt == "parquet":
+            try:
+                binary.to_parquet(path, index=False, compression=codec)
+            except ImportError as e:
+                raise ImportError("Parquet output needs pyarrow (pip install pyarrow), "
+                                  "or choose another format") from e
+        else:
+            _write_hdf5(binary, path, codec)
+        paths.append(path)
+    return paths
+
+
+def _write_hdf5(df, path, compression):
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError("HDF5 output needs h5py (pip install h5py), or choose another format") from e
+    with h5py.File(path, "w") as f:
+        f.attrs["columns"] = list(df.columns)
+        for name in df.columns:
+            values = df[name].to_numpy()
+            dtype = None
+            if values.dtype == object:  # labels (e.g. trial_type) as UTF-8 strings
+                values, dtype = values.astype(str).astype(object), h5py.string_dtype()
+            f.create_dataset(name, data=values, dtype=dtype, compression=compression,
+                             shuffle=compression is not None, chunks=True if len(values) else None)
+
+
+def read_results(path, columns=None):
+    """
+    Reads a table written by write_results; only `columns` are read.
+
+    Args:
+        path (str): A .parquet, .h5 or .csv result file.
+        columns (list): Column names to read (None = all).
+
+    Returns:
+        pd.DataFrame: The requested columns, in file order.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return pd.read_parquet(path, columns=columns)
+    if ext in (".h5", ".hdf5"):
+        import h5py
+        with h5py.File(path, "r") as f:
+            names = [str(name) for name in f.attrs["columns"]]
+            if columns is not None:
+                names = [name for name in names if name in set(columns)]
+            return pd.DataFrame({name: f[name].asstr()[()] if f[name].dtype.kind == "O" else f[name][()]
+                                 for name in names})
+    return pd.read_csv(path, usecols=columns)
@@ -0,0 +1,376 @@
+# =============================================================================
+# Streaming subject loader with stateful band-pass filtering
+#
+# The original loader preloaded every run, resampled it, concatenated all
+# runs (mne.concatenate_raws), copied the result out with get_data() and
+# filtered the whole array with lfilter, which allocates yet another copy:
+# peak memory was several times the recording size.
+#
+# SubjectStream reads only the run headers up front (channels, lengths,
+# phase boundaries, events) and then yields the filtered recording as
+# consecutive (channels, samples) blocks, run by run. The Butterworth state
+# (lfilter `zi`) is carried across block AND run boundaries, so the
+# concatenated blocks equal the one-shot `lfilter(b, a, data)` of the
+# concatenated recording.
+#
+# Channels are narrowed to the common EEG set on the headers, so only those
+# are ever read. Runs already at TARGET_SFREQ are read from disk block by
+# block. Runs that need resampling are loaded whole (common channels only),
+# because both resamplers work on a whole run:
+#
+#   "fft"        raw.resample (MNE's FFT resampler), the original behaviour
+#   "polyphase"  scipy.signal.resample_poly, for integer-related rates
+#                (e.g. 5000 -> 500 Hz); faster, slightly different
+#                anti-aliasing, and ceil(n * up / down) output samples
+#
+# With load_jobs > 1 the runs are read and resampled in a thread pool (file
+# parsing, FFTs and the polyphase filter release the GIL), up to load_jobs
+# runs ahead of the one being filtered. The band-pass itself stays
+# sequential, so the output is identical to a one-run-at-a-time load. Every
+# run in flight is held whole, so a recording analyzed while it streams
+# (run_subject(stream=True)) is read with STREAM_LOAD_JOBS = 1: its memory is
+# then bounded by one resampled run plus the blocks being analyzed.
+#
+# precision="float32" stores the filtered signal as float32 (the filter
+# itself still runs in float64); the window metrics then compute their FFTs
+# in complex64 (see kqeeg.metrics). It halves the recording in memory.
+# =============================================================================
+
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+import numpy as np
+
+from .profiling import count, stage
+from .progress import advance, check_cancelled
+
+# Sampling rate every run is resampled to
+TARGET_SFREQ = 500.0
+
+# Band-pass applied before the analysis (5th-order Butterworth, causal)
+FILTER_BAND_HZ = (0.5, 45.0)
+FILTER_ORDER = 5
+
+# Approximate size of one streamed block
+DEFAULT_BLOCK_BYTES = 64 * 2**20
+
+# Runs read and resampled concurrently (each one is held whole while in flight)
+DEFAULT_LOAD_JOBS = min(4, os.cpu_count() or 1)
+
+# Runs in flight when a recording is analyzed while it streams: resampled runs
+# are held whole, so more would multiply the memory streaming is meant to bound
+STREAM_LOAD_JOBS = 1
+
+RESAMPLERS = ("fft", "polyphase")
+
+# Storage/computation precision of the filtered signal
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+
+# Largest up/down factor the polyphase resampler is used with
+MAX_POLYPHASE_FACTOR = 1000
+
+
+def run_order(subject_id):
+    """
+    The eight BrainVision runs of a subject, in concatenation order.
+
+    Returns:
+        list: (phase_name, vhdr_filename) tuples.
+    """
+    return [
+        ("awake_EC", f"sub-{subject_id}_task-awake_acq-EC_eeg.vhdr"),
+        ("awake_EO", f"sub-{subject_id}_task-awake_acq-EO_eeg.vhdr"),
+        ("sed_run1", f"sub-{subject_id}_task-sed_acq-rest_run-1_eeg.vhdr"),
+        ("sed_run2", f"sub-{subject_id}_task-sed_acq-rest_run-2_eeg.vhdr"),
+        ("sed_run3", f"sub-{subject_id}_task-sed_acq-rest_run-3_eeg.vhdr"),
+        ("pre_run1", f"sub-{subject_id}_task-sed2_acq-rest_run-1_eeg.vhdr"),
+        ("pre_run2", f"sub-{subject_id}_task-sed2_acq-rest_run-2_eeg.vhdr"),
+        ("pre_run3", f"sub-{subject_id}_task-sed2_acq-rest_run-3_eeg.vhdr"),
+    ]
+
+
+def load_events(eeg_path, subject_id):
+    """
+    Reads the events .tsv files of the sedation runs (task, run columns added).
+
+    Returns:
+        pd.DataFrame: All events (empty if there are none).
+    """
+    import pandas as pd
+    events_all = []
+    for task in ["sed", "sed2"]:
+        for run in [1, 2, 3]:
+            tsv_path = os.path.join(eeg_path, f"sub-{subject_id}_task-{task}_acq-rest_run-{run}_events.tsv")
+            if os.path.exists(tsv_path):
+                try:
+                    df = pd.read_csv(tsv_path, sep='\t')
+                    df['task'] = task
+                    df['run'] = run
+                    events_all.append(df)
+                except Exception as e:
+                    print(f"Warning: Could not read events file {tsv_path}: {e}")
+
+    return pd.concat(events_all, ignore_index=True) if events_all else pd.DataFrame()
+
+
+def synchronize_events(events_df, phase_labels):
+    """Adds 'onset_global' (onset on the concatenated time axis) in place."""
+    if not events_df.empty and 'onset' in events_df.columns:
+        print("Synchronizing event times...")
+        run_starts = {name: s for s, e, name in phase_labels}
+        # Phase of every event: sed -> sed_run<r>, sed2 -> pre_run<r> (whole column at once)
+        runs = events_df['run'].astype(str)
+        phase_name = ("pre_run" + runs).where(events_df['task'] == "sed2", events_df['task'].astype(str) + "_run" + runs)
+        start_time = phase_name.map(run_starts).fillna(0)
+        events_df['onset_global'] = start_time + events_df['onset']
+    return events_df
+
+
+def polyphase_factors(sfreq, target_sfreq=TARGET_SFREQ):
+    """
+    (up, down) with target_sfreq / sfreq == up / down for integer rates,
+    or None when the rates are not integer-related closely enough.
+    """
+    if not (float(sfreq).is_integer() and float(target_sfreq).is_integer()):
+        return None
+    ratio = Fraction(int(target_sfreq), int(sfreq))
+    if max(ratio.numerator, ratio.denominator) > MAX_POLYPHASE_FACTOR:
+        return None
+    return ratio.numerator, ratio.denominator
+
+
+def resampled_length(n_samples, sfreq, target_sfreq=TARGET_SFREQ, resampler="fft"):
+    """Number of samples a run of `n_samples` has after resampling."""
+    if sfreq == target_sfreq:
+        return n_samples
+    factors = polyphase_factors(sfreq, target_sfreq) if resampler == "polyphase" else None
+    if factors is not None:
+        up, down = factors
+        return -(-n_samples * up // down)  # resample_poly: ceil(n * up / down)
+    return max(int(round(float(target_sfreq) / sfreq * n_samples)), 1)
+
+
+def precision_dtype(precision):
+    """numpy dtype of a precision name ("float64" or "float32")."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision!r} (expected one of {tuple(PRECISIONS)})")
+    return np.dtype(PRECISIONS[precision])
+
+
+class BandpassFilter:
+    """
+    Causal Butterworth band-pass applied block by block.
+
+    The lfilter state is kept between calls, so filtering consecutive
+    blocks gives the same output as filtering their concatenation at once.
+
+    Args:
+        sfreq (float): Sampling rate in Hz.
+        n_channels (int): Number of channels (rows) of every block.
+        band (tuple): (low, high) cut-offs in Hz.
+        order (int): Butterworth order.
+    """
+
+    def __init__(self, sfreq, n_channels, band=FILTER_BAND_HZ, order=FILTER_ORDER):
+        from scipy.signal import butter
+        nyq = 0.5 * sfreq
+        self.b, self.a = butter(order, [band[0] / nyq, band[1] / nyq], btype='band')
+        self.n_channels = n_channels
+        self.reset()
+
+    def reset(self):
+        """Back to the zero initial state of a one-shot lfilter call."""
+        self.zi = np.zeros((self.n_channels, max(len(self.a), len(self.b)) - 1))
+
+    def __call__(self, block):
+        from scipy.signal import lfilter
+        out, self.zi = lfilter(self.b, self.a, block, axis=1, zi=self.zi)
+        return out
+
+
+class SubjectStream:
+    """
+    Filtered recording of one subject, yielded as (channels, samples) blocks.
+
+    Only the headers are read on construction. Iterating reads, resamples
+    (if needed) and filters the runs in order; every iteration starts from
+    a fresh filter state. `shape`, `phase_labels`, `duration` and
+    `events_df` are known before any sample is read.
+
+    Args:
+        dataset_path (str): The path to the root of the dataset (e.g., '.../ds005620').
+        subject_id (str): The subject identifier (e.g., '1022').
+        block_bytes (int): Approximate size of one yielded block.
+        sfreq (float): Sampling rate every run is resampled to.
+        load_jobs (int): Runs read and resampled concurrently (1 = one
+            run at a time, lowest memory).
+        resampler (str): "fft" (MNE, default) or "polyphase" (scipy
+            resample_poly where the rates are integer-related, FFT otherwise).
+        precision (str): dtype of the filtered blocks, "float64" (default)
+            or "float32".
+    """
+
+    def __init__(self, dataset_path, subject_id, block_bytes=DEFAULT_BLOCK_BYTES, sfreq=TARGET_SFREQ,
+                 load_jobs=DEFAULT_LOAD_JOBS, resampler="fft", precision="float64"):
+        if resampler not in RESAMPLERS:
+            raise ValueError(f"Unknown resampler: {resampler!r} (expected one of {RESAMPLERS})")
+        import mne
+        from tqdm import tqdm
+        self.subject_id = subject_id
+        self.sfreq = float(sfreq)
+        self.load_jobs = max(1, int(load_jobs or 1))
+        self.resampler = resampler
+        self.precision = precision
+        self.dtype = precision_dtype(precision)
+        eeg_path = os.path.join(dataset_path, f"sub-{subject_id}", "eeg")
+
+        # --- Load all event files ---
+        self.events_df = load_events(eeg_path, subject_id)
+
+        # --- Read the run headers (no samples yet) ---
+        print("Reading EEG headers...")
+        self._raws = []         # header-only Raw objects, in concatenation order
+        self._run_lengths = []  # samples per run after resampling
+        self.phase_labels = []  # (start, end, name) for plotting
+        current_t = 0.0         # Global time tracker
+        for phase_name, fname in tqdm(run_order(subject_id), desc="Reading headers"):
+            path = os.path.join(eeg_path, fname)
+            if not os.path.exists(path):
+                print(f"Warning: File not found, skipping: {fname}")
+                continue
+            try:
+                with stage("load/read_header"):
+                    raw = mne.io.read_raw_brainvision(path, preload=False, verbose=False)
+                    raw.pick_types(eeg=True, exclude='bads')
+                count("files_read")
+                n_samples = resampled_length(raw.n_times, raw.info['sfreq'], self.sfreq, resampler)
+                duration = (n_samples - 1) / self.sfreq
+                self._raws.append(raw)
+                self._run_lengths.append(n_samples)
+                self.phase_labels.append((current_t, current_t + duration, phase_name))
+                current_t += duration
+            except Exception as e:
+                print(f"Error loading {fname}: {e}")
+
+        if not self._raws:
+            raise FileNotFoundError(f"No EEG data loaded for subject {subject_id}. Check path: {eeg_path}")
+
+        # --- Mismatched channels: keep those common to all runs ---
+        common_channels = set(self._raws[0].ch_names)
+        for r in self._raws[1:]:
+            common_channels.intersection_update(r.ch_names)
+        common_channels_list = sorted(list(common_channels))
+
+        # Coherence needs at least 2 channels left
+        if len(common_channels_list) < 2:
+            raise ValueError(f"Analysis failed: Coherence calculation requires at least 2 common EEG channels across all files.\n"
+                             f"This subject ({subject_id}) only has {len(common_channels_list)} common channel(s): {common_channels_list}")
+
+        print(f"Found {len(common_channels_list)} common channels. Forcing all files to match...")
+        with stage("load/pick_channels"):
+            for raw in self._raws:
+                raw.pick_channels(common_channels_list)
+        self.ch_names = list(self._raws[0].ch_names)
+        self.n_channels = len(self.ch_names)
+        self.n_samples = int(sum(self._run_lengths))
+        self.duration = (self.n_samples - 1) / self.sfreq
+        self.block_samples = max(1, int(block_bytes // (self.n_channels * 8)))
+
+        # --- Correct event times ---
+        with stage("load/event_sync"):
+            synchronize_events(self.events_df, self.phase_labels)
+
+    @property
+    def shape(self):
+        """(channels, samples) of the whole filtered recording."""
+        return (self.n_channels, self.n_samples)
+
+    def _load_run(self, raw, n_samples):
+        """One whole run at self.sfreq (common channels only), as an array."""
+        factors = polyphase_factors(raw.info['sfreq'], self.sfreq) if self.resampler == "polyphase" else None
+        if raw.info['sfreq'] == self.sfreq or factors is not None:
+            with stage("load/read"):
+                data = raw.get_data()
+            count("samples_read", data.shape[1])
+            if factors is not None:
+                from scipy.signal import resample_poly
+                with stage("load/resample"):
+                    data = resample_poly(data, *factors, axis=1)
+        else:
+            with stage("load/read"):
+                raw = raw.copy().load_data(verbose=False)
+            count("samples_read", raw.n_times)
+            with stage("load/resample"):
+                raw.resample(self.sfreq, npad="auto", verbose=False)
+            data = raw.get_data()
+        if data.shape[1] != n_samples:
+            raise RuntimeError(f"Run length changed while streaming: {data.shape[1]} != {n_samples} samples")
+        return data
+
+    def _run_blocks(self, raw, n_samples):
+        """Unfiltered blocks of one run at self.sfreq."""
+        if raw.info['sfreq'] != self.sfreq:
+            # The resamplers need the whole run
+            data = self._load_run(raw, n_samples)
+            for s0 in range(0, n_samples, self.block_samples):
+                yield data[:, s0:s0 + self.block_samples]
+            return
+        if raw.n_times != n_samples:
+            raise RuntimeError(f"Run length changed while streaming: {raw.n_times} != {n_samples} samples")
+        for s0 in range(0, n_samples, self.block_samples):
+            with stage("load/read"):
+                block = raw.get_data(start=s0, stop=min(s0 + self.block_samples, n_samples))
+            count("samples_read", block.shape[1])
+            yield block
+
+    def raw_blocks(self):
+        """Yields the resampled, channel-aligned recording BEFORE filtering."""
+        runs = zip(self._raws, self._run_lengths)
+        if self.load_jobs == 1 or len(self._raws) == 1:
+            for raw, n_samples in runs:
+                yield from self._run_blocks(raw, n_samples)
+            return
+
+        # Whole runs are loaded up to load_jobs ahead, and yielded in order
+        pool = ThreadPoolExecutor(self.load_jobs, thread_name_prefix="kqeeg-load")
+        try:
+            pending = deque((pool.submit(self._load_run, raw, n), n)
+                            for raw, n in itertools.islice(runs, self.load_jobs))
+            while pending:
+                future, n_samples = pending.popleft()
+                data = future.result()
+                for raw, n in itertools.islice(runs, 1):
+                    pending.append((pool.submit(self._load_run, raw, n), n))
+                for s0 in range(0, n_samples, self.block_samples):
+                    yield data[:, s0:s0 + self.block_samples]
+                del data
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def __iter__(self):
+        """Yields the band-passed recording as consecutive (channels, n) blocks."""
+        filt = BandpassFilter(self.sfreq, self.n_channels)
+        for block in self.raw_blocks():
+            check_cancelled()
+            with stage("load/filter"):
+                block = filt(block).astype(self.dtype, copy=False)
+            yield block
+
+    def read(self):
+        """
+        Reads the whole filtered recording into one array.
+
+        Returns:
+            np.ndarray: (channels, samples), allocated once and filled block by block.
+        """
+        data = np.empty(self.shape, dtype=self.dtype)
+        pos = 0
+        for block in self:
+            with stage("load/concatenate"):
+                data[:, pos:pos + block.shape[1]] = block
+            pos += block.shape[1]
+            advance(pos, self.n_samples, "samples")
+        return data
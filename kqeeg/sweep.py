@@ -0,0 +1,228 @@
+# =============================================================================
+# Window/overlap parameter sweeps in one pass
+#
+# A sensitivity study used to rerun the whole pipeline once per window
+# setting. Here the filtered signal is loaded once and windows that occur in
+# several settings (same length and start, e.g. every 50%-overlap window is
+# also a 75%-overlap window) are computed once, so the cost grows with the
+# number of DISTINCT windows only.
+#
+# In the default exact mode every distinct window gets its periodogram and
+# coherence exactly as in a normal run, so each setting's values are those
+# of a single run with that setting (bit for bit). In accumulator mode the
+# distinct windows are fed to ONE SlidingSpectralAccumulator pass (each grid
+# segment FFT'd once, one running sum per window length, C and PSD from the
+# grid) and ONE prefix-sum pass for the time-domain metrics, so a window
+# costs about one step of segments whatever its length. Its coherence grid
+# hop divides every setting's step (kqeeg.accumulator.aligned_hop), so C may
+# differ from a single accumulator-mode run of a setting whose own hop would
+# differ. "accumulator_window_psd" adds the window-long periodogram of every
+# distinct window for exact-mode band powers and H_norm, a cost that grows
+# with the window length again. Windows shorter than one grid segment are
+# computed as in exact mode.
+# =============================================================================
+
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .accumulator import SlidingSpectralAccumulator, aligned_hop, window_moments
+from .metrics import (DEFAULT_BLOCK_BYTES, METRIC_COLUMNS, SPECTRAL_MODES, _assemble, grid_psd_means,
+                      iter_exact_metrics_at, window_psd_means, window_starts)
+from .pipeline import add_derived_metrics
+from .profiling import active_profile, count, stage
+from .results import DEFAULT_RESULT_FORMATS, write_results
+from .spectral import COH_NPERSEG, DEFAULT_COH_CHANNELS
+
+
+def sweep_settings(win_secs, overlaps):
+    """
+    Every (win_sec, overlap_perc) combination of a grid.
+
+    Example:
+        sweep_settings([1, 2, 4, 8], [0, 50, 75]) gives 12 settings.
+    """
+    return [(float(w), float(o)) for w, o in itertools.product(win_secs, overlaps)]
+
+
+def _geometry(settings, sfreq):
+    """(win_samples, step) per setting, computed as in analyze_with_events."""
+    geometry = []
+    for win_sec, overlap_perc in settings:
+        win_samples = int(win_sec * sfreq)
+        step = int(win_samples * (1 - overlap_perc / 100))
+        if win_samples < 1 or step < 1:
+            raise ValueError(f"Invalid window setting: {win_sec} s at {overlap_perc}% overlap")
+        geometry.append((win_samples, step))
+    return geometry
+
+
+def sweep_window_metrics(data, sfreq, settings, coh_channels=DEFAULT_COH_CHANNELS, spectral_mode="exact",
+                         block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Per-window metrics for many window settings at once.
+
+    Args:
+        data (np.ndarray): Filtered signal (channels, samples).
+        sfreq (float): Sampling rate in Hz.
+        settings (list): (win_sec, overlap_perc) tuples (see sweep_settings).
+        coh_channels (int or None): Leading channels used for C (None = all).
+        spectral_mode (str): "exact" (default, the values of a normal run),
+            "accumulator" (shared segment spectra, see kqeeg.accumulator) or
+            "accumulator_window_psd" (shared coherence, exact-mode PSD).
+        block_bytes (int): Approximate memory budget for one block.
+
+    Returns:
+        dict: (win_sec, overlap_perc) -> results dict, as returned by
+        analyze_with_events for that setting.
+    """
+    from tqdm import tqdm
+    if spectral_mode not in SPECTRAL_MODES:
+        raise ValueError(f"Unknown spectral_mode: {spectral_mode!r} (expected one of {SPECTRAL_MODES})")
+
+    settings = [tuple(s) for s in settings]
+    geometry = _geometry(settings, sfreq)
+    starts_per_setting = [window_starts(data.shape[1], W, step) for W, step in geometry]
+
+    # Distinct windows of all settings: e.g. the 50% windows are a subset of
+    # the 75% ones with the same length, so they are computed only once
+    lengths = np.concatenate([np.full(len(s), W) for s, (W, _) in zip(starts_per_setting, geometry)])
+    unique, inverse = np.unique(np.stack([lengths, np.concatenate(starts_per_setting)], axis=1),
+                                axis=0, return_inverse=True)
+    lengths, starts = unique[:, 0], unique[:, 1]
+    shared = {name: np.empty(len(unique)) for name in METRIC_COLUMNS}
+    count("windows", len(unique))
+
+    with tqdm(total=len(unique), desc="Calculating KQ (sweep)") as pbar:
+        # Exact mode, and windows too short for the accumulator grid
+        exact = (lengths < COH_NPERSEG) | (spectral_mode == "exact")
+        for W in np.unique(lengths[exact]):
+            rows = np.flatnonzero(lengths == W)      # sorted by start
+            for k0, columns in iter_exact_metrics_at(data, sfreq, starts[rows], int(W), coh_channels,
+                                                     block_bytes):
+                sub = rows[k0:k0 + len(columns["KQ_naive"])]
+                for name in METRIC_COLUMNS:
+                    shared[name][sub] = columns[name]
+                pbar.update(len(sub))
+
+        rows = np.flatnonzero(~exact)
+        if len(rows):
+            window_psd = spectral_mode == "accumulator_window_psd"
+            steps = [step for W, step in geometry if W >= COH_NPERSEG]
+            acc = SlidingSpectralAccumulator(data, sfreq, coh_channels=coh_channels, block_bytes=block_bytes,
+                                             hop=aligned_hop(steps, lengths[rows]), psd=not window_psd)
+            gfp, mean_amp, variance = window_moments(data, starts[rows], starts[rows] + lengths[rows])
+            for idx, C, psd_mean, psd_nanmean in acc.iter_windows(starts[rows], starts[rows] + lengths[rows]):
+                for W in np.unique(lengths[rows[idx]]):
+                    mask = lengths[rows[idx]] == W
+                    sub, local = rows[idx[mask]], idx[mask]
+                    if window_psd:
+                        f, means, nanmeans = window_psd_means(data, sfreq, starts[sub], W, block_bytes)
+                    else:
+                        f, means, nanmeans = grid_psd_means(acc, W, psd_mean[mask], psd_nanmean[mask])
+                    columns = _assemble(starts[sub], W, sfreq, gfp[local], mean_amp[local], variance[local], f,
+                                        means, nanmeans, C[mask])
+                    for name in METRIC_COLUMNS:
+                        shared[name][sub] = columns[name]
+                pbar.update(len(idx))
+    return _per_setting(settings, starts_per_setting, inverse, shared)
+
+
+def _per_setting(settings, starts_per_setting, inverse, shared):
+    """Splits the distinct-window columns back into one time series per setting."""
+    sweeps = {}
+    bounds = np.cumsum([0] + [len(s) for s in starts_per_setting])
+    for k, setting in enumerate(settings):
+        rows = inverse.ravel()[bounds[k]:bounds[k + 1]]
+        sweeps[setting] = {name: shared[name][rows] for name in METRIC_COLUMNS}
+    return sweeps
+
+
+def sweep_dataframe(sweeps, phases):
+    """
+    One long table for all settings: 'win_sec' and 'overlap_perc' columns,
+    then the usual per-window and derived columns of each setting.
+    """
+    frames = []
+    for (win_sec, overlap_perc), results in sweeps.items():
+        df = pd.DataFrame(results)
+        add_derived_metrics(df, phases, win_sec, overlap_perc)
+        df.insert(0, "win_sec", win_sec)
+        df.insert(1, "overlap_perc", overlap_perc)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def plot_sweep(df, phases, subject_id, plot_filename):
+    """Saves KQ / C / H_norm of every setting overlaid on one 3-panel figure."""
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(3, 1, figsize=(20, 15), sharex=True)
+    fig.suptitle(f"KQ, C, H_norm window sweep — sub-{subject_id}", fontsize=16)
+    for (win_sec, overlap_perc), g in df.groupby(["win_sec", "overlap_perc"], sort=False):
+        label = f"{win_sec:g} s / {overlap_perc:g}%"
+        for ax, column in zip(axes, ["KQ_naive", "C_naive", "H_norm_naive"]):
+            ax.plot(g['t_mid_sec'], np.nan_to_num(g[column], nan=0.0, posinf=0.0, neginf=0.0),
+                    lw=1, alpha=0.7, label=label)
+    for ax, ylabel in zip(axes, ["KQ", "C (Coherence)", "H_norm (Entropy)"]):
+        ax.set_ylabel(ylabel, fontsize=12)
+        ax.grid(True)
+        for t0, t1, name in phases:
+            ax.axvspan(t0, t1, alpha=0.1, color='gray')
+    axes[0].legend(loc='upper left', ncol=4, fontsize=9)
+    axes[2].set_xlabel("Time (s)", fontsize=12)
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+    plt.savefig(plot_filename, dpi=200)
+    plt.close()
+
+
+def write_sweep_outputs(out_dir, dataset_path, subject_id, timestamp, sweeps, events, sfreq, phases,
+                        spectral_mode, formats=DEFAULT_RESULT_FORMATS, float32=False, compression=None,
+                        precision="float64"):
+    """
+    Writes kq_sweep_timeseries.<parquet|h5|csv> (all settings),
+    events_full_synchronized.tsv, run_metadata.json and
+    plots/KQ_sweep_sub-<id>.png into `out_dir` (formats as in write_outputs).
+
+    Returns:
+        pd.DataFrame: The long sweep table.
+    """
+    os.makedirs(os.path.join(out_dir, "plots"), exist_ok=True)
+    with stage("output"):
+        with stage("output/derived"):
+            df = sweep_dataframe(sweeps, phases)
+        with stage("output/results"):
+            result_files = write_results(df, os.path.join(out_dir, "kq_sweep_timeseries"), formats, float32,
+                                         compression)
+
+        if not events.empty:
+            events.to_csv(os.path.join(out_dir, "events_full_synchronized.tsv"), sep='\t', index=False)
+
+        with stage("output/plot"):
+            plot_sweep(df, phases, subject_id, os.path.join(out_dir, "plots", f"KQ_sweep_sub-{subject_id}.png"))
+
+    metadata = {
+        "run_id": f"sub-{subject_id}_{timestamp}",
+        "subject_id": subject_id,
+        "dataset_name": os.path.basename(os.path.normpath(dataset_path)),
+        "analysis_timestamp": timestamp,
+        "calculation_mode": f"Window sweep ({spectral_mode} spectra)",
+        "sampling_rate_hz_after_resample": sfreq,
+        "window_settings": [list(setting) for setting in sweeps],
+        "filter_band_hz": [0.5, 45.0],
+        "computation_precision": precision,
+        "phases_loaded": phases,
+        "results_files": [os.path.basename(path) for path in result_files],
+        "results_float32": float32,
+    }
+    if active_profile() is not None:
+        metadata["profile"] = active_profile().summary()
+    meta_filename = os.path.join(out_dir, "run_metadata.json")
+    try:
+        with open(meta_filename, 'w') as f:
+            json.dump(metadata, f, indent=4)
+    except Exception as e:
+        print(f"Warning: Could not save metadata JSON: {e}")
+    return df
@@ -0,0 +1,39 @@
+# Shared fixtures: small synthetic recordings in the ds005620 layout
+# (benchmarks.synthetic), so the tests exercise the real MNE reader,
+# resampling, filtering and outputs without the dataset.
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import make_dataset
+
+# Small enough that a whole subject runs in a few seconds
+N_CHANNELS = 8
+RUN_SEC = 20.0
+
+
+def write_subject(root, subject_id, seed=0):
+    """Writes (or rewrites, with other samples) one synthetic subject under `root`."""
+    return make_dataset(str(root), subject_id, n_channels=N_CHANNELS, run_sec=RUN_SEC, seed=seed)
+
+
+@pytest.fixture(autouse=True)
+def _headless(monkeypatch):
+    """Summary plots go to files, never to a window."""
+    monkeypatch.setenv("MPLBACKEND", "Agg")
+
+
+@pytest.fixture(scope="session")
+def dataset(tmp_path_factory):
+    """Read-only dataset with subjects 9001 and 9002 (tests that modify inputs write their own)."""
+    root = tmp_path_factory.mktemp("ds")
+    write_subject(root, "9001", seed=0)
+    write_subject(root, "9002", seed=1)
+    return str(root)
+
+
+@pytest.fixture(scope="session")
+def signal():
+    """Filtered-looking random signal (channels, samples) at 500 Hz."""
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((N_CHANNELS, 500 * 120)) * 20e-6
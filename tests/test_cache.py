@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from kqeeg.cache import cache_entries, load_full_cycle_cached
+from kqeeg.pipeline import load_full_cycle_and_events
+
+from .conftest import write_subject
+
+
+def test_cache_hit_and_invalidation(tmp_path):
+    dataset = write_subject(tmp_path / "ds", "9001", seed=0)
+    cache_dir = str(tmp_path / "cache")
+
+    data, sfreq, phases, duration, events = load_full_cycle_cached(dataset, "9001", cache_dir)
+    expected = load_full_cycle_and_events(dataset, "9001")
+    np.testing.assert_array_equal(data, expected[0])
+    assert (sfreq, phases, duration) == expected[1:4]
+    pd.testing.assert_frame_equal(events, expected[4])
+    [entry] = cache_entries(cache_dir)
+
+    # Unchanged inputs: the same entry is memory-mapped again
+    hit = load_full_cycle_cached(dataset, "9001", cache_dir)
+    assert isinstance(hit[0], np.memmap)
+    np.testing.assert_array_equal(hit[0], data)
+    assert [e["key"] for e in cache_entries(cache_dir)] == [entry["key"]]
+
+    # New samples in the same files: a new entry replaces the outdated one
+    write_subject(tmp_path / "ds", "9001", seed=1)
+    changed = load_full_cycle_cached(dataset, "9001", cache_dir)
+    np.testing.assert_array_equal(changed[0], load_full_cycle_and_events(dataset, "9001")[0])
+    assert not np.array_equal(changed[0], data)
+    assert [e["key"] for e in cache_entries(cache_dir)] != [entry["key"]]
+    assert len(cache_entries(cache_dir)) == 1
+
+
+def test_cache_invalidated_by_events_file(tmp_path):
+    """Small files are keyed by content: editing an events .tsv invalidates the entry."""
+    dataset = write_subject(tmp_path / "ds", "9001", seed=0)
+    cache_dir = str(tmp_path / "cache")
+    events = load_full_cycle_cached(dataset, "9001", cache_dir)[4]
+    [entry] = cache_entries(cache_dir)
+
+    eeg_path = os.path.join(dataset, "sub-9001", "eeg")
+    tsv = next(os.path.join(eeg_path, name) for name in sorted(os.listdir(eeg_path)) if name.endswith("_events.tsv"))
+    table = pd.read_csv(tsv, sep="\t")
+    table["onset"] += 1.0
+    table.to_csv(tsv, sep="\t", index=False)
+
+    reloaded = load_full_cycle_cached(dataset, "9001", cache_dir)[4]
+    assert [e["key"] for e in cache_entries(cache_dir)] != [entry["key"]]
+    assert not reloaded["onset_global"].equals(events["onset_global"])
@@ -0,0 +1,86 @@
+import inspect
+import json
+import os
+
+import numpy as np
+import pytest
+
+from kqeeg import metrics
+from kqeeg.checkpoint import CHECKPOINT_DIR, WindowCheckpoint
+from kqeeg.cube import SpectralCube
+from kqeeg.pipeline import run_subject
+from kqeeg.results import read_results
+
+
+class SimulatedKill(BaseException):
+    """Not an Exception, so nothing in the pipeline handles it: the run just stops."""
+
+
+def small_window_blocks(monkeypatch, block_bytes):
+    """Serial runs compute the windows in many small blocks (one checkpoint write each)."""
+    params = inspect.signature(metrics.iter_window_metrics).parameters.items()
+    defaults = tuple(block_bytes if name == "block_bytes" else param.default for name, param in params
+                     if param.default is not inspect.Parameter.empty)
+    monkeypatch.setattr(metrics.iter_window_metrics, "__defaults__", defaults)
+
+
+@pytest.mark.parametrize("options", [{"n_jobs": 1}, {"n_jobs": 2, "spectral_cube": "gzip"}])
+def test_resume_matches_uninterrupted_run(dataset, tmp_path, monkeypatch, capsys, options):
+    small_window_blocks(monkeypatch, 2**20)
+    kwargs = dict(formats=("parquet",), **options)
+    ref = run_subject(dataset, "9001", out_dir=str(tmp_path / "ref"), checkpoint_sec=0, **kwargs)
+    expected = read_results(os.path.join(ref, "kq_timeseries_hybrid.parquet"))
+    out = str(tmp_path / "out")
+
+    # Killed right after the third checkpoint save
+    save = WindowCheckpoint.save
+    saves = []
+
+    def save_then_kill(self):
+        save(self)
+        saves.append(1)
+        if len(saves) == 3:
+            raise SimulatedKill()
+
+    monkeypatch.setattr(WindowCheckpoint, "save", save_then_kill)
+    with pytest.raises(SimulatedKill):
+        run_subject(dataset, "9001", out_dir=out, checkpoint_sec=1e-9, **kwargs)
+    monkeypatch.setattr(WindowCheckpoint, "save", save)
+    with open(os.path.join(out, CHECKPOINT_DIR, "state.json")) as f:
+        assert 0 < json.load(f)["windows_done"] < len(expected)
+
+    capsys.readouterr()
+    run_subject(dataset, "9001", out_dir=out, checkpoint_sec=1e-9, **kwargs)
+    assert "Resuming from checkpoint" in capsys.readouterr().out
+    assert not os.path.exists(os.path.join(out, CHECKPOINT_DIR))
+    resumed = read_results(os.path.join(out, "kq_timeseries_hybrid.parquet"))
+    assert resumed.equals(expected)
+    if options.get("spectral_cube"):
+        with SpectralCube(os.path.join(ref, "spectral_cube.h5")) as a, \
+                SpectralCube(os.path.join(out, "spectral_cube.h5")) as b:
+            np.testing.assert_array_equal(b.psd(), a.psd())
+            np.testing.assert_array_equal(b.coherence(), a.coherence())
+            np.testing.assert_array_equal(b.t_mid_sec, a.t_mid_sec)
+
+
+def test_checkpoint_of_other_parameters_is_ignored(dataset, tmp_path, monkeypatch, capsys):
+    """A checkpoint left by another analysis of the same folder is discarded, not resumed."""
+    small_window_blocks(monkeypatch, 2**20)
+    out = str(tmp_path / "out")
+    save = WindowCheckpoint.save
+
+    def save_then_kill(self):
+        save(self)
+        raise SimulatedKill()
+
+    monkeypatch.setattr(WindowCheckpoint, "save", save_then_kill)
+    with pytest.raises(SimulatedKill):
+        run_subject(dataset, "9001", out_dir=out, checkpoint_sec=1e-9, formats=("parquet",), coh_channels=4)
+    monkeypatch.setattr(WindowCheckpoint, "save", save)
+
+    ref = run_subject(dataset, "9001", out_dir=str(tmp_path / "ref"), checkpoint_sec=0, formats=("parquet",))
+    capsys.readouterr()
+    run_subject(dataset, "9001", out_dir=out, checkpoint_sec=1e-9, formats=("parquet",))
+    assert "Resuming" not in capsys.readouterr().out
+    assert read_results(os.path.join(out, "kq_timeseries_hybrid.parquet")).equals(
+        read_results(os.path.join(ref, "kq_timeseries_hybrid.parquet")))
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from kqeeg.derived import DERIVED_COLUMNS, DerivedMetrics, baseline_interval, derivative_dt
+from kqeeg.pipeline import add_derived_metrics
+
+PHASES = [(0.0, 59.0, "awake_EC"), (59.0, 119.0, "awake_EO"), (119.0, 299.0, "sed_run1")]
+WIN_SEC, OVERLAP_PERC = 2.0, 50
+
+
+def pandas_derived(df, phases, win_sec, overlap_perc):
+    """The derived columns as the original engine computed them, from the finished table."""
+    df = df.copy()
+    dt = df['t_mid_sec'].diff().mean()
+    if dt is None or np.isnan(dt) or dt == 0:
+        dt = win_sec * (1 - overlap_perc / 100.0)
+    df['dKQ_dt'] = (df['KQ_naive'].diff() / dt).fillna(0)
+    df['KQ_local_variance'] = df['KQ_naive'].rolling(window=5, min_periods=1, center=True).var().fillna(0)
+    baseline_phase = None
+    for s, e, name in phases:
+        if 'awake' in name:
+            baseline_phase = (s, e)
+            break
+    baseline_mean = 0.0
+    baseline_std = 1.0
+    if baseline_phase:
+        s, e = baseline_phase
+        baseline_df = df[(df['t_mid_sec'] >= s) & (df['t_mid_sec'] <= e)]
+        if not baseline_df.empty:
+            baseline_mean = baseline_df['KQ_naive'].mean()
+            baseline_std = baseline_df['KQ_naive'].std()
+            if baseline_std < 1e-6 or np.isnan(baseline_std):
+                baseline_std = 1.0
+    df['KQ_zscore'] = (df['KQ_naive'] - baseline_mean) / (baseline_std + 1e-12)
+    return df
+
+
+def kq_table(kind, n=299):
+    rng = np.random.default_rng(1)
+    t_mid = np.arange(n) * 1.0 + 1.0
+    if kind == "random":
+        kq = rng.gamma(2.0, 0.5, n)
+    elif kind == "nan":
+        kq = rng.gamma(2.0, 0.5, n)
+        kq[rng.choice(n, 20, replace=False)] = np.nan
+    elif kind == "offset":
+        # Large common offset with small steps: exercises the cancellation path of the rolling variance
+        kq = 1e8 + np.repeat(rng.standard_normal(n // 10 + 1), 10)[:n] * 1e-3
+    else:  # constant baseline: std 0 -> 1
+        kq = np.where(t_mid < 120, 0.7, rng.gamma(2.0, 0.5, n))
+    return pd.DataFrame({"t_mid_sec": t_mid, "KQ_naive": kq})
+
+
+@pytest.mark.parametrize("kind", ["random", "nan", "offset", "constant"])
+@pytest.mark.parametrize("block", [1, 7, 1000])
+def test_incremental_matches_pandas(kind, block):
+    """DerivedMetrics fed block by block gives the pandas diff/rolling/zscore columns."""
+    df = kq_table(kind)
+    expected = pandas_derived(df, PHASES, WIN_SEC, OVERLAP_PERC)
+
+    t_mid, kq = df["t_mid_sec"].to_numpy(), df["KQ_naive"].to_numpy()
+    derived = DerivedMetrics(derivative_dt(t_mid, WIN_SEC, OVERLAP_PERC), baseline_interval(PHASES))
+    released = {name: np.full(len(df), np.nan) for name in DERIVED_COLUMNS}
+    n_released = 0
+    for w0 in range(0, len(df), block):
+        parts = [derived.update(t_mid[w0:w0 + block], kq[w0:w0 + block])]
+        if w0 + block >= len(df):
+            parts.append(derived.finish())
+        for first, columns in parts:
+            n = len(columns["dKQ_dt"])
+            assert first == n_released  # released in order, each window once
+            for name in DERIVED_COLUMNS:
+                released[name][first:first + n] = columns[name]
+            n_released += n
+    assert n_released == len(df)
+    for name in DERIVED_COLUMNS:
+        np.testing.assert_array_equal(released[name], expected[name].to_numpy(), err_msg=name)
+
+
+def test_add_derived_metrics_matches_pandas():
+    df = kq_table("random")
+    expected = pandas_derived(df, PHASES, WIN_SEC, OVERLAP_PERC)
+    result = add_derived_metrics(df.copy(), PHASES, WIN_SEC, OVERLAP_PERC)
+    for name in DERIVED_COLUMNS:
+        np.testing.assert_array_equal(result[name].to_numpy(), expected[name].to_numpy(), err_msg=name)
+
+
+def test_windows_released_once_baseline_ends():
+    """Windows after the baseline are final at once (backward difference, trailing variance lag only)."""
+    df = kq_table("random")
+    t_mid, kq = df["t_mid_sec"].to_numpy(), df["KQ_naive"].to_numpy()
+    derived = DerivedMetrics(1.0, baseline_interval(PHASES))
+    first, columns = derived.update(t_mid[:59], kq[:59])
+    assert len(columns["KQ_zscore"]) == 0  # baseline still running
+    first, columns = derived.update(t_mid[59:200], kq[59:200])
+    assert first == 0 and len(columns["KQ_zscore"]) == 200 - 2  # centered variance over 5 waits 2 windows
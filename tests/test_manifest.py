@@ -0,0 +1,47 @@
+import os
+
+from kqeeg.batch import run_batch
+from kqeeg.manifest import analysis_params, default_out_root
+
+from .conftest import write_subject
+
+
+def statuses(summary):
+    return {r["subject_id"]: r["status"] for r in summary}
+
+
+def test_rerun_skips_unchanged_subjects(tmp_path):
+    dataset = str(tmp_path / "ds")
+    write_subject(dataset, "9001", seed=0)
+    write_subject(dataset, "9002", seed=1)
+
+    assert statuses(run_batch(dataset)) == {"9001": "ok", "9002": "ok"}
+    out_root = default_out_root(dataset)
+    table = os.path.join(out_root, "sub-9001", "kq_timeseries_hybrid.parquet")
+    mtime = os.stat(table).st_mtime_ns
+
+    assert statuses(run_batch(dataset)) == {"9001": "up_to_date", "9002": "up_to_date"}
+    assert os.stat(table).st_mtime_ns == mtime
+
+    # Changed inputs of one subject: only that one is analyzed again
+    write_subject(dataset, "9002", seed=2)
+    assert statuses(run_batch(dataset)) == {"9001": "up_to_date", "9002": "ok"}
+
+    # Changed parameters, forced runs and deleted outputs are recomputed
+    assert statuses(run_batch(dataset, subjects=["9001"], win_sec=4.0)) == {"9001": "ok"}
+    assert statuses(run_batch(dataset, subjects=["9001"], win_sec=4.0, force=True)) == {"9001": "ok"}
+    os.remove(os.path.join(out_root, "sub-9002", "run_metadata.json"))
+    assert statuses(run_batch(dataset)) == {"9001": "ok", "9002": "ok"}
+
+    # Every run left its own summary in the stable output folder
+    assert len(os.listdir(os.path.join(out_root, "runs"))) == 6
+
+
+def test_params_ignore_defaults_and_neutral_options():
+    """The GUI (few arguments) and the batch runner (every option) fingerprint the same analysis alike."""
+    gui = analysis_params(2.0, 50, {"cache_dir": "/tmp/cache", "n_jobs": 4})
+    batch = analysis_params(2.0, 50, {"coh_channels": 20, "formats": ["parquet"], "float32": False,
+                                      "compression": None, "resampler": "fft", "precision": "float64",
+                                      "stream": False, "load_jobs": 4, "profile": False})
+    assert gui == batch
+    assert analysis_params(2.0, 50, {"formats": ["csv"]}) != batch
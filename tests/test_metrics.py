@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from benchmarks.precision import PRECISION_RTOL
+from benchmarks.reference import REFERENCE_RTOL, reference_tolerance, reference_window_metrics
+from benchmarks.synthetic import synthetic_eeg
+from kqeeg.metrics import METRIC_COLUMNS, iter_window_metrics, window_starts
+from kqeeg.spectral import naive_coherence
+from kqeeg.stream import BandpassFilter
+from kqeeg.sweep import sweep_window_metrics
+
+SFREQ = 500.0
+COH_CHANNELS = 8     # fewer than the channels, so the channel limit is exercised too
+VALUE_COLUMNS = [name for name in METRIC_COLUMNS if not name.startswith("t_")]
+
+# float32 computation: the columns benchmarks.precision gates, and ~1e-7 for the rest
+FLOAT32_RTOL = {**dict.fromkeys(VALUE_COLUMNS, 1e-6), **PRECISION_RTOL}
+
+# scipy.signal.coherence in the reference loop warns about windows shorter than one segment
+pytestmark = pytest.mark.filterwarnings("ignore:nperseg=256 is greater than signal length:UserWarning")
+
+
+@pytest.fixture(scope="module")
+def recording():
+    """12 s of filtered synthetic EEG (10 channels)."""
+    return BandpassFilter(SFREQ, 10)(synthetic_eeg(10, 6000, SFREQ, seed=3))
+
+
+def collect(blocks):
+    """Blocks of iter_window_metrics -> one array per column."""
+    out = {name: [] for name in METRIC_COLUMNS}
+    for _, columns in blocks:
+        for name in METRIC_COLUMNS:
+            out[name].append(columns[name])
+    return {name: np.concatenate(arrays) for name, arrays in out.items()}
+
+
+def reference_columns(data, starts, win_samples):
+    """reference_window_metrics of every window, as one array per column."""
+    refs = [reference_window_metrics(data[:, s:s + win_samples], SFREQ, COH_CHANNELS) for s in starts]
+    return {name: np.array([ref[name] for ref in refs]) for name in VALUE_COLUMNS}
+
+
+def assert_matches(actual, expected, rtol):
+    """
+    Every column within `rtol` (a float, or column -> tolerance) of the
+    column's largest reference magnitude.
+    """
+    for name, values in expected.items():
+        tol = rtol[name] if isinstance(rtol, dict) else rtol
+        np.testing.assert_allclose(actual[name], values, rtol=0, atol=tol * np.abs(values).max(), err_msg=name)
+
+
+@pytest.mark.parametrize("win_samples", [1000, 200])
+def test_naive_coherence_matches_reference(recording, win_samples):
+    """The vectorized C equals the per-pair scipy coherence loop, also when a window is shorter than one segment."""
+    starts = window_starts(recording.shape[1], win_samples, win_samples)
+    windows = np.stack([recording[:, s:s + win_samples] for s in starts])
+    expected = reference_columns(recording, starts, win_samples)["C_naive"]
+    np.testing.assert_allclose(naive_coherence(windows, max_channels=COH_CHANNELS), expected, rtol=REFERENCE_RTOL)
+    assert naive_coherence(windows[0], max_channels=COH_CHANNELS) == pytest.approx(expected[0], rel=REFERENCE_RTOL)
+
+
+@pytest.mark.parametrize("win_samples,step", [(1000, 500), (750, 750), (200, 100)])
+def test_exact_windows_match_reference(recording, win_samples, step):
+    starts = window_starts(recording.shape[1], win_samples, step)
+    results = collect(iter_window_metrics(recording, SFREQ, win_samples, step, coh_channels=COH_CHANNELS))
+    np.testing.assert_array_equal(results["t_start_sec"], starts / SFREQ)
+    assert_matches(results, reference_columns(recording, starts, win_samples), REFERENCE_RTOL)
+
+
+@pytest.mark.parametrize("spectral_mode", ["accumulator", "accumulator_window_psd"])
+@pytest.mark.parametrize("win_samples,step", [(1000, 500), (1024, 256), (200, 100)])
+def test_accumulator_windows_match_reference(recording, spectral_mode, win_samples, step):
+    """Within the documented accumulator tolerances (exact for windows shorter than one segment)."""
+    starts = window_starts(recording.shape[1], win_samples, step)
+    results = collect(iter_window_metrics(recording, SFREQ, win_samples, step, coh_channels=COH_CHANNELS,
+                                          spectral_mode=spectral_mode))
+    rtol = {name: reference_tolerance(name, spectral_mode) for name in VALUE_COLUMNS}
+    assert_matches(results, reference_columns(recording, starts, win_samples), rtol)
+
+
+@pytest.mark.parametrize("win_samples,step", [(1000, 500), (200, 100)])
+def test_float32_windows_match_reference(recording, win_samples, step):
+    starts = window_starts(recording.shape[1], win_samples, step)
+    results = collect(iter_window_metrics(recording.astype(np.float32), SFREQ, win_samples, step,
+                                          coh_channels=COH_CHANNELS))
+    assert_matches(results, reference_columns(recording, starts, win_samples), FLOAT32_RTOL)
+
+
+@pytest.mark.parametrize("spectral_mode", ["exact", "accumulator", "accumulator_window_psd"])
+def test_sweep_matches_reference(recording, spectral_mode):
+    """Every setting of a sweep, including one shorter than a coherence segment."""
+    settings = [(2.0, 50.0), (2.0, 75.0), (1.5, 0.0), (0.4, 50.0)]
+    sweeps = sweep_window_metrics(recording, SFREQ, settings, coh_channels=COH_CHANNELS,
+                                  spectral_mode=spectral_mode)
+    rtol = {name: reference_tolerance(name, spectral_mode) for name in VALUE_COLUMNS}
+    for (win_sec, overlap_perc), results in sweeps.items():
+        win_samples = int(win_sec * SFREQ)
+        starts = window_starts(recording.shape[1], win_samples, int(win_samples * (1 - overlap_perc / 100)))
+        np.testing.assert_array_equal(results["t_start_sec"], starts / SFREQ)
+        assert_matches(results, reference_columns(recording, starts, win_samples), rtol)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from kqeeg.metrics import METRIC_COLUMNS, iter_window_metrics, window_starts
+from kqeeg.parallel import iter_window_metrics_parallel
+
+SFREQ, WIN, STEP = 500.0, 1000, 500
+
+
+def collect(blocks, n_windows):
+    """Blocks -> one array per column; checks they arrive in time order without gaps."""
+    out = {name: np.full(n_windows, np.nan) for name in METRIC_COLUMNS}
+    expected = None
+    for w0, columns in blocks:
+        assert expected is None or w0 == expected
+        expected = w0 + len(columns["KQ_naive"])
+        for name in METRIC_COLUMNS:
+            out[name][w0:expected] = columns[name]
+    return out
+
+
+@pytest.mark.parametrize("chunk_windows", [None, 3])
+def test_parallel_matches_serial(signal, chunk_windows):
+    n = len(window_starts(signal.shape[1], WIN, STEP))
+    serial = collect(iter_window_metrics(signal, SFREQ, WIN, STEP), n)
+    parallel = collect(iter_window_metrics_parallel(signal, SFREQ, WIN, STEP, n_jobs=2,
+                                                    chunk_windows=chunk_windows), n)
+    for name in METRIC_COLUMNS:
+        np.testing.assert_array_equal(parallel[name], serial[name], err_msg=name)
+
+
+def test_parallel_memmap_window_range(signal, tmp_path):
+    """Memory-mapped signals are re-opened by the workers; a window range computes only those windows."""
+    mm = np.memmap(tmp_path / "signal.dat", dtype=signal.dtype, mode="w+", shape=signal.shape)
+    mm[:] = signal
+    mm.flush()
+    mm = np.memmap(tmp_path / "signal.dat", dtype=signal.dtype, mode="r", shape=signal.shape)
+    n = len(window_starts(signal.shape[1], WIN, STEP))
+    serial = collect(iter_window_metrics(signal, SFREQ, WIN, STEP, window_range=(10, 90)), n)
+    parallel = collect(iter_window_metrics_parallel(mm, SFREQ, WIN, STEP, n_jobs=2, window_range=(10, 90)), n)
+    assert np.isnan(parallel["KQ_naive"][:10]).all() and np.isnan(parallel["KQ_naive"][90:]).all()
+    for name in METRIC_COLUMNS:
+        np.testing.assert_array_equal(parallel[name], serial[name], err_msg=name)
@@ -0,0 +1,24 @@
+import pytest
+
+from benchmarks.startup import IMPORT_TARGETS, measure_import
+
+# `import kqeeg` alone must not load any numeric or I/O library: names are resolved on first use
+PACKAGE_EXCLUDED = ("mne", "scipy", "matplotlib", "pandas", "tkinter", "tqdm")
+
+# Best-of-three import time in a fresh interpreter (generous: slow CI machines, cold disks)
+PACKAGE_BUDGET_SEC = 0.2
+TARGET_BUDGET_SEC = 3.0
+
+
+def test_package_import_is_lazy():
+    result = measure_import(IMPORT_TARGETS["package"], modules=PACKAGE_EXCLUDED)
+    assert result["heavy"] == []
+    assert result["sec"] < PACKAGE_BUDGET_SEC
+
+
+@pytest.mark.parametrize("target", sorted(IMPORT_TARGETS))
+def test_targets_skip_heavy_modules(target):
+    """Workers that only need the KQ math never import MNE, matplotlib, Tk, tqdm or scipy.signal."""
+    result = measure_import(IMPORT_TARGETS[target])
+    assert result["heavy"] == [], f"{target} imports {', '.join(result['heavy'])}"
+    assert result["sec"] < TARGET_BUDGET_SEC
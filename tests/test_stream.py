@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from scipy.signal import butter, lfilter
+
+from benchmarks.synthetic import make_dataset
+from kqeeg.pipeline import load_full_cycle_and_events
+from kqeeg.stream import FILTER_BAND_HZ, FILTER_ORDER, TARGET_SFREQ, BandpassFilter, SubjectStream, run_order
+
+# Streams one subject through the window metrics twice (the first pass also
+# pays for lazy imports and FFT plans) and reports the peak RSS growth of the
+# second pass; Linux resets the high-water mark through clear_refs
+_RSS_PROBE = """
+import json, sys
+from kqeeg.metrics import iter_stream_window_metrics
+from kqeeg.stream import STREAM_LOAD_JOBS, SubjectStream
+
+def status(key):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith(key))
+
+stream = SubjectStream(sys.argv[1], "9001", block_bytes=2**20, load_jobs=STREAM_LOAD_JOBS)
+for _ in range(2):
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    base = status("VmRSS:")
+    for _ in iter_stream_window_metrics(stream, stream.sfreq, 1000, 500, block_bytes=2**20):
+        pass
+print(json.dumps({"growth": status("VmHWM:") - base, "recording": 8 * stream.n_channels * stream.n_samples}))
+"""
+
+
+def whole_array_load(dataset_path, subject_id):
+    """The original loader: preload, resample and concatenate every run, then filter the whole array."""
+    import mne
+    eeg_path = os.path.join(dataset_path, f"sub-{subject_id}", "eeg")
+    raws = []
+    for _, fname in run_order(subject_id):
+        raw = mne.io.read_raw_brainvision(os.path.join(eeg_path, fname), preload=True, verbose=False)
+        raw.resample(TARGET_SFREQ, npad="auto", verbose=False)
+        raw.pick_types(eeg=True, exclude='bads')
+        raws.append(raw)
+    channels = sorted(set.intersection(*(set(raw.ch_names) for raw in raws)))
+    for raw in raws:
+        raw.pick_channels(channels)
+    data = mne.concatenate_raws(raws).get_data()
+    nyq = 0.5 * TARGET_SFREQ
+    b, a = butter(FILTER_ORDER, [FILTER_BAND_HZ[0] / nyq, FILTER_BAND_HZ[1] / nyq], btype='band')
+    return lfilter(b, a, data, axis=1)
+
+
+@pytest.fixture(scope="module")
+def reference(dataset):
+    return whole_array_load(dataset, "9001")
+
+
+def test_bandpass_blocks_match_one_shot(signal):
+    """Filtering consecutive blocks of uneven size equals one lfilter call over the concatenation."""
+    filt = BandpassFilter(TARGET_SFREQ, signal.shape[0])
+    edges = [0, 1, 17, 5000, 5001, 33333, signal.shape[1]]
+    blocks = [filt(signal[:, s0:s1]) for s0, s1 in zip(edges[:-1], edges[1:])]
+    np.testing.assert_array_equal(np.concatenate(blocks, axis=1), lfilter(filt.b, filt.a, signal, axis=1))
+
+
+@pytest.mark.parametrize("block_bytes,load_jobs", [(2**14, 1), (2**20, 3)])
+def test_stream_matches_whole_array_load(dataset, reference, block_bytes, load_jobs):
+    stream = SubjectStream(dataset, "9001", block_bytes=block_bytes, load_jobs=load_jobs)
+    assert stream.shape == reference.shape
+    blocks = list(stream)
+    assert len(blocks) > 1
+    np.testing.assert_array_equal(np.concatenate(blocks, axis=1), reference)
+    np.testing.assert_array_equal(stream.read(), reference)  # a second pass starts from a fresh filter state
+
+
+def test_loader_matches_whole_array_load(dataset, reference):
+    data, sfreq, phases, duration, events = load_full_cycle_and_events(dataset, "9001")
+    assert sfreq == TARGET_SFREQ
+    np.testing.assert_array_equal(data, reference)
+    assert [name for _, _, name in phases] == [phase for phase, _ in run_order("9001")]
+    assert duration == pytest.approx((reference.shape[1] - 1) / sfreq)
+    assert "onset_global" in events
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="needs the Linux RSS high-water mark")
+def test_streamed_analysis_peak_rss(tmp_path):
+    """Analyzing while streaming holds one resampled run at a time, never the recording's size."""
+    dataset = make_dataset(str(tmp_path / "ds"), "9001", n_channels=16, run_sec=60.0)
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, "-c", _RSS_PROBE, dataset], cwd=repo, capture_output=True, text=True,
+                         check=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    assert result["growth"] < result["recording"]